@@ -1,43 +1,66 @@
+import os
 import random
 import time
 import logging
 
-from .client import process_task
+from . import client, logs, metrics
+from .client import process_batch, process_task
+from .dispatcher import Dispatcher
+from .sources import TASK_SOURCES, ingest
+from .tasks import generate_task
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logs.setup()
+
+QUEUE_DEPTH = metrics.Gauge('proof_queue_depth', 'Tasks waiting for a worker', ['validator_type'])
+INFLIGHT = metrics.Gauge('proof_inflight_requests', 'Requests in flight to validators', ['validator_type'])
+VALIDATORS = metrics.Gauge('proof_validators', 'Validator replicas by lifecycle state', ['validator_type', 'state'])
+
+def validator_counts(backend):
+    counts = {}
+    for validator_type, stats in backend.stats().items():
+        for state, key in (('active', 'replicas'), ('starting', 'starting'), ('paused', 'paused'), ('stopped', 'stopped')):
+            counts[(validator_type, state)] = stats.get(key, 0)
+    return counts
+
+def log_result(task, future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error:
+        logging.error(f"Task for {task['validator_type']} failed: {error}")
+    else:
+        logging.info("Task for %s finished. Valid: %s", task['validator_type'], future.result(), extra=logs.SAMPLED)
 
 def main():
     logging.info("Starting client")
+    logs.install_signal_handlers()
+    backend = client.start()
+    # Without explicit limits, each type may have as many tasks in flight as
+    # its replicas can absorb, and the backend scales on the dispatcher's queue
+    limits = None if os.environ.get('VALIDATOR_CONCURRENCY') else backend.capacity
+    dispatcher = Dispatcher(process_task, batch_handler=process_batch, limits=limits)
+    backend.queue_depth = dispatcher.queue_depth
+
+    QUEUE_DEPTH.set_function(lambda: {(t,): n for t, n in dispatcher.queue_depths().items()})
+    INFLIGHT.set_function(lambda: {(t,): s['inflight'] for t, s in backend.stats().items()})
+    VALIDATORS.set_function(lambda: validator_counts(backend))
+    if metrics.METRICS_PORT:
+        metrics.start_http_server()
+
+    if TASK_SOURCES:
+        # Tasks from producers, by way of the spool
+        ingest(dispatcher, on_done=log_result)
+        return
 
     while True:
-        task = random.choice([
-            {
-                "validator_type": "doordash",
-                "data": {
-                    "id": str(random.randint(1, 1000)),
-                    "name": f"User {random.randint(1, 100)}",
-                    "email": f"user{random.randint(1, 100)}@example.com",
-                    "phone": f"{random.randint(1000000000, 9999999999)}"
-                }
-            },
-            {
-                "validator_type": "analytics",
-                "data": {
-                    "duration": random.randint(30, 300),
-                    "pages": [f"page_{random.randint(1, 10)}" for _ in range(random.randint(1, 10))] + 
-                             random.choice([["cart"], ["checkout"], ["buy"], []])
-                }
-            }
-        ])
-        
-        if task["validator_type"] == "doordash" and random.random() < 0.2:
-            task["data"].pop("phone", None)
-        
-        logging.info(f"Generated task: {task}")
-        process_task(task)
-        
+        task = generate_task()
+        logging.debug("Generated task: %s", task)
+        # Blocks while the dispatch queue is full
+        future = dispatcher.submit(task)
+        future.add_done_callback(lambda f, task=task: log_result(task, f))
+
         time.sleep(random.uniform(1, 5))
 
 if __name__ == "__main__":
     logging.info("Starting main")
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,624 @@
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import docker
+import requests
+import urllib3
+
+from . import metrics
+from .framing import EncodeError
+from .pool import ACQUIRE_TIMEOUT, ValidatorPool
+from .registry import EndpointRegistry
+
+logger = logging.getLogger(__name__)
+
+# How long a task may take once a backend takes it up, unless it carries its
+# own 'timeout' in seconds. Validators are told what is left of it, and drop
+# requests that waited for a worker past it.
+TASK_TIMEOUT = float(os.environ.get('TASK_TIMEOUT', 35))
+DEADLINE_HEADER = 'X-Deadline-Ms'
+# Attempts per task when a failure is worth another try, such as a refused
+# connection while a validator restarts
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY_MS', 50)) / 1000
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY_MS', 2000)) / 1000
+# Retries earned per task and how many may be banked, so a validator that
+# is down is not sent a multiple of its usual load
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0.2))
+RETRY_BUDGET_BURST = float(os.environ.get('RETRY_BUDGET_BURST', 10))
+# A deterministic validator's request goes to a second replica as well once
+# it has taken longer than this quantile of recent requests; 0 disables it
+HEDGE_QUANTILE = float(os.environ.get('HEDGE_QUANTILE', 0.95))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 100))
+HEDGE_WINDOW = int(os.environ.get('HEDGE_WINDOW', 1000))
+HEDGE_WORKERS = int(os.environ.get('HEDGE_WORKERS', 64))
+
+ACQUIRE_TIME = metrics.Histogram('proof_acquire_seconds', 'Time spent waiting for a ready validator replica',
+                                 ['validator_type'])
+REQUEST_TIME = metrics.Histogram('proof_validator_request_seconds',
+                                 'Round trip of requests to validators, including validator compute',
+                                 ['validator_type', 'mode'])
+ERRORS = metrics.Counter('proof_errors_total', 'Failed requests to validators, by error class',
+                         ['validator_type', 'error'])
+RETRIES = metrics.Counter('proof_retries_total', 'Requests sent again after a failure, by error class',
+                          ['validator_type', 'error'])
+HEDGES = metrics.Counter('proof_hedged_requests_total',
+                         'Requests also sent to a second replica, and how many of those answered first',
+                         ['validator_type', 'outcome'])
+
+
+class ValidationError(Exception):
+    """A task that could not be validated, as opposed to one found invalid.
+
+    reason is the error class counted in proof_errors_total. An error is
+    retryable when sending the task again may succeed and can do no harm:
+    the validator never saw it, or its validator is deterministic.
+    """
+
+    def __init__(self, message, reason, retryable=False):
+        super().__init__(message)
+        self.reason = reason
+        self.retryable = retryable
+
+
+class DeadlineExceeded(ValidationError):
+    def __init__(self, message, reason='deadline'):
+        super().__init__(message, reason)
+
+
+def task_deadline(task):
+    return time.monotonic() + task.get('timeout', TASK_TIMEOUT)
+
+
+def backoff(attempt):
+    # Anywhere up to the exponential delay, so tasks that failed together
+    # do not all come back together
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def refused(error, depth=0):
+    # Whether a connection error means nothing was sent, looking through the
+    # exceptions requests and urllib3 wrap it in
+    if isinstance(error, (urllib3.exceptions.NewConnectionError, ConnectionRefusedError, FileNotFoundError)):
+        return True
+    if not isinstance(error, BaseException) or depth > 4:
+        return False
+    inner = (getattr(error, 'reason', None), error.__cause__, error.__context__, *error.args)
+    return any(refused(e, depth + 1) for e in inner if e is not None and e is not error)
+
+
+class RetryBudget:
+    # Every task of a type earns ratio of a retry for the type, up to burst
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, burst=RETRY_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = defaultdict(lambda: burst)
+
+    def deposit(self, validator_type):
+        with self._lock:
+            self._tokens[validator_type] = min(self.burst, self._tokens[validator_type] + self.ratio)
+
+    def withdraw(self, validator_type):
+        with self._lock:
+            if self._tokens[validator_type] < 1:
+                return False
+            self._tokens[validator_type] -= 1
+            return True
+
+
+class LatencyTracker:
+    # A quantile of each type's recent request latencies, recomputed every
+    # few requests rather than on each
+    def __init__(self, quantile=HEDGE_QUANTILE, window=HEDGE_WINDOW, min_samples=HEDGE_MIN_SAMPLES, every=32):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.every = every
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._counts = Counter()
+        self._quantiles = {}
+
+    def observe(self, validator_type, seconds):
+        with self._lock:
+            samples = self._samples[validator_type]
+            samples.append(seconds)
+            self._counts[validator_type] += 1
+            if len(samples) >= self.min_samples and self._counts[validator_type] % self.every == 0:
+                ordered = sorted(samples)
+                self._quantiles[validator_type] = ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))]
+
+    def get(self, validator_type):
+        # None until enough requests have been seen
+        return self._quantiles.get(validator_type)
+
+
+class Backend:
+    """Where validators run and how tasks reach them.
+
+    process_task returns whether a task's data is valid, and raises
+    ValidationError if it could not be validated; process_batch returns a
+    result or a ValidationError for each of a list of tasks of one type.
+    Both give up once the task's deadline has passed. capacity and stats
+    are per validator type, and queue_depth is set by whoever feeds the
+    backend so it can size itself to the backlog.
+
+    With a cache, tasks for deterministic validators are answered from it
+    when they can be; subclasses implement _process_task and _process_batch
+    for the rest and _remember every result a validator actually returned.
+    """
+
+    # A ResultCache, set by client.start()
+    cache = None
+
+    def __init__(self):
+        self.queue_depth = lambda validator_type: 0
+
+    def start(self):
+        pass
+
+    def process_task(self, task):
+        results, misses = self._from_cache([task])
+        return self._process_task(task, task_deadline(task)) if misses else results[0]
+
+    def process_batch(self, tasks):
+        results, misses = self._from_cache(tasks)
+        if len(misses) == 1:
+            task = tasks[misses[0]]
+            try:
+                results[misses[0]] = self._process_task(task, task_deadline(task))
+            except ValidationError as e:
+                results[misses[0]] = e
+        elif misses:
+            missed = [tasks[index] for index in misses]
+            deadline = min(task_deadline(task) for task in missed)
+            for index, result in zip(misses, self._process_batch(missed, deadline)):
+                results[index] = result
+        return results
+
+    def _process_task(self, task, deadline):
+        raise NotImplementedError
+
+    def _process_batch(self, tasks, deadline):
+        results = []
+        for task in tasks:
+            try:
+                results.append(self._process_task(task, deadline))
+            except ValidationError as e:
+                results.append(e)
+        return results
+
+    def deterministic(self, validator_type):
+        # Whether the validator declared that its results may be cached
+        return False
+
+    def version(self, validator_type):
+        # The configuration version the validator reports, part of cache keys
+        return None
+
+    def _from_cache(self, tasks):
+        # Results served from the cache, and the indexes of the tasks that
+        # still have to go to a validator
+        results = [False] * len(tasks)
+        if self.cache is None or not self.deterministic(tasks[0]['validator_type']):
+            return results, list(range(len(tasks)))
+        misses = []
+        for index, task in enumerate(tasks):
+            hit, results[index] = self.cache.get(task['validator_type'], task['data'],
+                                                 self.version(task['validator_type']))
+            if not hit:
+                misses.append(index)
+        return results, misses
+
+    def _remember(self, task, is_valid):
+        if self.cache is not None and self.deterministic(task['validator_type']):
+            self.cache.put(task['validator_type'], task['data'], is_valid, self.version(task['validator_type']))
+
+    def capacity(self, validator_type):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+    def shutdown(self):
+        pass
+
+
+class HttpBackend(Backend):
+    """Sends tasks to validator servers over HTTP.
+
+    Replicas come from a pool's acquire() and release(). Subclasses supply
+    the pool, and mount adapters on each thread's session for transports
+    other than TCP. With a FrameConnectionPool in frames, tasks go over
+    persistent framed connections instead, and over HTTP to validators
+    that do not speak frames.
+
+    Failures worth another try are retried with jittered backoff, within
+    the task's deadline and a retry budget per type. A task for a
+    deterministic validator that runs past the type's usual latency is
+    also sent to a second replica, and the first answer wins.
+    """
+
+    # A FrameConnectionPool, set by client.start()
+    frames = None
+
+    def __init__(self, pool=None, endpoints=None):
+        self.pool = pool
+        self.endpoints = endpoints
+        # Tasks are processed concurrently by the dispatcher, and each
+        # worker thread keeps its own HTTP session
+        self._local = threading.local()
+        self.retries = RetryBudget()
+        self.latency = LatencyTracker()
+        # Runs both requests of a hedged task, so neither blocks the caller
+        self._hedger = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+
+    @property
+    def queue_depth(self):
+        return self.pool.queue_depth
+
+    @queue_depth.setter
+    def queue_depth(self, queue_depth):
+        self.pool.queue_depth = queue_depth
+
+    def capacity(self, validator_type):
+        return self.pool.capacity(validator_type)
+
+    def stats(self):
+        return self.pool.stats()
+
+    def deterministic(self, validator_type):
+        return self.pool.deterministic(validator_type)
+
+    def version(self, validator_type):
+        return self.pool.version(validator_type)
+
+    def shutdown(self):
+        self.pool.shutdown()
+        self._hedger.shutdown(wait=False)
+        if self.frames:
+            self.frames.close()
+
+    def configure_session(self, session):
+        pass
+
+    def url(self, endpoint, path='/'):
+        return f"http://{endpoint.ip}:{endpoint.port}{path}"
+
+    def address(self, endpoint):
+        # Where framed connections to the validator go
+        return (endpoint.ip, endpoint.port)
+
+    def _session(self):
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            self.configure_session(session)
+            self._local.session = session
+        return self._local.session
+
+    def _invalidate(self, endpoint):
+        if self.endpoints:
+            self.endpoints.invalidate(container_id=endpoint.container_id)
+
+    def _process_task(self, task, deadline):
+        return self._with_retries(task['validator_type'], deadline, lambda: self._hedged(task, deadline))
+
+    def _process_batch(self, tasks, deadline):
+        try:
+            return self._with_retries(tasks[0]['validator_type'], deadline, lambda: self._send_batch(tasks, deadline))
+        except ValidationError as e:
+            return [e] * len(tasks)
+
+    def _with_retries(self, validator_type, deadline, attempt):
+        self.retries.deposit(validator_type)
+        for number in itertools.count(1):
+            try:
+                return attempt()
+            except ValidationError as e:
+                if not e.retryable or number >= RETRY_MAX_ATTEMPTS:
+                    raise
+                delay = backoff(number - 1)
+                if time.monotonic() + delay >= deadline or not self.retries.withdraw(validator_type):
+                    raise
+                logger.debug("Retrying %s task in %.0fms after: %s", validator_type, delay * 1000, e)
+                RETRIES.labels(validator_type, e.reason).inc()
+                time.sleep(delay)
+
+    def _hedged(self, task, deadline):
+        validator_type = task['validator_type']
+        delay = self.latency.get(validator_type) if HEDGE_QUANTILE and self.deterministic(validator_type) else None
+        # Without a second replica to send it to, a hedge is not worth the
+        # thread the first request would run on
+        if delay is None or self.pool.replicas(validator_type) < 2:
+            return self._send_task(task, deadline)
+
+        acquired = []
+        primary = self._hedger.submit(self._send_task, task, deadline, acquired)
+        done, _ = wait([primary], timeout=max(0, min(delay, deadline - time.monotonic())))
+        # A request still waiting for a replica would have a hedge wait too
+        if done or not acquired:
+            return primary.result()
+        replica = self.pool.acquire(validator_type, timeout=0, exclude=acquired)
+        if replica is None:
+            return primary.result()
+
+        HEDGES.labels(validator_type, 'sent').inc()
+        hedge = self._hedger.submit(self._send_to, replica, task, deadline)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except ValidationError as e:
+                    error = error or e
+                    continue
+                if future is hedge:
+                    HEDGES.labels(validator_type, 'won').inc()
+                return result
+        raise error
+
+    def _acquire(self, validator_type, deadline):
+        with ACQUIRE_TIME.labels(validator_type).time():
+            timeout = max(0, min(ACQUIRE_TIMEOUT, deadline - time.monotonic()))
+            replica = self.pool.acquire(validator_type, timeout=timeout)
+        if not replica:
+            logger.error(f"Failed to get or create validator for {validator_type}")
+            ERRORS.labels(validator_type, 'no_validator').inc()
+            raise ValidationError(f"No {validator_type} validator was ready", 'no_validator', retryable=True)
+        return replica
+
+    def _check_deadline(self, validator_type, deadline):
+        if time.monotonic() >= deadline:
+            ERRORS.labels(validator_type, 'deadline').inc()
+            raise DeadlineExceeded(f"Task for {validator_type} ran out of time before it was sent")
+
+    def _send_task(self, task, deadline, acquired=None):
+        replica = self._acquire(task['validator_type'], deadline)
+        if acquired is not None:
+            acquired.append(replica)
+        return self._send_to(replica, task, deadline)
+
+    def _send_to(self, replica, task, deadline):
+        validator_type = task['validator_type']
+        # Per-task detail is DEBUG and formatted only if it is logged
+        logger.debug("Starting task for %s on %s: %s", validator_type, replica.name, task['data'])
+
+        start = time.monotonic()
+        try:
+            self._check_deadline(validator_type, deadline)
+            response = self._frame_request(validator_type, replica.endpoint, {'data': task['data']}, deadline, 'frame')
+            if response is None:
+                is_valid = self._post_task(replica.endpoint, task, deadline)
+            elif 'error' in response:
+                logger.error(f"Error processing task: {response['error']}")
+                ERRORS.labels(validator_type, 'record').inc()
+                raise ValidationError(response['error'], 'record')
+            else:
+                is_valid = response['result']['is_valid']
+        finally:
+            self.pool.release(replica, time.monotonic() - start)
+
+        self.latency.observe(validator_type, time.monotonic() - start)
+        logger.debug("Validation result for %s: %s", validator_type, is_valid)
+        self._remember(task, is_valid)
+        return is_valid
+
+    def _frame_request(self, validator_type, endpoint, message, deadline, mode):
+        # The validator's response over a framed connection, or None if the
+        # request has to go over HTTP instead
+        if self.frames is None:
+            return None
+        address = self.address(endpoint)
+        try:
+            connection = self.frames.get(address)
+        except OSError as e:
+            logger.error(f"Connection error: {e}")
+            ERRORS.labels(validator_type, 'connection').inc()
+            self._invalidate(endpoint)
+            raise ValidationError(str(e), 'connection', retryable=True)
+        if connection is None:
+            return None
+
+        remaining = deadline - time.monotonic()
+        try:
+            with REQUEST_TIME.labels(validator_type, mode).time():
+                response = connection.request({**message, 'timeout_ms': int(remaining * 1000)},
+                                              timeout=max(0, remaining))
+        except EncodeError:
+            # Data that msgpack cannot carry, such as integers over 64 bits,
+            # still can as JSON
+            return None
+        except TimeoutError:
+            logger.error(f"Request to {address} timed out")
+            ERRORS.labels(validator_type, 'timeout').inc()
+            raise DeadlineExceeded(f"Request to {address} timed out", 'timeout')
+        except OSError as e:
+            logger.error(f"Connection error: {e}")
+            ERRORS.labels(validator_type, 'connection').inc()
+            self._invalidate(endpoint)
+            # The validator may have seen the request before the connection broke
+            raise ValidationError(str(e), 'connection', retryable=self.deterministic(validator_type))
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            ERRORS.labels(validator_type, 'unexpected').inc()
+            raise ValidationError(f"Unexpected error: {e}", 'unexpected')
+        if response.get('expired'):
+            ERRORS.labels(validator_type, 'deadline').inc()
+            raise DeadlineExceeded(f"{address} dropped the request, its deadline had passed")
+        return response
+
+    def _post_task(self, endpoint, task, deadline):
+        validator_type = task['validator_type']
+        url = self.url(endpoint)
+        remaining = deadline - time.monotonic()
+        try:
+            # Send POST request to the validator using the container's IP
+            logger.debug("Sending request to %s", url)
+            with REQUEST_TIME.labels(validator_type, 'single').time():
+                response = self._session().post(url, json=task['data'], timeout=remaining,
+                                                headers={DEADLINE_HEADER: str(int(remaining * 1000))})
+
+            if response.status_code != 200:
+                logger.error(f"Error processing task: {response.text}")
+                ERRORS.labels(validator_type, f'http_{response.status_code}').inc()
+                raise self._http_error(response)
+
+            return response.json()['is_valid']
+
+        except requests.exceptions.ConnectTimeout:
+            logger.error(f"Connection to {url} timed out")
+            ERRORS.labels(validator_type, 'connect_timeout').inc()
+            self._invalidate(endpoint)
+            raise ValidationError(f"Connection to {url} timed out", 'connect_timeout', retryable=True)
+        except requests.exceptions.ConnectionError as e:
+            logger.error(f"Connection error: {e}")
+            ERRORS.labels(validator_type, 'connection').inc()
+            self._invalidate(endpoint)
+            raise ValidationError(f"Connection error: {e}", 'connection',
+                                  retryable=refused(e) or self.deterministic(validator_type))
+        except requests.exceptions.Timeout:
+            logger.error(f"Request to {url} timed out")
+            ERRORS.labels(validator_type, 'timeout').inc()
+            raise DeadlineExceeded(f"Request to {url} timed out", 'timeout')
+        except ValidationError:
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            ERRORS.labels(validator_type, 'unexpected').inc()
+            raise ValidationError(f"Unexpected error: {e}", 'unexpected')
+
+    def _http_error(self, response):
+        # 503 comes from a validator that is not taking work, so the request
+        # was never served, and 504 from one that got it past its deadline
+        reason = f'http_{response.status_code}'
+        message = f"Validator answered {response.status_code}: {response.text[:200]}"
+        if response.status_code == 503:
+            return ValidationError(message, reason, retryable=True)
+        if response.status_code == 504:
+            return DeadlineExceeded(message, reason)
+        return ValidationError(message, reason)
+
+    def _send_batch(self, tasks, deadline):
+        # All tasks in a batch share a validator type
+        validator_type = tasks[0]['validator_type']
+        replica = self._acquire(validator_type, deadline)
+        logger.debug("Starting batch of %d tasks for %s on %s", len(tasks), validator_type, replica.name)
+
+        start = time.monotonic()
+        try:
+            self._check_deadline(validator_type, deadline)
+            response = self._frame_request(validator_type, replica.endpoint,
+                                           {'batch': [task['data'] for task in tasks]}, deadline, 'frame_batch')
+            if response is None:
+                results = self._post_batch(replica.endpoint, tasks, deadline)
+            else:
+                results = []
+                for index, result in enumerate(response['results']):
+                    if 'error' in result:
+                        logger.error(f"Task {index} in batch for {validator_type} failed: {result['error']}")
+                        ERRORS.labels(validator_type, 'record').inc()
+                        results.append(ValidationError(result['error'], 'record'))
+                    else:
+                        results.append(result['is_valid'])
+        finally:
+            self.pool.release(replica, (time.monotonic() - start) / len(tasks))
+
+        for task, result in zip(tasks, results):
+            if not isinstance(result, Exception):
+                self._remember(task, result)
+        logger.debug("Batch validation results for %s: %s", validator_type, results)
+        return results
+
+    def _post_batch(self, endpoint, tasks, deadline):
+        # Results come back as a stream of NDJSON lines in the order the
+        # records were sent
+        validator_type = tasks[0]['validator_type']
+        url = self.url(endpoint, '/batch')
+        results = [None] * len(tasks)
+        start = time.monotonic()
+        remaining = deadline - start
+        try:
+            body = b''.join(json.dumps(task['data']).encode('utf-8') + b'\n' for task in tasks)
+            headers = {'Content-Type': 'application/x-ndjson', DEADLINE_HEADER: str(int(remaining * 1000))}
+            response = self._session().post(url, data=body, headers=headers, timeout=remaining, stream=True)
+            with response:
+                if response.status_code != 200:
+                    logger.error(f"Error processing batch: {response.text}")
+                    ERRORS.labels(validator_type, f'http_{response.status_code}').inc()
+                    raise self._http_error(response)
+
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    result = json.loads(line)
+                    if 'index' not in result:
+                        logger.error(f"Batch for {validator_type} failed: {result.get('error')}")
+                        ERRORS.labels(validator_type, 'batch').inc()
+                        break
+                    if 'error' in result:
+                        logger.error(f"Task {result['index']} in batch for {validator_type} failed: {result['error']}")
+                        ERRORS.labels(validator_type, 'record').inc()
+                        results[result['index']] = ValidationError(result['error'], 'record')
+                        continue
+                    results[result['index']] = result['is_valid']
+            REQUEST_TIME.labels(validator_type, 'batch').observe(time.monotonic() - start)
+
+        except requests.exceptions.ConnectTimeout:
+            logger.error(f"Connection to {url} timed out")
+            ERRORS.labels(validator_type, 'connect_timeout').inc()
+            self._invalidate(endpoint)
+            raise ValidationError(f"Connection to {url} timed out", 'connect_timeout', retryable=True)
+        except requests.exceptions.ConnectionError as e:
+            logger.error(f"Connection error: {e}")
+            ERRORS.labels(validator_type, 'connection').inc()
+            self._invalidate(endpoint)
+            raise ValidationError(f"Connection error: {e}", 'connection',
+                                  retryable=refused(e) or self.deterministic(validator_type))
+        except requests.exceptions.Timeout:
+            logger.error(f"Request to {url} timed out")
+            ERRORS.labels(validator_type, 'timeout').inc()
+            raise DeadlineExceeded(f"Request to {url} timed out", 'timeout')
+        except ValidationError:
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            ERRORS.labels(validator_type, 'unexpected').inc()
+            raise ValidationError(f"Unexpected error: {e}", 'unexpected')
+
+        # Records the stream stopped short of
+        return [ValidationError("Batch ended before this task's result", 'batch') if result is None else result
+                for result in results]
+
+
+class DockerBackend(HttpBackend):
+    # One container per validator replica, required for SGX
+    def start(self):
+        try:
+            client = docker.from_env(version='auto')
+            client.ping()  # Test the connection
+            logger.info("Connected to Docker")
+        except docker.errors.DockerException as e:
+            logger.error(f"Error connecting to Docker: {e}")
+            sys.exit(1)
+
+        # Endpoints of ready validators, kept current from the Docker event stream
+        self.endpoints = EndpointRegistry()
+        self.endpoints.watch(client)
+
+        # Validator replicas per type, scaled with demand
+        self.pool = ValidatorPool(client, self.endpoints)
+        self.pool.start()
+
+    def shutdown(self):
+        super().shutdown()
+        self.endpoints.stop()
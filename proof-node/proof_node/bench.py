@@ -0,0 +1,292 @@
+# Load generator and benchmark for the proof node.
+#
+# Replays the node's task mix from a fixed seed through the dispatcher and
+# client, against validators run locally straight from proof-tasks (as
+# server processes, or in-process with --backend process), so it needs
+# neither Docker nor network access:
+#
+#   python -m proof_node.bench --mode open --rate 200 --duration 30 --seed 1
+#   python -m proof_node.bench --mode closed --concurrency 32 --output results.json
+#   python -m proof_node.bench --backend process --replicas 4
+#   python -m proof_node.bench --duration 60 --profile manifests
+#
+# Open loop submits tasks at the target rate (Poisson arrivals) however fast
+# they complete and measures latency from each task's scheduled arrival, so
+# a backlog shows up as latency rather than a lower offered load. Closed
+# loop keeps a fixed number of tasks outstanding. Results are JSON.
+#
+# With --profile the validators' peak memory, threads and open files are
+# recorded over the run and their Gramine manifests written out sized to
+# them, see sizing.py.
+import argparse
+import json
+import math
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import wait
+from pathlib import Path
+
+from . import backends, client, logs, sizing
+from .cache import RESULT_CACHE_SIZE, ResultCache
+from .dispatcher import DISPATCH_QUEUE_SIZE, DISPATCH_WORKERS, Dispatcher
+from .local import PROOF_TASKS_DIR, ProcessBackend, SubprocessBackend, validator_types
+from .pool import REPLICA_CONCURRENCY
+from .tasks import generate_task
+
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+
+class Recorder:
+    # Latency and outcome of every task submitted after the warmup
+    def __init__(self):
+        self.measure_from = None
+        self.last_finished = None
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(Counter)
+        self.dropped = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, validator_type, submitted_at, future):
+        finished = time.monotonic()
+        if submitted_at < self.measure_from:
+            return
+        if future.exception() is not None:
+            outcome = 'failed'
+        else:
+            outcome = 'valid' if future.result() else 'invalid'
+        with self._lock:
+            self.latencies[validator_type].append(finished - submitted_at)
+            self.outcomes[validator_type][outcome] += 1
+            self.last_finished = max(self.last_finished or finished, finished)
+
+    def drop(self, validator_type, submitted_at):
+        if submitted_at >= self.measure_from:
+            with self._lock:
+                self.dropped[validator_type] += 1
+
+
+def run_open_loop(dispatcher, rng, recorder, rate, duration, warmup):
+    start = time.monotonic()
+    recorder.measure_from = start + warmup
+    end = recorder.measure_from + duration
+    futures = []
+    arrival = start
+    while True:
+        # Arrival times and tasks come from the same seeded sequence, so
+        # every run offers exactly the same load
+        arrival += rng.expovariate(rate)
+        if arrival >= end:
+            break
+        task = generate_task(rng)
+        delay = arrival - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        validator_type = task['validator_type']
+        try:
+            future = dispatcher.submit(task, block=False)
+        except queue.Full:
+            recorder.drop(validator_type, arrival)
+            continue
+        future.add_done_callback(lambda f, t=validator_type, a=arrival: recorder.record(t, a, f))
+        futures.append(future)
+    wait(futures)
+
+
+def run_closed_loop(dispatcher, rng, recorder, concurrency, duration, warmup):
+    start = time.monotonic()
+    recorder.measure_from = start + warmup
+    end = recorder.measure_from + duration
+    lock = threading.Lock()
+
+    def loop():
+        while True:
+            with lock:
+                task = generate_task(rng)
+            submitted = time.monotonic()
+            if submitted >= end:
+                return
+            future = dispatcher.submit(task)
+            try:
+                future.result()
+            except Exception:
+                pass
+            recorder.record(task['validator_type'], submitted, future)
+
+    threads = [threading.Thread(target=loop, name=f'bench-{i}', daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def percentile(ordered, fraction):
+    # Nearest rank
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def summarize(latencies, outcomes, dropped, elapsed):
+    ordered = sorted(latencies)
+    summary = {
+        'completed': len(ordered),
+        'dropped': dropped,
+        'outcomes': dict(outcomes),
+        'throughput': len(ordered) / elapsed if elapsed > 0 else 0.0,
+        'latency_ms': None,
+    }
+    if ordered:
+        summary['latency_ms'] = {
+            'mean': sum(ordered) / len(ordered) * 1000,
+            **{name: percentile(ordered, fraction) * 1000 for name, fraction in PERCENTILES},
+            'max': ordered[-1] * 1000,
+        }
+    return summary
+
+
+def report(recorder, cache=None):
+    elapsed = (recorder.last_finished - recorder.measure_from) if recorder.last_finished else 0.0
+    types = sorted(set(recorder.latencies) | set(recorder.dropped))
+    return {
+        'elapsed': elapsed,
+        'types': {
+            validator_type: summarize(recorder.latencies[validator_type], recorder.outcomes[validator_type],
+                                      recorder.dropped[validator_type], elapsed)
+            for validator_type in types
+        },
+        'total': summarize(
+            [latency for latencies in recorder.latencies.values() for latency in latencies],
+            sum(recorder.outcomes.values(), Counter()), sum(recorder.dropped.values()), elapsed,
+        ),
+        # Failed requests, including ones a retry or hedge made up for; tasks
+        # that failed in the end are counted as failed above
+        'errors': {f'{validator_type}/{error}': count
+                   for (validator_type, error), count in sorted(backends.ERRORS.totals().items())},
+        'retries': {f'{validator_type}/{error}': count
+                    for (validator_type, error), count in sorted(backends.RETRIES.totals().items())},
+        'hedges': {f'{validator_type}/{outcome}': count
+                   for (validator_type, outcome), count in sorted(backends.HEDGES.totals().items())},
+        'cache': cache.stats() if cache is not None else None,
+    }
+
+
+def print_summary(results):
+    for validator_type, summary in list(results['types'].items()) + [('total', results['total'])]:
+        latency = summary['latency_ms'] or {}
+        percentiles = ' '.join(f"{name}={latency[name]:.1f}ms" for name, _ in PERCENTILES if name in latency)
+        print(f"{validator_type}: {summary['completed']} tasks, {summary['throughput']:.1f}/s, "
+              f"{percentiles}, dropped={summary['dropped']}", file=sys.stderr)
+    if results['hedges']:
+        print(f"hedges: {results['hedges']}", file=sys.stderr)
+    for validator_type, sized in (results.get('profile') or {}).items():
+        print(f"{validator_type}: peak RSS {sized['rss_bytes'] / 1024 / 1024:.0f} MiB, {sized['threads']} threads, "
+              f"{sized['open_files']} open files -> enclave_size {sized['enclave_size']}, "
+              f"max_threads {sized['max_threads']}, written to {sized['manifest']}", file=sys.stderr)
+    if results['cache']:
+        cache = results['cache']
+        print(f"cache: {cache['hits']} hits, {cache['misses']} misses, {cache['entries']} entries", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m proof_node.bench', description='Benchmark the proof node')
+    parser.add_argument('--mode', choices=('open', 'closed'), default='closed')
+    parser.add_argument('--rate', type=float, default=100, help='open loop: tasks per second')
+    parser.add_argument('--concurrency', type=int, default=16, help='closed loop: tasks outstanding')
+    parser.add_argument('--duration', type=float, default=10, help='seconds measured, after the warmup')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds run before measuring')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=('subprocess', 'process'), default='subprocess',
+                        help='validator servers as local processes, or validation in a process pool')
+    parser.add_argument('--transport', choices=('unix', 'tcp'), default='unix',
+                        help='subprocess: how requests reach the validators')
+    parser.add_argument('--protocol', choices=('http', 'frames'), default='http',
+                        help='subprocess: an HTTP request per task, or multiplexed framed connections')
+    parser.add_argument('--replicas', type=int, default=1, help='validator processes per type')
+    parser.add_argument('--validator-workers', type=int, default=None,
+                        help='subprocess: worker threads per validator (default: what its thread budget allows)')
+    parser.add_argument('--replica-concurrency', type=int, default=REPLICA_CONCURRENCY,
+                        help='subprocess: in-flight requests per replica')
+    parser.add_argument('--workers', type=int, default=DISPATCH_WORKERS, help='dispatcher worker threads')
+    parser.add_argument('--queue-size', type=int, default=DISPATCH_QUEUE_SIZE, help='dispatcher capacity')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--cache-size', type=int, default=RESULT_CACHE_SIZE,
+                        help='results cached for deterministic validators, 0 to disable')
+    parser.add_argument('--tasks-dir', default=PROOF_TASKS_DIR, help='proof-tasks checkout')
+    parser.add_argument('--ready-timeout', type=float, default=30)
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='subprocess: write manifests sized from the run to DIR/<type>/, '
+                             'which may be the proof-tasks checkout to update them in place')
+    parser.add_argument('--memory-headroom', type=float, default=sizing.MANIFEST_MEMORY_HEADROOM,
+                        help='profile: share of peak RSS added to the enclave size')
+    parser.add_argument('--thread-headroom', type=int, default=sizing.MANIFEST_THREAD_HEADROOM,
+                        help='profile: threads added to the peak')
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logs.set_level(args.log_level)
+    if not (Path(args.tasks_dir) / 'common' / 'validator_server.py').exists():
+        sys.exit(f"No proof-tasks checkout at {args.tasks_dir}, pass --tasks-dir")
+    if args.profile and args.backend != 'subprocess':
+        sys.exit("--profile measures validator processes and needs the subprocess backend")
+
+    # Validators inherit the environment; keep them off the network
+    os.environ.setdefault('RANDOMNESS_BACKEND', 'local')
+
+    # Profiled validators get the thread budget their enclave would give them
+    validator_env = sizing.validator_env(args.tasks_dir, validator_types(args.tasks_dir)) if args.profile else None
+    peaks = None
+
+    with tempfile.TemporaryDirectory(prefix='proof-bench-') as work_dir:
+        if args.backend == 'process':
+            backend = ProcessBackend(args.tasks_dir, workers=args.replicas, sealed_root=work_dir)
+        else:
+            backend = SubprocessBackend(args.tasks_dir, args.replicas, args.transport, sealed_root=work_dir,
+                                        validator_workers=args.validator_workers,
+                                        replica_concurrency=args.replica_concurrency,
+                                        ready_timeout=args.ready_timeout, validator_env=validator_env)
+        cache = ResultCache(args.cache_size) if args.cache_size else None
+        dispatcher = None
+        sampler = None
+        try:
+            client.start(backend, cache, args.protocol)
+            if args.profile:
+                sampler = sizing.ResourceSampler((v.validator_type, v.process.pid) for v in backend.validators)
+                sampler.start()
+            dispatcher = Dispatcher(client.process_task, workers=args.workers, max_queue=args.queue_size,
+                                    limits=backend.capacity, batch_handler=client.process_batch,
+                                    batch_size=args.batch_size)
+            rng = random.Random(args.seed)
+            recorder = Recorder()
+            if args.mode == 'open':
+                run_open_loop(dispatcher, rng, recorder, args.rate, args.duration, args.warmup)
+            else:
+                run_closed_loop(dispatcher, rng, recorder, args.concurrency, args.duration, args.warmup)
+        finally:
+            if dispatcher:
+                dispatcher.shutdown()
+            peaks = sampler.stop() if sampler else None
+            backend.shutdown()
+
+    results = {'config': vars(args), **report(recorder, cache)}
+    if peaks:
+        results['profile'] = sizing.write_manifests(peaks, args.tasks_dir, args.profile, args.memory_headroom,
+                                                    args.thread_headroom)
+    print_summary(results)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
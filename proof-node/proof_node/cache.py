@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Results kept for validators that declare themselves deterministic; 0
+# disables the cache
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 10000))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 3600))
+
+LOOKUPS = metrics.Counter('proof_result_cache_lookups_total', 'Result cache lookups, by result',
+                          ['validator_type', 'result'])
+EVICTIONS = metrics.Counter('proof_result_cache_evictions_total', 'Results dropped from the cache, by reason',
+                            ['reason'])
+ENTRIES = metrics.Gauge('proof_result_cache_entries', 'Results held in the cache')
+
+
+def task_key(validator_type, data, version=None):
+    # Equal payloads hash the same however their keys happen to be ordered
+    canonical = json.dumps([validator_type, version, data], sort_keys=True, separators=(',', ':'),
+                           ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Validation results by task content, bounded in size and age.
+
+    Least recently used results are evicted first once max_entries is
+    reached, and results older than ttl seconds are never returned.
+    Results are also keyed by the version a validator reports for its
+    configuration, and a type's results are dropped once it reports
+    another.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires at, result, validator type)
+        self._versions = {}  # validator type -> version its results were stored under
+        self._hits = Counter()
+        self._misses = Counter()
+        self._evictions = Counter()
+        ENTRIES.set_function(lambda: len(self))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, validator_type, data, version=None):
+        # (True, result) on a hit, (False, None) otherwise
+        key = task_key(validator_type, data, version)
+        with self._lock:
+            self._check_version(validator_type, version)
+            entry = self._entries.get(key)
+            if entry and entry[0] <= self._clock():
+                del self._entries[key]
+                self._evictions['expired'] += 1
+                EVICTIONS.labels('expired').inc()
+                entry = None
+            if entry is None:
+                self._misses[validator_type] += 1
+            else:
+                self._entries.move_to_end(key)
+                self._hits[validator_type] += 1
+        LOOKUPS.labels(validator_type, 'hit' if entry else 'miss').inc()
+        return (True, entry[1]) if entry else (False, None)
+
+    def put(self, validator_type, data, result, version=None):
+        key = task_key(validator_type, data, version)
+        with self._lock:
+            self._check_version(validator_type, version)
+            self._entries[key] = (self._clock() + self.ttl, result, validator_type)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions['size'] += 1
+                EVICTIONS.labels('size').inc()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _check_version(self, validator_type, version):
+        # Called with the lock held. Results under an older version can never
+        # be hit again, so they go rather than wait to expire.
+        previous = self._versions.setdefault(validator_type, version)
+        if previous == version:
+            return
+        self._versions[validator_type] = version
+        stale = [key for key, entry in self._entries.items() if entry[2] == validator_type]
+        for key in stale:
+            del self._entries[key]
+        self._evictions['version'] += len(stale)
+        EVICTIONS.labels('version').inc(len(stale))
+        logger.info(f"{validator_type} now reports version {version}, dropped {len(stale)} cached results")
+
+    def stats(self):
+        with self._lock:
+            types = sorted(set(self._hits) | set(self._misses))
+            hits = sum(self._hits.values())
+            lookups = hits + sum(self._misses.values())
+            return {
+                'entries': len(self._entries),
+                'hits': hits,
+                'misses': lookups - hits,
+                'hit_ratio': hits / lookups if lookups else 0.0,
+                'evictions': dict(self._evictions),
+                'types': {t: {'hits': self._hits[t], 'misses': self._misses[t]} for t in types},
+            }
@@ -1,182 +1,68 @@
-import docker
-# import json
 import os
 import signal
 import sys
 import logging
-import time
-import requests
-import subprocess
-import socket
+
+from . import logs
+from .backends import DockerBackend, HttpBackend
+from .cache import RESULT_CACHE_SIZE, ResultCache
+from .framing import FrameConnectionPool
+from .local import ProcessBackend, SubprocessBackend
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logs.setup()
 logger = logging.getLogger(__name__)
 
-try:
-    client = docker.from_env(version='auto')
-    client.ping()  # Test the connection
-    logger.info("Connected to Docker")
-except docker.errors.DockerException as e:
-    logger.error(f"Error connecting to Docker: {e}")
-    sys.exit(1)
-MAX_VALIDATORS = int(os.environ.get('MAX_VALIDATORS', 3))
-BASE_PORT = 8000  # Starting port for validators
-
-active_validators = {}
-
-def get_or_create_validator(validator_type):
-    sgx_enabled = os.environ.get('SGX') == 'true'
-    container_name = f'gsc-{validator_type}-proof' if sgx_enabled else f'{validator_type}-proof'
-
-    # Check if a container with the given name already exists
-    existing_containers = client.containers.list(all=True, filters={'name': container_name})
-
-    if existing_containers:
-        container = existing_containers[0]
-        if container.status != 'running':
-            container.start()
-        logger.info(f"Reusing existing validator: {container_name}")
-        active_validators[validator_type] = container
-        return container
-
-    if len(active_validators) >= MAX_VALIDATORS:
-        oldest_type = min(active_validators, key=lambda k: active_validators[k].attrs['Created'])
-        oldest_validator = active_validators.pop(oldest_type)
-        oldest_validator.stop()
-        oldest_validator.remove()
-        logger.info(f"Removed oldest validator: {oldest_type}")
-
-    # Determine the host port for this validator
-    host_port = BASE_PORT + len(active_validators)
-
-    # Prepare SGX-specific configurations
-    devices = ['/dev/sgx_enclave:/dev/sgx_enclave'] if sgx_enabled else None
-    volumes = {'/var/run/aesmd': {'bind': '/var/run/aesmd', 'mode': 'rw'}, f'/mnt/sealed/{container_name}': {'bind': '/sealed', 'mode': 'rw'}} if sgx_enabled else None
-
-    # Include IAS_API_KEY in the environment variables
-    environment = {'SGX_AESM_ADDR': '1'} if sgx_enabled else {}
-    ias_api_key = os.environ.get('IAS_API_KEY')
-    if ias_api_key:
-        environment['IAS_API_KEY'] = ias_api_key
-    else:
-        logger.warning("IAS_API_KEY not set in the environment")
-
-    # Remove None values to avoid empty specs
-    run_kwargs = {
-        'image': f'gsc-{validator_type}-proof' if sgx_enabled else f'{validator_type}-proof',
-        'detach': True,
-        'name': container_name,
-        'ports': {'8000/tcp': host_port},  # Map container port 8000 to a specific host port
-        'command': ["python", "/validate.py"],
-        'environment': environment,
-    }
-    if devices:
-        run_kwargs['devices'] = devices
-    if volumes:
-        run_kwargs['volumes'] = volumes
-
-    validator = client.containers.run(**run_kwargs)
-
-    # Check if the container is running
-    validator.reload()
-    logger.info(f"Created new validator: {validator_type} on host port {host_port}. Status: {validator.status}")
-
-    # Wait for the container to be ready
-    max_retries = 5
-    for i in range(max_retries):
-        validator.reload()
-        if validator.status == 'running':
-            # Check if the server is actually running
-            container_ip = validator.attrs['NetworkSettings']['IPAddress']
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(1)
-            result = s.connect_ex((container_ip, 8000))
-            s.close()
-            if result == 0:
-                logger.info(f"Validator {validator_type} is ready")
-                break
-        logger.info(f"Waiting for validator {validator_type} to start... (Attempt {i+1}/{max_retries})")
-        time.sleep(2)
-
-    if validator.status != 'running':
-        logger.error(f"Validator {validator_type} failed to start. Status: {validator.status}")
-        return None
-
-    active_validators[validator_type] = validator
-    return validator
+# Where validators run: in Docker containers, which SGX requires, as local
+# server processes ('subprocess'), or in a pool of local worker processes
+# that call the validation functions directly ('process')
+VALIDATOR_BACKEND = os.environ.get('VALIDATOR_BACKEND', 'docker')
+# How the node talks to validator servers: an HTTP request per task, or
+# 'frames' for persistent connections carrying many requests at once as
+# length-prefixed msgpack, with HTTP kept for validators that lack them
+VALIDATOR_PROTOCOL = os.environ.get('VALIDATOR_PROTOCOL', 'http')
+
+BACKENDS = {
+    'docker': DockerBackend,
+    'subprocess': SubprocessBackend,
+    'process': ProcessBackend,
+}
+
+# Set by start()
+backend = None
+
+def make_backend(name=VALIDATOR_BACKEND):
+    if os.environ.get('SGX') == 'true' and name != 'docker':
+        raise ValueError(f"The {name} backend cannot run validators in an enclave, SGX needs the docker backend")
+    return BACKENDS[name]()
+
+def start(validator_backend=None, result_cache=None, protocol=VALIDATOR_PROTOCOL):
+    global backend
+    if protocol not in ('http', 'frames'):
+        raise ValueError(f"Unknown validator protocol {protocol!r}, expected http or frames")
+    backend = validator_backend or make_backend()
+    if validator_backend is None and RESULT_CACHE_SIZE:
+        result_cache = ResultCache()
+    backend.cache = result_cache
+    if protocol == 'frames' and isinstance(backend, HttpBackend):
+        backend.frames = FrameConnectionPool()
+    backend.start()
+    if validator_backend is None:
+        signal.signal(signal.SIGTERM, cleanup)
+        signal.signal(signal.SIGINT, cleanup)
+    return backend
 
 def process_task(task):
-    validator_type = task['validator_type']
-    data = task['data']
-
-    validator = get_or_create_validator(validator_type)
-    if not validator:
-        logger.error(f"Failed to get or create validator for {validator_type}")
-        return False
-
-    logger.info(f"Starting task for {validator_type}: {data}")
-
-    try:
-        # Get the container's IP address
-        container_info = client.api.inspect_container(validator.id)
-        container_ip = container_info['NetworkSettings']['IPAddress']
-        logger.info(f"Validator container IP: {container_ip}")
-
-        # Check connectivity
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(5)
-        result = s.connect_ex((container_ip, 8000))
-        if result == 0:
-            logger.info(f"Successfully connected to {container_ip}:8000")
-        else:
-            logger.error(f"Failed to connect to {container_ip}:8000. Error code: {result}")
-        s.close()
-
-        # Send POST request to the validator using the container's IP
-        logger.info(f"Sending request to http://{container_ip}:8000")
-        response = requests.post(f"http://{container_ip}:8000", json=data, timeout=35)
+    return backend.process_task(task)
 
-        if response.status_code != 200:
-            logger.error(f"Error processing task: {response.text}")
-            return False
-
-        result = response.json()
-        logger.info(f"Validation result for {validator_type}: {result}")
-        return result['is_valid']
-
-    except requests.exceptions.ConnectTimeout:
-        logger.error(f"Connection to {container_ip}:8000 timed out")
-    except requests.exceptions.ConnectionError as e:
-        logger.error(f"Connection error: {e}")
-    except socket.gaierror as e:
-        logger.error(f"Address-related error: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-
-    return False
+def process_batch(tasks):
+    return backend.process_batch(tasks)
 
 def cleanup(signum=None, frame=None):
     logger.info("Starting cleanup process")
-    for validator_type in list(active_validators.keys()):
-        container_name = f'gsc-{validator_type}-proof' if os.environ.get('SGX') == 'true' else f'{validator_type}-proof'
-        try:
-            container = client.containers.get(container_name)
-            logger.info(f"Stopping validator {container.name}")
-            container.stop()
-            logger.info(f"Removing validator {container.name}")
-            container.remove()
-            logger.info(f"Successfully removed validator {container.name}")
-            del active_validators[validator_type]
-        except docker.errors.NotFound:
-            logger.info(f"Container {container_name} not found, skipping")
-        except docker.errors.APIError as e:
-            logger.error(f"Error cleaning up validator {container_name}: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error cleaning up validator {container_name}: {e}")
+    try:
+        backend.shutdown()
+    except Exception as e:
+        logger.error(f"Unexpected error cleaning up validators: {e}")
     logger.info("Cleanup process completed")
     sys.exit(0)
-
-# atexit.register(cleanup)
-signal.signal(signal.SIGTERM, cleanup)
-signal.signal(signal.SIGINT, cleanup)
\ No newline at end of file
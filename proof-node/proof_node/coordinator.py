@@ -0,0 +1,672 @@
+# Coordinator mode: spreads tasks over several proof-node instances.
+#
+# The coordinator runs no validators. It takes tasks from TASK_SOURCES into
+# its own spool, as a node would, and forwards each to the node that owns
+# its validator type on a consistent hash ring. Tasks reach a node through
+# that node's own task socket, a unix: or tcp: entry in its TASK_SOURCES. A
+# task is acknowledged in the coordinator's spool once the node has spooled
+# it in turn. If a node fails before answering, its unanswered tasks are
+# sent again, so a task may reach a node more than once.
+#
+# Every task of a type goes to the same node, so that node's validators
+# stay warm. When a node joins or leaves, only the types on the arcs of the
+# ring it gains or loses move. Nodes come from COORDINATOR_NODES, and can
+# join or leave at runtime through the control socket at
+# COORDINATOR_CONTROL, which takes one JSON command per line:
+#
+#   {"join": "tcp:10.0.0.5:7000"}   -> {"ok": true}
+#   {"leave": "tcp:10.0.0.5:7000"}  -> {"ok": true}
+#   {"status": true}                -> {"nodes": {"tcp:10.0.0.5:7000": {"up": true, "queued": 12, ...}}}
+#
+# A node's load is what it last reported when asked on its task socket:
+# queued counts tasks waiting for one of its dispatcher workers and spooled
+# the tasks in its spool that are not yet done. unanswered counts tasks the
+# coordinator sent that the node has not spooled yet.
+#
+# A node whose connection fails leaves the ring until it can be reached
+# again. --local-nodes starts nodes as local processes, with validators
+# run from proof-tasks, to stand in for a cluster:
+#
+#   python -m proof_node.coordinator --nodes tcp:10.0.0.5:7000,tcp:10.0.0.6:7000
+#   python -m proof_node.coordinator --local-nodes 3 --rate 50 --control unix:/tmp/coordinator.sock
+import argparse
+import bisect
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, InvalidStateError
+from pathlib import Path
+
+from . import logs, metrics
+from .sources import TASK_SOURCES, ingest
+from .spool import Spool
+from .tasks import generate_task
+
+logger = logging.getLogger(__name__)
+
+COORDINATOR_NODES = os.environ.get('COORDINATOR_NODES', '')  # comma separated unix:PATH or tcp:HOST:PORT
+COORDINATOR_CONTROL = os.environ.get('COORDINATOR_CONTROL')
+COORDINATOR_SPOOL_DIR = os.environ.get('COORDINATOR_SPOOL_DIR', '/var/spool/proof-coordinator')
+# Points per node on the ring; more spread the hash space more evenly
+NODE_VNODES = int(os.environ.get('NODE_VNODES', 64))
+# Tasks sent to a node that it has not yet answered
+NODE_MAX_INFLIGHT = int(os.environ.get('NODE_MAX_INFLIGHT', 1024))
+NODE_CONNECT_TIMEOUT = float(os.environ.get('NODE_CONNECT_TIMEOUT', 2))
+# How often nodes that are down are tried again
+NODE_RETRY_INTERVAL = float(os.environ.get('NODE_RETRY_INTERVAL', 2))
+# How long a node that leaves gets to answer what was sent to it
+NODE_DRAIN_TIMEOUT = float(os.environ.get('NODE_DRAIN_TIMEOUT', 10))
+COORDINATOR_STATUS_INTERVAL = float(os.environ.get('COORDINATOR_STATUS_INTERVAL', 60))
+# How often nodes are asked for their load, and how long they get to answer
+NODE_STATUS_INTERVAL = float(os.environ.get('NODE_STATUS_INTERVAL', 5))
+NODE_STATUS_TIMEOUT = float(os.environ.get('NODE_STATUS_TIMEOUT', 2))
+STATUS_REQUEST = b'{"status":true}\n'
+
+FORWARDED = metrics.Counter('proof_coordinator_forwarded_total', 'Tasks spooled by each node',
+                            ['node', 'validator_type'])
+RESENT = metrics.Counter('proof_coordinator_resent_total', 'Tasks sent again after a node failed or left', ['node'])
+NODE_INFLIGHT = metrics.Gauge('proof_coordinator_inflight', 'Tasks sent to a node and not yet answered', ['node'])
+NODE_UP = metrics.Gauge('proof_coordinator_node_up', 'Whether the node is on the ring', ['node'])
+NODE_QUEUED = metrics.Gauge('proof_coordinator_node_queued',
+                            'Tasks waiting for a dispatcher worker on a node, as it last reported', ['node'])
+NODE_SPOOLED = metrics.Gauge('proof_coordinator_node_spooled',
+                             'Tasks spooled on a node and not yet done, as it last reported', ['node'])
+
+
+def parse_address(spec):
+    # A Unix socket path, or a (host, port) pair
+    kind, _, target = spec.partition(':')
+    if kind == 'unix' and target:
+        return target
+    if kind == 'tcp':
+        host, _, port = target.rpartition(':')
+        return (host or '127.0.0.1', int(port))
+    raise ValueError(f"Unknown node address {spec!r}, expected unix:PATH or tcp:HOST:PORT")
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Nodes placed on a ring of 64-bit hashes, each at vnodes points.
+
+    A key belongs to the node of the first point at or after the key's
+    hash, so adding or removing a node only moves the keys between its
+    points and the ones before them. Not thread-safe.
+    """
+
+    def __init__(self, vnodes=NODE_VNODES):
+        self.vnodes = vnodes
+        self._points = []  # sorted
+        self._owners = {}  # point -> node
+
+    def __len__(self):
+        return len(set(self._owners.values()))
+
+    def __contains__(self, node):
+        return node in self._owners.values()
+
+    def add(self, node):
+        for i in range(self.vnodes):
+            point = _hash(f'{node}#{i}')
+            if point not in self._owners:
+                self._owners[point] = node
+                bisect.insort(self._points, point)
+
+    def remove(self, node):
+        self._points = [point for point in self._points if self._owners[point] != node]
+        self._owners = {point: self._owners[point] for point in self._points}
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect_left(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+    def shares(self):
+        # The fraction of the hash space each node owns
+        shares = Counter()
+        previous = self._points[-1] - 2 ** 64 if self._points else 0
+        for point in self._points:
+            shares[self._owners[point]] += (point - previous) / 2 ** 64
+            previous = point
+        return dict(shares)
+
+
+def _resolve(future, result=None, error=None):
+    # A task sent twice, once by a failing link and once by a resend, may be
+    # answered twice; the first answer stands
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class NodeLink:
+    """The coordinator's connection to one node's task socket.
+
+    Tasks go out as NDJSON lines and the node answers each, in order, once
+    it is spooled; a reader thread resolves the tasks' futures from the
+    answers. At most max_inflight tasks are unanswered at once. When the
+    connection breaks, the unanswered tasks are handed to on_failure to be
+    sent again. Status requests go down the same connection and are
+    answered in turn.
+    """
+
+    def __init__(self, address, on_failure, max_inflight=NODE_MAX_INFLIGHT, connect_timeout=NODE_CONNECT_TIMEOUT):
+        self.address = address
+        self.on_failure = on_failure
+        self.connect_timeout = connect_timeout
+        self.up = False
+        self.error = None
+        self.forwarded = Counter()  # validator_type -> tasks the node spooled
+        self.load = {}  # queued and spooled, as the node last reported
+        self._closing = False
+        self._sock = None
+        self._lock = threading.Lock()  # guards _pending and _sock
+        self._write_lock = threading.Lock()  # keeps _pending in the order tasks are written
+        self._pending = deque()  # (task, future), with task None for a status request
+        self._slots = threading.Semaphore(max_inflight)
+
+    @property
+    def unanswered(self):
+        with self._lock:
+            return sum(1 for task, _ in self._pending if task is not None)
+
+    def connect(self):
+        address = parse_address(self.address)
+        if isinstance(address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.connect_timeout)
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(address, timeout=self.connect_timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        with self._lock:
+            self._sock = sock
+            self.up = True
+            self.error = None
+        threading.Thread(target=self._read_loop, args=(sock,), name=f'node-{self.address}', daemon=True).start()
+
+    def send(self, task, future):
+        # Blocks while the node has max_inflight tasks unanswered
+        while not self._slots.acquire(timeout=1):
+            if not self.up:
+                raise ConnectionError(f"Node {self.address} is down")
+        line = json.dumps(task, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._write_lock:
+            with self._lock:
+                sock = self._sock
+                if sock is None:
+                    self._slots.release()
+                    raise ConnectionError(f"Node {self.address} is down")
+                self._pending.append((task, future))
+            try:
+                sock.sendall(line)
+            except OSError as e:
+                # If the reader already failed the link, this task went to
+                # on_failure with the rest and must not be sent twice
+                with self._lock:
+                    owned = bool(self._pending) and self._pending[-1][1] is future
+                    if owned:
+                        self._pending.pop()
+                        self._slots.release()
+                self._failed(sock, e)
+                if owned:
+                    # The caller sends it again
+                    raise ConnectionError(f"Sending to node {self.address} failed: {e}") from e
+
+    def request_status(self):
+        # A future for the node's load, answered after the tasks sent before it
+        future = Future()
+        with self._write_lock:
+            with self._lock:
+                sock = self._sock
+                if sock is None:
+                    raise ConnectionError(f"Node {self.address} is down")
+                self._pending.append((None, future))
+            try:
+                sock.sendall(STATUS_REQUEST)
+            except OSError as e:
+                self._failed(sock, e)
+        return future
+
+    def close(self, drain_timeout=NODE_DRAIN_TIMEOUT):
+        # Waits for answers to what was sent, then hands on whatever is left
+        self._closing = True
+        deadline = time.monotonic() + drain_timeout
+        while self._pending and self.up and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self._lock:
+            sock = self._sock
+        if sock:
+            self._failed(sock, ConnectionError(f"Node {self.address} left"))
+
+    def _read_loop(self, sock):
+        # Only the connection failing ends up in _failed; a future that
+        # someone else resolved first is left alone
+        try:
+            with sock.makefile('rb') as reader:
+                for line in reader:
+                    reply = json.loads(line)
+                    with self._lock:
+                        task, future = self._pending.popleft()
+                    if task is None:
+                        if 'status' in reply:
+                            _resolve(future, result=reply['status'])
+                        else:
+                            _resolve(future, error=ValueError(f"Node {self.address} gave no status: {reply}"))
+                        continue
+                    if 'seq' not in reply and str(reply.get('error', '')).startswith('not spooled'):
+                        # The node could not write it down; it goes to the
+                        # type's next owner with everything else sent here
+                        with self._lock:
+                            self._pending.appendleft((task, future))
+                        raise ConnectionError(f"Node {self.address} cannot spool: {reply['error']}")
+                    self._slots.release()
+                    if 'seq' in reply:
+                        self.forwarded[task['validator_type']] += 1
+                        FORWARDED.labels(self.address, task['validator_type']).inc()
+                        _resolve(future, result=self.address)
+                    else:
+                        error = ValueError(f"Node {self.address} refused the task: {reply.get('error')}")
+                        _resolve(future, error=error)
+            raise ConnectionError(f"Node {self.address} closed the connection")
+        except Exception as e:
+            self._failed(sock, e)
+
+    def _failed(self, sock, error):
+        with self._lock:
+            if self._sock is not sock:
+                return
+            self._sock = None
+            self.up = False
+            self.error = str(error)
+            pending, self._pending = list(self._pending), deque()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        for task, future in pending:
+            if task is None:
+                _resolve(future, error=ConnectionError(f"Node {self.address} is down: {error}"))
+        pending = [(task, future) for task, future in pending if task is not None]
+        for _ in pending:
+            self._slots.release()
+        if self._closing:
+            logger.info(f"Closed connection to node {self.address}, {len(pending)} tasks unanswered")
+        else:
+            logger.warning(f"Connection to node {self.address} failed with {len(pending)} tasks unanswered: {error}")
+        self.on_failure(self, pending)
+
+
+class Router:
+    """Routes tasks to nodes by validator type on a consistent hash ring.
+
+    submit() stands in for Dispatcher.submit, so the coordinator ingests
+    through the same sources, spool and feeder as a node. A task's future
+    resolves with the node that spooled it, and submit() blocks while no
+    node is up. Nodes that are down are off the ring and tried again every
+    retry_interval.
+    """
+
+    def __init__(self, vnodes=NODE_VNODES, retry_interval=NODE_RETRY_INTERVAL, status_interval=NODE_STATUS_INTERVAL):
+        self.ring = HashRing(vnodes)
+        self.retry_interval = retry_interval
+        self.status_interval = status_interval
+        self._cond = threading.Condition()  # guards ring, _links and _types
+        self._links = {}  # address -> NodeLink, whether up or not
+        self._types = set()  # validator types seen, to report who owns them
+
+    def start(self):
+        NODE_INFLIGHT.set_function(lambda: {(link.address,): link.unanswered for link in self.links()})
+        NODE_UP.set_function(lambda: {(link.address,): int(link.up) for link in self.links()})
+        NODE_QUEUED.set_function(lambda: {(link.address,): link.load['queued']
+                                          for link in self.links() if 'queued' in link.load})
+        NODE_SPOOLED.set_function(lambda: {(link.address,): link.load['spooled']
+                                           for link in self.links() if 'spooled' in link.load})
+        threading.Thread(target=self._reconnect_loop, name='coordinator-reconnect', daemon=True).start()
+        threading.Thread(target=self._status_loop, name='coordinator-node-status', daemon=True).start()
+
+    def links(self):
+        with self._cond:
+            return list(self._links.values())
+
+    def join(self, address):
+        parse_address(address)
+        with self._cond:
+            if address in self._links:
+                return False
+            link = self._links[address] = NodeLink(address, self._failed)
+        self._connect(link)
+        return True
+
+    def leave(self, address):
+        with self._cond:
+            link = self._links.pop(address, None)
+            if link is None:
+                return False
+            self._update_ring(remove=address)
+        logger.info(f"Node {address} left")
+        link.close()
+        return True
+
+    def submit(self, task):
+        future = Future()
+        self._forward(task, future)
+        return future
+
+    def queue_depth(self):
+        # Tasks sent on and not yet spooled by a node, the coordinator's own
+        # queued count when it takes tasks on a socket
+        return sum(link.unanswered for link in self.links())
+
+    def status(self):
+        with self._cond:
+            owners = {validator_type: self.ring.owner(validator_type) for validator_type in sorted(self._types)}
+            shares = self.ring.shares()
+            links = list(self._links.values())
+        return {
+            link.address: {
+                'up': link.up,
+                'queued': link.load.get('queued'),
+                'spooled': link.load.get('spooled'),
+                'unanswered': link.unanswered,
+                'forwarded': dict(link.forwarded),
+                'share': round(shares.get(link.address, 0.0), 4),
+                'types': [validator_type for validator_type, owner in owners.items() if owner == link.address],
+                'error': link.error,
+            }
+            for link in links
+        }
+
+    def _forward(self, task, future):
+        validator_type = task['validator_type']
+        while not future.done():
+            with self._cond:
+                self._types.add(validator_type)
+                while not len(self.ring):
+                    self._cond.wait()
+                link = self._links[self.ring.owner(validator_type)]
+            try:
+                link.send(task, future)
+                return
+            except ConnectionError:
+                # Its failure takes it off the ring; try the next owner
+                if link.up:
+                    time.sleep(0.01)
+
+    def _connect(self, link):
+        try:
+            link.connect()
+        except OSError as e:
+            logger.debug("Cannot reach node %s: %s", link.address, e)
+            return
+        with self._cond:
+            if self._links.get(link.address) is not link:
+                # It left while connecting
+                link.close(0)
+                return
+            self._update_ring(add=link.address)
+        logger.info(f"Node {link.address} joined")
+
+    def _failed(self, link, pending):
+        with self._cond:
+            if link.address in self.ring:
+                self._update_ring(remove=link.address)
+        if pending:
+            RESENT.labels(link.address).inc(len(pending))
+            # Off the reader thread, as sending may wait for a node to come up
+            threading.Thread(target=self._resend, args=(pending,), name='coordinator-resend', daemon=True).start()
+
+    def _resend(self, pending):
+        for task, future in pending:
+            self._forward(task, future)
+
+    def _update_ring(self, add=None, remove=None):
+        # With _cond held
+        before = {validator_type: self.ring.owner(validator_type) for validator_type in self._types}
+        if add:
+            self.ring.add(add)
+        if remove:
+            self.ring.remove(remove)
+        for validator_type, owner in sorted(before.items()):
+            moved_to = self.ring.owner(validator_type)
+            if moved_to == owner:
+                continue
+            if moved_to is None:
+                logger.warning(f"No node left for {validator_type}")
+            elif owner is None:
+                logger.info(f"{validator_type} goes to node {moved_to}")
+            else:
+                logger.info(f"{validator_type} moved from node {owner} to {moved_to}")
+        self._cond.notify_all()
+
+    def poll_status(self, timeout=NODE_STATUS_TIMEOUT):
+        # Asks every node that is up for its load, all at once
+        requests = []
+        for link in self.links():
+            if link.up:
+                try:
+                    requests.append((link, link.request_status()))
+                except ConnectionError:
+                    pass
+        deadline = time.monotonic() + timeout
+        for link, future in requests:
+            try:
+                load = future.result(max(0, deadline - time.monotonic()))
+            except Exception as e:
+                logger.debug("No status from node %s: %s", link.address, e)
+                continue
+            link.load = {key: load[key] for key in ('queued', 'spooled') if key in load}
+
+    def _status_loop(self):
+        while True:
+            time.sleep(self.status_interval)
+            self.poll_status()
+
+    def _reconnect_loop(self):
+        while True:
+            time.sleep(self.retry_interval)
+            for link in self.links():
+                if not link.up:
+                    self._connect(link)
+
+
+class ControlServer:
+    # Takes join, leave and status commands on a socket, one JSON object per line
+    def __init__(self, router, address):
+        self.router = router
+        self.address = address
+
+    def start(self):
+        address = parse_address(self.address)
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(address)
+        server.listen()
+        threading.Thread(target=self._accept_loop, args=(server,), name='coordinator-control', daemon=True).start()
+        logger.info(f"Taking coordinator commands on {self.address}")
+
+    def _accept_loop(self, server):
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self._serve, args=(conn,), name='coordinator-control-conn', daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            with conn, conn.makefile('rb') as reader:
+                for line in reader:
+                    if line.strip():
+                        conn.sendall(json.dumps(self.handle(line)).encode('utf-8') + b'\n')
+        except OSError:
+            pass
+
+    def handle(self, line):
+        try:
+            command = json.loads(line)
+            if not isinstance(command, dict):
+                raise ValueError("expected an object")
+            if 'join' in command:
+                return {'ok': self.router.join(command['join'])}
+            if 'leave' in command:
+                return {'ok': self.router.leave(command['leave'])}
+            if 'status' in command:
+                return {'nodes': self.router.status()}
+            raise ValueError("expected join, leave or status")
+        except (ValueError, TypeError) as e:
+            return {'error': str(e)}
+
+
+class LocalCluster:
+    """proof-node instances run as local processes, standing in for a cluster.
+
+    Each node runs its validators as local server processes from
+    proof-tasks and takes tasks on a Unix socket, with its own spool and
+    sealed directories under work_dir.
+    """
+
+    def __init__(self, work_dir, env=None):
+        self.work_dir = Path(work_dir)
+        self.env = env or {}
+        self.nodes = {}  # address -> (process, log)
+        self._index = itertools.count()
+
+    def start_node(self):
+        node_dir = self.work_dir / f'node-{next(self._index)}'
+        node_dir.mkdir(parents=True)
+        address = f"unix:{node_dir / 'tasks.sock'}"
+        env = dict(os.environ)
+        # Validators stay off the network
+        env.setdefault('RANDOMNESS_BACKEND', 'local')
+        env.update({
+            'TASK_SOURCES': address,
+            'VALIDATOR_BACKEND': 'subprocess',
+            'LOCAL_WORKERS': '1',
+            'SPOOL_DIR': str(node_dir / 'spool'),
+            'SEALED_ROOT': str(node_dir / 'sealed'),
+            'METRICS_PORT': '0',
+            **self.env,
+        })
+        log = open(node_dir / 'node.log', 'wb')
+        process = subprocess.Popen([sys.executable, '-m', 'proof_node'], cwd=Path(__file__).resolve().parents[1],
+                                   env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.nodes[address] = (process, log)
+        logger.info(f"Started local node {address}")
+        return address
+
+    def stop_node(self, address):
+        process, log = self.nodes.pop(address)
+        if process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        log.close()
+
+    def stop(self):
+        for address in list(self.nodes):
+            self.stop_node(address)
+
+
+def log_result(task, future):
+    error = future.exception()
+    if error:
+        logger.error(f"Task for {task['validator_type']} was not forwarded: {error}")
+    else:
+        logger.debug("Task for %s forwarded to %s", task['validator_type'], future.result())
+
+
+def log_status(router, interval):
+    while True:
+        time.sleep(interval)
+        for address, status in router.status().items():
+            logger.info(f"Node {address}: {'up' if status['up'] else 'down'}, {status['queued']} queued, "
+                        f"{status['spooled']} spooled, {sum(status['forwarded'].values())} forwarded, "
+                        f"owns {status['types'] or 'nothing'}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m proof_node.coordinator',
+                                     description='Route tasks to proof-node instances by validator type')
+    parser.add_argument('--nodes', default=COORDINATOR_NODES, help='comma separated unix:PATH or tcp:HOST:PORT')
+    parser.add_argument('--control', default=COORDINATOR_CONTROL, help='unix:PATH or tcp:HOST:PORT for commands')
+    parser.add_argument('--sources', default=TASK_SOURCES, help='where tasks come from; without them tasks are generated')
+    parser.add_argument('--spool-dir', default=COORDINATOR_SPOOL_DIR)
+    parser.add_argument('--rate', type=float, help='generated tasks per second (default: one every 1-5 seconds)')
+    parser.add_argument('--local-nodes', type=int, default=0, help='also start this many nodes as local processes')
+    parser.add_argument('--status-interval', type=float, default=COORDINATOR_STATUS_INTERVAL)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logs.setup()
+    logs.install_signal_handlers()
+    # Unwinds main so local nodes are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    router = Router()
+    router.start()
+    if metrics.METRICS_PORT:
+        metrics.start_http_server()
+    if args.control:
+        ControlServer(router, args.control).start()
+
+    cluster = None
+    if args.local_nodes:
+        cluster = LocalCluster(tempfile.mkdtemp(prefix='proof-cluster-'))
+    try:
+        nodes = [node.strip() for node in args.nodes.split(',') if node.strip()]
+        nodes += [cluster.start_node() for _ in range(args.local_nodes)]
+        for node in nodes:
+            router.join(node)
+        threading.Thread(target=log_status, args=(router, args.status_interval), name='coordinator-status',
+                         daemon=True).start()
+
+        if args.sources:
+            ingest(router, args.sources, spool=Spool(args.spool_dir), on_done=log_result)
+            return
+        while True:
+            task = generate_task()
+            future = router.submit(task)
+            future.add_done_callback(lambda f, task=task: log_result(task, f))
+            time.sleep(random.expovariate(args.rate) if args.rate else random.uniform(1, 5))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cluster:
+            cluster.stop()
+            shutil.rmtree(cluster.work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
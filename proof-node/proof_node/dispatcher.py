@@ -0,0 +1,175 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 8))
+DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', 100))
+DEFAULT_VALIDATOR_CONCURRENCY = int(os.environ.get('DEFAULT_VALIDATOR_CONCURRENCY', 2))
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 1))
+BATCH_WINDOW = float(os.environ.get('BATCH_WINDOW_MS', 50)) / 1000
+
+QUEUE_WAIT = metrics.Histogram('proof_queue_wait_seconds', 'Time tasks spent queued before a worker took them',
+                               ['validator_type'])
+TASKS = metrics.Counter('proof_tasks_total', 'Tasks completed, by outcome', ['validator_type', 'outcome'])
+
+
+def parse_limits(spec):
+    # "doordash=4,analytics=8" -> {'doordash': 4, 'analytics': 8}
+    limits = {}
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        validator_type, _, limit = item.partition('=')
+        limits[validator_type.strip()] = int(limit)
+    return limits
+
+
+class Dispatcher:
+    """Runs tasks on a pool of worker threads.
+
+    Every task counts against a bounded capacity from the moment it is
+    submitted until it completes, so producers block (or get queue.Full)
+    instead of growing memory without limit. Each validator type also has
+    its own in-flight limit; a saturated type never holds a worker hostage
+    because workers only pick up tasks whose type has a free slot.
+
+    With a batch_handler, queued tasks of the same type are grouped into
+    batches of up to batch_size, waiting at most batch_window seconds for
+    a batch to fill. A batch occupies one in-flight slot of its type.
+    """
+
+    def __init__(self, handler, workers=DISPATCH_WORKERS, max_queue=DISPATCH_QUEUE_SIZE,
+                 limits=None, default_limit=DEFAULT_VALIDATOR_CONCURRENCY,
+                 batch_handler=None, batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW):
+        self._handler = handler
+        self._batch_handler = batch_handler
+        self._batch_size = batch_size if batch_handler else 1
+        self._batch_window = batch_window
+        # Either a dict of per-type limits or a callable returning the limit for a type
+        self._limits = parse_limits(os.environ.get('VALIDATOR_CONCURRENCY')) if limits is None else limits
+        self._default_limit = default_limit
+        self._capacity = threading.BoundedSemaphore(max_queue)
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # validator type -> deque of (task, future, enqueued at)
+        self._inflight = Counter()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'dispatcher-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def limit(self, validator_type):
+        if callable(self._limits):
+            return self._limits(validator_type)
+        return self._limits.get(validator_type, self._default_limit)
+
+    def submit(self, task, block=True, timeout=None):
+        if self._closed:
+            raise RuntimeError("Dispatcher is shut down")
+        if not self._capacity.acquire(block, timeout):
+            raise queue.Full(f"Dispatch queue is full, rejected {task['validator_type']} task")
+
+        future = Future()
+        with self._cond:
+            self._pending.setdefault(task['validator_type'], deque()).append((task, future, time.monotonic()))
+            self._cond.notify()
+        return future
+
+    def queue_depth(self, validator_type=None):
+        with self._cond:
+            if validator_type is not None:
+                return len(self._pending.get(validator_type, ()))
+            return sum(len(tasks) for tasks in self._pending.values())
+
+    def queue_depths(self):
+        with self._cond:
+            return {validator_type: len(tasks) for validator_type, tasks in self._pending.items()}
+
+    def inflight(self, validator_type=None):
+        with self._cond:
+            if validator_type is not None:
+                return self._inflight[validator_type]
+            return sum(self._inflight.values())
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _take(self):
+        # Called with the condition held. Types are visited round-robin so a
+        # busy type cannot starve the others. Returns the next batch to run,
+        # or None and how long to wait for a partial batch to become due.
+        now = time.monotonic()
+        wait = None
+        for validator_type in list(self._pending):
+            tasks = self._pending[validator_type]
+            if not tasks or self._inflight[validator_type] >= self.limit(validator_type):
+                continue
+            due = tasks[0][2] + self._batch_window
+            if len(tasks) < self._batch_size and now < due and not self._closed:
+                wait = due - now if wait is None else min(wait, due - now)
+                continue
+            self._pending.move_to_end(validator_type)
+            self._inflight[validator_type] += 1
+            batch = [tasks.popleft() for _ in range(min(self._batch_size, len(tasks)))]
+            return validator_type, batch, None
+        return None, None, wait
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                validator_type, batch, wait = self._take()
+                while batch is None:
+                    if self._closed and not any(self._pending.values()):
+                        return
+                    self._cond.wait(wait)
+                    validator_type, batch, wait = self._take()
+
+            taken = len(batch)
+            now = time.monotonic()
+            queue_wait = QUEUE_WAIT.labels(validator_type)
+            for _, _, enqueued_at in batch:
+                queue_wait.observe(now - enqueued_at)
+            try:
+                batch = [(task, future) for task, future, _ in batch if future.set_running_or_notify_cancel()]
+                if batch:
+                    self._run(validator_type, batch)
+            finally:
+                with self._cond:
+                    self._inflight[validator_type] -= 1
+                    self._cond.notify_all()
+                for _ in range(taken):
+                    self._capacity.release()
+
+    def _run(self, validator_type, batch):
+        try:
+            if self._batch_handler and len(batch) > 1:
+                results = self._batch_handler([task for task, _ in batch])
+            else:
+                results = [self._handler(batch[0][0])]
+        except Exception as e:
+            logger.error(f"Task for {validator_type} failed: {e}")
+            TASKS.labels(validator_type, 'failed').inc(len(batch))
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        # A batch handler returns the exception for a task that failed on its own
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                TASKS.labels(validator_type, 'failed').inc()
+                future.set_exception(result)
+                continue
+            TASKS.labels(validator_type, 'valid' if result else 'invalid').inc()
+            future.set_result(result)
@@ -0,0 +1,263 @@
+# Persistent framed connections to validators, as an alternative to an HTTP
+# request per task. The protocol is the one in proof-tasks/common/framing.py:
+# a hello that an HTTP-only validator rejects with a 400, then
+# length-prefixed msgpack or JSON messages, each request tagged with an id
+# so many share one connection.
+import itertools
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open to each validator; requests are multiplexed over them
+FRAME_CONNECTIONS = int(os.environ.get('FRAME_CONNECTIONS', 2))
+# msgpack or json; msgpack needs the msgpack package on both ends
+FRAME_ENCODING = os.environ.get('FRAME_ENCODING', 'msgpack' if msgpack else 'json')
+FRAME_CONNECT_TIMEOUT = float(os.environ.get('FRAME_CONNECT_TIMEOUT', 2))
+# How long a validator that only speaks HTTP is left to HTTP before it is
+# offered frames again
+FRAME_RETRY_INTERVAL = float(os.environ.get('FRAME_RETRY_INTERVAL', 60))
+FRAME_MAX_BYTES = int(os.environ.get('FRAME_MAX_BYTES', 64 * 1024 * 1024))
+
+# No HTTP request starts with a NUL byte
+MAGIC = b'\x00PVF'
+VERSION = 1
+MSGPACK = b'm'
+JSON = b'j'
+ENCODINGS = {'msgpack': MSGPACK, 'json': JSON}
+HELLO_SIZE = len(MAGIC) + 4
+HEADER = struct.Struct('>I')
+
+
+class FramesUnsupported(Exception):
+    # The validator answered the hello with something else, most likely HTTP
+    pass
+
+
+class EncodeError(ValueError):
+    # A message the connection's encoding cannot carry, such as an integer
+    # too large for msgpack
+    pass
+
+
+def hello(encoding):
+    return MAGIC + bytes([VERSION]) + encoding + b'\r\n'
+
+
+def encode(message, encoding):
+    try:
+        if encoding == MSGPACK:
+            body = msgpack.packb(message, use_bin_type=True)
+        else:
+            body = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    except (TypeError, ValueError, OverflowError) as e:
+        raise EncodeError(str(e)) from e
+    return HEADER.pack(len(body)) + body
+
+
+def decode(body, encoding):
+    if encoding == MSGPACK:
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+def split_frames(buffer):
+    # Removes the complete frames from the start of buffer, a bytearray, and
+    # returns their bodies
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= HEADER.size:
+        (size,) = HEADER.unpack_from(buffer, offset)
+        if size > FRAME_MAX_BYTES:
+            raise ValueError(f"Frame of {size} bytes is over the limit of {FRAME_MAX_BYTES}")
+        end = offset + HEADER.size + size
+        if len(buffer) < end:
+            break
+        frames.append(bytes(buffer[offset + HEADER.size:end]))
+        offset = end
+    del buffer[:offset]
+    return frames
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class FrameConnection:
+    """One persistent connection to a validator, shared by many requests.
+
+    Requests are written as they are made and a reader thread matches
+    responses to them by id, in whatever order the validator finishes
+    them. If the connection breaks, every request still waiting on it
+    fails with ConnectionError.
+    """
+
+    def __init__(self, address, encoding=ENCODINGS[FRAME_ENCODING], connect_timeout=FRAME_CONNECT_TIMEOUT):
+        self.address = address
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(connect_timeout)
+            self.sock.connect(address)
+            if family == socket.AF_INET:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.sendall(hello(encoding))
+            reply = _recv_exactly(self.sock, HELLO_SIZE)
+        except OSError as e:
+            self.sock.close()
+            raise ConnectionError(f"Cannot open framed connection to {address}: {e}") from e
+        if not reply.startswith(MAGIC) or len(reply) < HELLO_SIZE or reply[len(MAGIC)] != VERSION:
+            self.sock.close()
+            raise FramesUnsupported(f"{address} does not speak frames")
+        self.encoding = reply[len(MAGIC) + 1:len(MAGIC) + 2]
+        self.sock.settimeout(None)
+        self.closed = False
+        self._ids = itertools.count()
+        self._lock = threading.Lock()  # guards _pending and writes
+        self._pending = {}  # id -> Future
+        threading.Thread(target=self._read_loop, name=f'frames-{address}', daemon=True).start()
+
+    @property
+    def inflight(self):
+        return len(self._pending)
+
+    def submit(self, message):
+        # A future for the validator's response to message, which gets an id
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise ConnectionError(f"Framed connection to {self.address} is closed")
+            request_id = next(self._ids)
+            data = encode({'id': request_id, **message}, self.encoding)
+            self._pending[request_id] = future
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                del self._pending[request_id]
+                self._fail(e)
+                raise ConnectionError(f"Framed connection to {self.address} failed: {e}") from e
+        future.request_id = request_id
+        return future
+
+    def request(self, message, timeout=None):
+        future = self.submit(message)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # A response that turns up later is dropped
+            with self._lock:
+                self._pending.pop(future.request_id, None)
+            raise
+
+    def close(self):
+        with self._lock:
+            self._fail(ConnectionError(f"Framed connection to {self.address} was closed"))
+
+    def _read_loop(self):
+        buffer = bytearray()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionError(f"{self.address} closed the framed connection")
+                buffer += data
+                for body in split_frames(buffer):
+                    response = decode(body, self.encoding)
+                    with self._lock:
+                        future = self._pending.pop(response.get('id'), None)
+                    if future:
+                        future.set_result(response)
+        except Exception as e:
+            with self._lock:
+                if not self.closed:
+                    logger.warning(f"Framed connection to {self.address} failed: {e}")
+                self._fail(e)
+
+    def _fail(self, error):
+        # With the lock held
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(error if isinstance(error, ConnectionError) else ConnectionError(str(error)))
+
+
+class FrameConnectionPool:
+    """Framed connections to validators, shared by every thread of the node.
+
+    Each validator address gets up to FRAME_CONNECTIONS, opened as they are
+    first needed, and a request goes on the one with the fewest requests in
+    flight. get() returns None for a validator that answered the hello in
+    HTTP, so the caller falls back to HTTP for it.
+    """
+
+    def __init__(self, connections=FRAME_CONNECTIONS, encoding=FRAME_ENCODING,
+                 connect_timeout=FRAME_CONNECT_TIMEOUT, retry_interval=FRAME_RETRY_INTERVAL):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown frame encoding {encoding!r}, expected one of {sorted(ENCODINGS)}")
+        if encoding == 'msgpack' and msgpack is None:
+            raise ValueError("The msgpack frame encoding needs the msgpack package")
+        self.connections = connections
+        self.encoding = ENCODINGS[encoding]
+        self.connect_timeout = connect_timeout
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._connections = defaultdict(list)  # address -> open connections
+        self._opening = defaultdict(threading.Lock)  # address -> held while connecting
+        self._http_only = {}  # address -> when to offer frames again
+
+    def get(self, address):
+        with self._lock:
+            if self._http_only.get(address, 0) > time.monotonic():
+                return None
+            connections = self._connections[address] = [c for c in self._connections[address] if not c.closed]
+            if len(connections) >= self.connections:
+                return min(connections, key=lambda c: c.inflight)
+            opening = self._opening[address]
+
+        # Connecting to one validator does not hold up requests to others
+        with opening:
+            with self._lock:
+                connections = [c for c in self._connections[address] if not c.closed]
+                if len(connections) >= self.connections:
+                    return min(connections, key=lambda c: c.inflight)
+            try:
+                connection = FrameConnection(address, self.encoding, self.connect_timeout)
+            except FramesUnsupported:
+                logger.info(f"Validator at {address} does not speak frames, using HTTP")
+                with self._lock:
+                    self._http_only[address] = time.monotonic() + self.retry_interval
+                return None
+        with self._lock:
+            self._connections[address].append(connection)
+        return connection
+
+    def close(self):
+        with self._lock:
+            connections = [c for address in self._connections.values() for c in address]
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
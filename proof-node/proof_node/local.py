@@ -0,0 +1,408 @@
+import importlib
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import requests
+import urllib3
+
+from .backends import ERRORS, REQUEST_TIME, Backend, DeadlineExceeded, HttpBackend, ValidationError
+from .pool import REPLICA_CONCURRENCY
+from .registry import READINESS_DEADLINE, Endpoint, wait_until_healthy
+
+logger = logging.getLogger(__name__)
+
+# Validators run straight from a proof-tasks checkout, outside of any enclave
+PROOF_TASKS_DIR = os.environ.get('PROOF_TASKS_DIR', str(Path(__file__).resolve().parents[2] / 'proof-tasks'))
+# Processes per validator type
+LOCAL_WORKERS = int(os.environ.get('LOCAL_WORKERS', os.cpu_count() or 1))
+LOCAL_TRANSPORT = os.environ.get('LOCAL_TRANSPORT', 'unix')
+# Each local validator seals into its own directory here, as each container
+# does under /mnt/sealed
+SEALED_ROOT = os.environ.get('SEALED_ROOT', '/mnt/sealed')
+
+
+def validator_types(tasks_dir=PROOF_TASKS_DIR):
+    return sorted(entry.name for entry in Path(tasks_dir).iterdir() if (entry / 'validate.py').exists())
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class UnixConnection(urllib3.connection.HTTPConnection):
+    def __init__(self, *args, socket_path=None, **kwargs):
+        self.socket_path = socket_path
+        super().__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = UnixConnection
+
+
+class UnixAdapter(requests.adapters.HTTPAdapter):
+    # Sends every request it is mounted for to one Unix socket
+    def __init__(self, socket_path):
+        super().__init__()
+        self._pool = UnixConnectionPool('localhost', socket_path=socket_path)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self._pool
+
+    def get_connection(self, url, proxies=None):
+        return self._pool
+
+    def close(self):
+        self._pool.close()
+        super().close()
+
+
+class LocalValidator:
+    # A validator server process, run from its directory in proof-tasks
+    def __init__(self, validator_type, tasks_dir, run_dir, sealed_root, index=0, workers=None, transport='unix',
+                 env=None):
+        self.validator_type = validator_type
+        self.name = f'{validator_type}-local-{index}'
+        self.tasks_dir = Path(tasks_dir)
+        self.sealed_dir = Path(sealed_root) / self.name
+        self.log_path = Path(run_dir) / f'{self.name}.log'
+        self.workers = workers
+        self.env = env or {}
+        if transport == 'unix':
+            self.socket_path = str(Path(run_dir) / f'{self.name}.sock')
+            self.endpoint = Endpoint(validator_type, self.name, self.name, None)
+        else:
+            self.socket_path = None
+            self.endpoint = Endpoint(validator_type, self.name, '127.0.0.1', free_port())
+        self.deterministic = False
+        self.version = None
+        self.process = None
+        self._log = None
+
+    def start(self):
+        env = dict(os.environ, **self.env)
+        env.update({
+            'PYTHONPATH': os.pathsep.join(filter(None, [str(self.tasks_dir / 'common'), env.get('PYTHONPATH')])),
+            'SEALED_DIR': str(self.sealed_dir),
+        })
+        if self.socket_path:
+            env['VALIDATOR_SOCKET'] = self.socket_path
+        else:
+            env.update({'VALIDATOR_HOST': self.endpoint.ip, 'VALIDATOR_PORT': str(self.endpoint.port)})
+        if self.workers:
+            env['VALIDATOR_WORKERS'] = str(self.workers)
+        self._log = open(self.log_path, 'wb')
+        self.process = subprocess.Popen([sys.executable, 'validate.py'], cwd=self.tasks_dir / self.validator_type,
+                                        env=env, stdout=self._log, stderr=subprocess.STDOUT)
+
+    def url(self, path='/'):
+        if self.socket_path:
+            return f'http://{self.name}{path}'
+        return f'http://{self.endpoint.ip}:{self.endpoint.port}{path}'
+
+    def wait_until_ready(self, session, deadline=READINESS_DEADLINE):
+        # Probed through the session so Unix sockets go through their adapter
+        def probe():
+            try:
+                response = session.get(self.url('/healthz'), timeout=1)
+                health = response.json() if response.status_code == 200 else None
+            except (requests.exceptions.RequestException, ValueError):
+                return None
+            return health if health and health.get('ready') else None
+
+        health = wait_until_healthy(None, deadline=deadline, cancelled=self._exited, probe=probe)
+        if not health:
+            with open(self.log_path, 'rb') as f:
+                tail = f.read()[-2000:].decode('utf-8', 'replace')
+            raise RuntimeError(f"Validator {self.name} did not become ready:\n{tail}")
+        self.deterministic = bool(health.get('deterministic'))
+        self.version = health.get('version')
+        logger.info(f"Local validator {self.name} is ready")
+
+    def _exited(self):
+        return self.process.poll() is not None
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self._log:
+            self._log.close()
+
+
+class LocalReplica:
+    def __init__(self, validator):
+        self.validator_type = validator.validator_type
+        self.name = validator.name
+        self.endpoint = validator.endpoint
+        self.inflight = 0
+
+
+class LocalPool:
+    """A fixed set of local validator processes.
+
+    Requests go to the least-loaded replica of their type, round-robin
+    among equals, as they do in ValidatorPool.
+    """
+
+    def __init__(self, validators, replica_concurrency=REPLICA_CONCURRENCY):
+        self.replica_concurrency = replica_concurrency
+        self.queue_depth = lambda validator_type: 0
+        self._lock = threading.Lock()
+        self._validators = validators
+        self._replicas = defaultdict(list)
+        for validator in validators:
+            self._replicas[validator.validator_type].append(LocalReplica(validator))
+        self._rr = itertools.count()
+
+    def acquire(self, validator_type, timeout=None, exclude=()):
+        with self._lock:
+            replicas = [r for r in self._replicas.get(validator_type, ()) if r not in exclude]
+            if not replicas:
+                return None
+            offset = next(self._rr) % len(replicas)
+            replica = min(replicas[offset:] + replicas[:offset], key=lambda r: r.inflight)
+            replica.inflight += 1
+            return replica
+
+    def release(self, replica, latency=None):
+        with self._lock:
+            replica.inflight -= 1
+
+    def capacity(self, validator_type):
+        return max(1, len(self._replicas.get(validator_type, ()))) * self.replica_concurrency
+
+    def replicas(self, validator_type):
+        return len(self._replicas.get(validator_type, ()))
+
+    def deterministic(self, validator_type):
+        validators = [v for v in self._validators if v.validator_type == validator_type]
+        return bool(validators) and all(v.deterministic for v in validators)
+
+    def version(self, validator_type):
+        # Validators of a type all start from the same environment
+        versions = {v.version for v in self._validators if v.validator_type == validator_type}
+        return versions.pop() if len(versions) == 1 else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                validator_type: {'replicas': len(replicas), 'inflight': sum(r.inflight for r in replicas)}
+                for validator_type, replicas in self._replicas.items()
+            }
+
+    def shutdown(self):
+        pass
+
+
+class SubprocessBackend(HttpBackend):
+    """Runs validator servers as local processes, LOCAL_WORKERS per type.
+
+    They speak the same HTTP as in containers, over Unix sockets unless
+    LOCAL_TRANSPORT is tcp, so there is no container start or NAT in the way.
+    """
+
+    def __init__(self, tasks_dir=PROOF_TASKS_DIR, replicas=LOCAL_WORKERS, transport=LOCAL_TRANSPORT,
+                 sealed_root=SEALED_ROOT, validator_workers=None, replica_concurrency=REPLICA_CONCURRENCY,
+                 ready_timeout=READINESS_DEADLINE, validator_env=None):
+        # validator_env maps a validator type to extra environment for its processes
+        validator_env = validator_env or {}
+        self.ready_timeout = ready_timeout
+        self.run_dir = tempfile.mkdtemp(prefix='proof-validators-')
+        self.validators = [
+            LocalValidator(validator_type, tasks_dir, self.run_dir, sealed_root, index, validator_workers, transport,
+                           validator_env.get(validator_type))
+            for validator_type in validator_types(tasks_dir)
+            for index in range(replicas)
+        ]
+        # Unix socket endpoints carry the validator's name in place of an IP
+        self._sockets = {validator.name: validator.socket_path for validator in self.validators}
+        super().__init__(LocalPool(self.validators, replica_concurrency))
+
+    def start(self):
+        for validator in self.validators:
+            validator.start()
+        for validator in self.validators:
+            validator.wait_until_ready(self._session(), self.ready_timeout)
+
+    def configure_session(self, session):
+        for validator in self.validators:
+            if validator.socket_path:
+                session.mount(f'http://{validator.name}/', UnixAdapter(validator.socket_path))
+
+    def url(self, endpoint, path='/'):
+        if endpoint.port is None:
+            return f"http://{endpoint.ip}{path}"
+        return super().url(endpoint, path)
+
+    def address(self, endpoint):
+        if endpoint.port is None:
+            return self._sockets[endpoint.ip]
+        return super().address(endpoint)
+
+    def shutdown(self):
+        super().shutdown()
+        for validator in self.validators:
+            validator.stop()
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+
+# Set in each worker process of ProcessBackend
+_process_record = None
+_deterministic = False
+_version = None
+
+
+def _init_worker(tasks_dir, validator_type, sealed_root, counter):
+    global _process_record, _deterministic, _version
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    os.environ['SEALED_DIR'] = os.path.join(sealed_root, f'{validator_type}-local-{index}')
+    sys.path[:0] = [os.path.join(tasks_dir, validator_type), os.path.join(tasks_dir, 'common')]
+    module = importlib.import_module('validate')
+    if hasattr(module, 'setup'):
+        module.setup()
+    _process_record = module.process_record
+    # Declared on the validator's request handler, as its server reports in /healthz
+    _deterministic = getattr(getattr(module, 'ValidatorHandler', None), 'deterministic', False)
+    _version = getattr(getattr(module, 'ValidatorHandler', None), 'version', None)
+
+
+def _run_record(record):
+    return _process_record(record)
+
+
+def _worker_info():
+    return os.getpid(), _deterministic, _version
+
+
+class ProcessBackend(Backend):
+    """Calls each validator's process_record in a warm pool of worker processes.
+
+    Every validator type gets its own pool of LOCAL_WORKERS processes that
+    import validate.py once, so a task costs a pickle round trip rather
+    than an HTTP request.
+    """
+
+    def __init__(self, tasks_dir=PROOF_TASKS_DIR, workers=LOCAL_WORKERS, sealed_root=SEALED_ROOT):
+        super().__init__()
+        self.tasks_dir = tasks_dir
+        self.workers = workers
+        self.sealed_root = sealed_root
+        # Workers are spawned rather than forked from a process full of threads
+        self._context = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._executors = {}
+        self._deterministic = {}
+        self._versions = {}
+        self._inflight = Counter()
+
+    def start(self):
+        for validator_type in validator_types(self.tasks_dir):
+            self._executors[validator_type] = self._new_executor(validator_type)
+        # Bring every worker up and through setup() before taking tasks
+        for validator_type, executor in self._executors.items():
+            infos = [future.result() for future in [executor.submit(_worker_info) for _ in range(self.workers)]]
+            self._deterministic[validator_type] = all(deterministic for _, deterministic, _ in infos)
+            self._versions[validator_type] = infos[0][2]
+            logger.info(f"Started {self.workers} local workers for {validator_type}")
+
+    def _new_executor(self, validator_type):
+        counter = self._context.Value('i', 0)
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context, initializer=_init_worker,
+                                   initargs=(self.tasks_dir, validator_type, self.sealed_root, counter))
+
+    def capacity(self, validator_type):
+        return self.workers
+
+    def deterministic(self, validator_type):
+        return self._deterministic.get(validator_type, False)
+
+    def version(self, validator_type):
+        return self._versions.get(validator_type)
+
+    def stats(self):
+        with self._lock:
+            return {
+                validator_type: {'replicas': self.workers, 'inflight': self._inflight[validator_type]}
+                for validator_type in self._executors
+            }
+
+    def _process_task(self, task, deadline):
+        result = self._process_batch([task], deadline)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _process_batch(self, tasks, deadline):
+        validator_type = tasks[0]['validator_type']
+        executor = self._executors.get(validator_type)
+        if not executor:
+            logger.error(f"No local validator for {validator_type}")
+            ERRORS.labels(validator_type, 'no_validator').inc()
+            return [ValidationError(f"No local validator for {validator_type}", 'no_validator')] * len(tasks)
+
+        with self._lock:
+            self._inflight[validator_type] += len(tasks)
+        results = [None] * len(tasks)
+        try:
+            with REQUEST_TIME.labels(validator_type, 'local').time():
+                futures = [executor.submit(_run_record, task['data']) for task in tasks]
+                for index, future in enumerate(futures):
+                    try:
+                        results[index] = future.result(timeout=max(0, deadline - time.monotonic()))['is_valid']
+                        self._remember(tasks[index], results[index])
+                    except TimeoutError:
+                        # Records not yet started are dropped rather than run for nothing
+                        future.cancel()
+                        logger.error(f"Local validation for {validator_type} timed out")
+                        ERRORS.labels(validator_type, 'timeout').inc()
+                        results[index] = DeadlineExceeded(f"Local validation for {validator_type} timed out", 'timeout')
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        logger.error(f"Local validation for {validator_type} failed: {e}")
+                        ERRORS.labels(validator_type, 'record').inc()
+                        results[index] = ValidationError(str(e), 'record')
+        except BrokenProcessPool as e:
+            logger.error(f"Local workers for {validator_type} died, restarting them: {e}")
+            ERRORS.labels(validator_type, 'worker_died').inc()
+            with self._lock:
+                if self._executors.get(validator_type) is executor:
+                    self._executors[validator_type] = self._new_executor(validator_type)
+            results = [ValidationError(f"Local workers died: {e}", 'worker_died') if result is None else result
+                       for result in results]
+        finally:
+            with self._lock:
+                self._inflight[validator_type] -= len(tasks)
+        return results
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
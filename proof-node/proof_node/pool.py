@@ -0,0 +1,641 @@
+import heapq
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+import docker
+
+from . import metrics
+from .registry import VALIDATOR_TYPE_LABEL, container_ip, probe_health, wait_until_healthy
+
+logger = logging.getLogger(__name__)
+
+MAX_VALIDATORS = int(os.environ.get('MAX_VALIDATORS', 3))
+MAX_REPLICAS_PER_TYPE = int(os.environ.get('MAX_REPLICAS_PER_TYPE', MAX_VALIDATORS))
+BASE_PORT = 8000  # Starting port for validators
+PORT_RANGE = 100
+# In-flight requests one replica is expected to absorb before another is worth starting
+REPLICA_CONCURRENCY = int(os.environ.get('REPLICA_CONCURRENCY', 2))
+LATENCY_TARGET = float(os.environ.get('LATENCY_TARGET_MS', 1000)) / 1000
+SCALE_INTERVAL = float(os.environ.get('SCALE_INTERVAL', 1))
+# Idle replicas are demoted one tier at a time: paused keeps the enclave in
+# memory, stopped keeps only the container, and removed frees the host port
+PAUSE_AFTER_IDLE = float(os.environ.get('PAUSE_AFTER_IDLE', 60))
+STOP_AFTER_IDLE = float(os.environ.get('STOP_AFTER_IDLE', 600))
+REMOVE_AFTER_IDLE = float(os.environ.get('REMOVE_AFTER_IDLE', 3600))
+MAX_HIBERNATED_VALIDATORS = int(os.environ.get('MAX_HIBERNATED_VALIDATORS', MAX_VALIDATORS * 2))
+# Memory that running and paused validators may hold together; 0 for no limit
+MEMORY_BUDGET = int(float(os.environ.get('VALIDATOR_MEMORY_BUDGET_MB', 0)) * 1024 * 1024)
+MEMORY_SAMPLE_INTERVAL = float(os.environ.get('MEMORY_SAMPLE_INTERVAL', 10))
+ACQUIRE_TIMEOUT = float(os.environ.get('ACQUIRE_TIMEOUT', 60))
+# How long shutdown waits for validators still starting to finish or give up
+SHUTDOWN_TIMEOUT = float(os.environ.get('POOL_SHUTDOWN_TIMEOUT', 30))
+LATENCY_EWMA_ALPHA = 0.2
+
+COLD_START = metrics.Histogram('proof_validator_cold_start_seconds',
+                               'Time from creating a validator container until it reports ready',
+                               ['validator_type'])
+RESUME_TIME = metrics.Histogram('proof_validator_resume_seconds',
+                                'Time to bring a hibernated validator back until it reports ready',
+                                ['validator_type', 'tier'])
+START_FAILURES = metrics.Counter('proof_validator_start_failures_total',
+                                 'Validators that failed to start or resume', ['validator_type'])
+TRANSITIONS = metrics.Counter('proof_validator_transitions_total',
+                              'Validators moved to a hibernation tier', ['validator_type', 'state'])
+
+ACTIVE = 'active'
+PAUSED = 'paused'
+STOPPED = 'stopped'
+# Transitional states, held while a background thread moves the container
+PAUSING = 'pausing'
+STOPPING = 'stopping'
+RESUMING = 'resuming'
+
+
+class PortAllocator:
+    def __init__(self, base=BASE_PORT, size=PORT_RANGE):
+        self._lock = threading.Lock()
+        self._free = list(range(base, base + size))
+        heapq.heapify(self._free)
+
+    def allocate(self):
+        with self._lock:
+            if not self._free:
+                raise RuntimeError("No free validator host ports")
+            return heapq.heappop(self._free)
+
+    def reserve(self, port):
+        with self._lock:
+            if port in self._free:
+                self._free.remove(port)
+                heapq.heapify(self._free)
+
+    def release(self, port):
+        with self._lock:
+            if port is not None and port not in self._free:
+                heapq.heappush(self._free, port)
+
+
+class Replica:
+    def __init__(self, validator_type, container, host_port):
+        self.validator_type = validator_type
+        self.container = container
+        self.host_port = host_port
+        self.endpoint = None  # snapshot handed out by acquire()
+        self.inflight = 0
+        self.last_used = time.monotonic()
+        self.state = ACTIVE
+        self.memory = 0  # bytes, as last sampled
+
+    @property
+    def id(self):
+        return self.container.id
+
+    @property
+    def name(self):
+        return self.container.name
+
+
+class ValidatorPool:
+    """Runs up to MAX_VALIDATORS validator containers shared across types.
+
+    Each type gets as many replicas as its queue depth and latency call
+    for, up to MAX_REPLICAS_PER_TYPE. Requests go to the least-loaded ready
+    replica, round-robin among equals. A background scaler starts replicas
+    for types with demand, evicting the least recently used idle replica of
+    another type when the pool is full.
+
+    Idle replicas are not removed straight away but hibernate: paused after
+    PAUSE_AFTER_IDLE, stopped after STOP_AFTER_IDLE and removed after
+    REMOVE_AFTER_IDLE seconds, and eviction pauses rather than removes. A
+    paused replica resumes in milliseconds and a stopped one skips container
+    creation, so demand for a cold type reactivates one of its hibernated
+    replicas before starting a new container. Only active replicas count
+    towards MAX_VALIDATORS; hibernated ones are bounded by
+    MAX_HIBERNATED_VALIDATORS and, when set, VALIDATOR_MEMORY_BUDGET_MB.
+    """
+
+    def __init__(self, docker_client, registry, max_validators=MAX_VALIDATORS,
+                 max_replicas_per_type=MAX_REPLICAS_PER_TYPE, max_hibernated_validators=MAX_HIBERNATED_VALIDATORS):
+        self.docker_client = docker_client
+        self.registry = registry
+        self.max_validators = max_validators
+        self.max_replicas_per_type = max_replicas_per_type
+        self.max_hibernated_validators = max_hibernated_validators
+        # Queue depth per validator type, provided by whoever feeds the pool.
+        # It is sampled by the scaler outside the pool's lock.
+        self.queue_depth = lambda validator_type: 0
+        self._queued = Counter()
+        self._cond = threading.Condition()
+        self._replicas = {}  # container id -> Replica
+        self._starting = Counter()  # validator type -> replicas being started or resumed
+        self._waiting = Counter()  # validator type -> callers blocked in acquire
+        self._latency = {}  # validator type -> EWMA of request latency in seconds
+        self._cold_start = {}  # validator type -> EWMA of container creation to ready, in seconds
+        self._deterministic = {}  # validator type -> as declared by its last /healthz
+        self._versions = {}  # validator type -> configuration version from its last /healthz
+        self._rr = itertools.count()
+        self._ports = PortAllocator()
+        self._stopped = threading.Event()
+        registry.add_listener(self._on_registry_change)
+
+    def start(self):
+        self._adopt_existing()
+        threading.Thread(target=self._scale_loop, name='validator-scaler', daemon=True).start()
+        if MEMORY_BUDGET:
+            threading.Thread(target=self._memory_loop, name='validator-memory', daemon=True).start()
+
+    # Task path
+
+    def acquire(self, validator_type, timeout=ACQUIRE_TIMEOUT, exclude=()):
+        # exclude holds replicas already working on the same task, for a hedge
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._waiting[validator_type] += 1
+            try:
+                while True:
+                    replica = self._pick(validator_type, exclude)
+                    if replica:
+                        replica.inflight += 1
+                        replica.last_used = time.monotonic()
+                        return replica
+                    if not self._replicas_of(validator_type) and not self._starting[validator_type]:
+                        self._request_replica(validator_type)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(min(remaining, SCALE_INTERVAL))
+            finally:
+                self._waiting[validator_type] -= 1
+
+    def release(self, replica, latency=None):
+        with self._cond:
+            replica.inflight -= 1
+            replica.last_used = time.monotonic()
+            if latency is not None:
+                previous = self._latency.get(replica.validator_type, latency)
+                self._latency[replica.validator_type] = previous + LATENCY_EWMA_ALPHA * (latency - previous)
+            self._cond.notify_all()
+
+    def capacity(self, validator_type):
+        # How many requests of this type are worth having in flight at once
+        with self._cond:
+            replicas = len(self._replicas_of(validator_type)) + self._starting[validator_type]
+        return max(1, replicas) * REPLICA_CONCURRENCY
+
+    def replicas(self, validator_type):
+        with self._cond:
+            return len(self._replicas_of(validator_type))
+
+    def deterministic(self, validator_type):
+        # Unknown until a replica of the type has reported ready
+        return self._deterministic.get(validator_type, False)
+
+    def version(self, validator_type):
+        return self._versions.get(validator_type)
+
+    def stats(self):
+        with self._cond:
+            types = self._types() | {r.validator_type for r in self._replicas.values()}
+            return {
+                validator_type: {
+                    'replicas': len(self._replicas_of(validator_type)),
+                    'starting': self._starting[validator_type],
+                    'paused': len(self._replicas_of(validator_type, PAUSED, PAUSING)),
+                    'stopped': len(self._replicas_of(validator_type, STOPPED, STOPPING)),
+                    'inflight': sum(r.inflight for r in self._replicas_of(validator_type)),
+                    'latency': self._latency.get(validator_type),
+                    'cold_start': self._cold_start.get(validator_type),
+                }
+                for validator_type in types
+            }
+
+    def _pick(self, validator_type, exclude=()):
+        ready = []
+        for replica in self._replicas_of(validator_type):
+            if replica in exclude:
+                continue
+            replica.endpoint = self.registry.lookup(replica.id)
+            if replica.endpoint:
+                ready.append(replica)
+        if not ready:
+            return None
+        offset = next(self._rr) % len(ready)
+        return min(ready[offset:] + ready[:offset], key=lambda r: r.inflight)
+
+    def _replicas_of(self, validator_type, *states):
+        states = states or (ACTIVE,)
+        return [r for r in self._replicas.values() if r.validator_type == validator_type and r.state in states]
+
+    def _in_state(self, *states):
+        return [r for r in self._replicas.values() if r.state in states]
+
+    def _types(self):
+        # Types with active or starting replicas
+        return {r.validator_type for r in self._in_state(ACTIVE)} | {t for t, n in self._starting.items() if n}
+
+    def _on_registry_change(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    # Scaling
+
+    def _scale_loop(self):
+        while not self._stopped.wait(SCALE_INTERVAL):
+            try:
+                self._scale()
+            except Exception as e:
+                logger.error(f"Error while scaling validators: {e}")
+
+    def _scale(self):
+        with self._cond:
+            types = self._types() | {t for t, n in self._waiting.items() if n}
+        queued = Counter({validator_type: self.queue_depth(validator_type) for validator_type in types})
+
+        now = time.monotonic()
+        demotions = []
+        removals = []
+        unreachable = []
+        with self._cond:
+            self._queued = queued
+            for validator_type in types:
+                replicas = self._replicas_of(validator_type)
+                backlog = self._queued[validator_type] + self._waiting[validator_type]
+                inflight = sum(r.inflight for r in replicas)
+                current = len(replicas) + self._starting[validator_type]
+
+                desired = math.ceil((backlog + inflight) / REPLICA_CONCURRENCY)
+                if backlog and self._latency.get(validator_type, 0) > LATENCY_TARGET:
+                    desired = max(desired, current + 1)
+                desired = min(desired, self.max_replicas_per_type)
+
+                if desired > current:
+                    self._request_replica(validator_type)
+                elif desired < len(replicas):
+                    idle = sorted((r for r in replicas if r.inflight == 0 and now - r.last_used > PAUSE_AFTER_IDLE),
+                                  key=lambda r: r.last_used)
+                    for replica in idle[:len(replicas) - desired]:
+                        demotions.append(self._begin_demotion(replica, PAUSED))
+
+            # Replicas whose container died or became unreachable
+            for replica in self._in_state(ACTIVE):
+                if replica.inflight == 0 and not self.registry.lookup(replica.id) and \
+                        now - replica.last_used > SCALE_INTERVAL:
+                    unreachable.append(replica)
+
+            for replica in self._in_state(PAUSED):
+                if now - replica.last_used > STOP_AFTER_IDLE:
+                    demotions.append(self._begin_demotion(replica, STOPPED))
+            for replica in self._in_state(STOPPED):
+                if now - replica.last_used > REMOVE_AFTER_IDLE:
+                    self._detach(replica)
+                    removals.append(replica)
+            self._enforce_hibernation_limits(demotions, removals)
+
+        for replica in unreachable:
+            self._recheck(replica)
+        for replica, state in demotions:
+            threading.Thread(target=self._demote, args=(replica, state),
+                             name=f'demote-{replica.name}', daemon=True).start()
+        for replica in removals:
+            logger.info(f"Removing hibernated validator {replica.name}")
+            self._remove_container(replica)
+
+    def _enforce_hibernation_limits(self, demotions, removals):
+        # Called with the condition held. Stopped replicas are given up
+        # before paused ones, least recently used first.
+        hibernated = sorted(self._in_state(PAUSED, STOPPED), key=lambda r: (r.state == PAUSED, r.last_used))
+        excess = len(self._in_state(PAUSED, PAUSING, STOPPED, STOPPING)) - self.max_hibernated_validators
+        for replica in hibernated[:max(0, excess)]:
+            self._detach(replica)
+            removals.append(replica)
+
+        if not MEMORY_BUDGET:
+            return
+        used = sum(r.memory for r in self._in_state(ACTIVE, PAUSED, PAUSING, RESUMING))
+        for replica in sorted(self._in_state(PAUSED), key=lambda r: r.last_used):
+            if used <= MEMORY_BUDGET:
+                break
+            used -= replica.memory
+            demotions.append(self._begin_demotion(replica, STOPPED))
+
+    def _memory_loop(self):
+        while not self._stopped.wait(MEMORY_SAMPLE_INTERVAL):
+            with self._cond:
+                replicas = self._in_state(ACTIVE, PAUSED)
+            for replica in replicas:
+                try:
+                    stats = replica.container.stats(stream=False)
+                    replica.memory = stats.get('memory_stats', {}).get('usage', 0)
+                except docker.errors.APIError as e:
+                    logger.warning(f"Could not read memory usage of validator {replica.name}: {e}")
+
+    def _request_replica(self, validator_type):
+        # Called with the condition held
+        if self._stopped.is_set():
+            return False
+        active = len(self._in_state(ACTIVE)) + sum(self._starting.values())
+        evict = None
+        if active >= self.max_validators:
+            evict = self._eviction_candidate(validator_type)
+            if not evict:
+                return False
+            self._begin_demotion(evict, PAUSED)
+        replica = self._dormant_candidate(validator_type)
+        resume_from = replica.state if replica else None
+        if replica:
+            replica.state = RESUMING
+        self._starting[validator_type] += 1
+        threading.Thread(target=self._activate, args=(validator_type, replica, resume_from, evict),
+                         name=f'start-{validator_type}', daemon=True).start()
+        return True
+
+    def _eviction_candidate(self, validator_type):
+        # Least recently used idle replica of another type; a type's last
+        # replica is only taken if nothing is waiting on it
+        idle = [r for r in self._in_state(ACTIVE) if r.inflight == 0 and r.validator_type != validator_type]
+        idle.sort(key=lambda r: r.last_used)
+        for replica in idle:
+            alone = len(self._replicas_of(replica.validator_type)) == 1
+            if not alone or not (self._waiting[replica.validator_type] or self._queued[replica.validator_type]):
+                return replica
+        return None
+
+    def _dormant_candidate(self, validator_type):
+        # Paused replicas come back fastest, then stopped ones
+        dormant = self._replicas_of(validator_type, PAUSED, STOPPED)
+        return max(dormant, key=lambda r: (r.state == PAUSED, r.last_used), default=None)
+
+    def _begin_demotion(self, replica, state):
+        # Called with the condition held; _demote finishes the move
+        replica.state = PAUSING if state == PAUSED else STOPPING
+        self.registry.invalidate(container_id=replica.id)
+        return replica, state
+
+    def _detach(self, replica):
+        # Called with the condition held; the container is removed afterwards
+        self._replicas.pop(replica.id, None)
+        self.registry.invalidate(container_id=replica.id)
+
+    def _discard(self, replica):
+        with self._cond:
+            self._detach(replica)
+        self._remove_container(replica)
+
+    # Container lifecycle
+
+    def _activate(self, validator_type, replica=None, resume_from=None, evict=None):
+        try:
+            if evict:
+                logger.info(f"Evicting least recently used validator {evict.name}")
+                self._demote(evict, PAUSED)
+            if replica:
+                ready = self._resume(replica, resume_from)
+            else:
+                started = time.monotonic()
+                replica = self._run_container(validator_type)
+                ready = self._wait_until_ready(replica)
+                if ready:
+                    self._record_cold_start(validator_type, time.monotonic() - started)
+            if ready:
+                with self._cond:
+                    # shutdown has already taken the replicas it removes
+                    stopped = self._stopped.is_set()
+                    if not stopped:
+                        replica.state = ACTIVE
+                        replica.last_used = time.monotonic()
+                        self._replicas[replica.id] = replica
+                if stopped:
+                    self._discard(replica)
+                return
+            START_FAILURES.labels(validator_type).inc()
+            self._discard(replica)
+        except Exception as e:
+            logger.error(f"Failed to start validator for {validator_type}: {e}")
+            START_FAILURES.labels(validator_type).inc()
+            if replica:
+                self._discard(replica)
+        finally:
+            with self._cond:
+                self._starting[validator_type] -= 1
+                self._cond.notify_all()
+
+    def _resume(self, replica, resume_from):
+        started = time.monotonic()
+        if resume_from == PAUSED:
+            # The validator was frozen mid-accept, so it is listening already
+            replica.container.unpause()
+            replica.container.reload()
+            ready = self.registry.put_container(replica.container.attrs) is not None
+        else:
+            replica.container.start()
+            ready = self._wait_until_ready(replica)
+        if ready:
+            elapsed = time.monotonic() - started
+            RESUME_TIME.labels(replica.validator_type, resume_from).observe(elapsed)
+            logger.info(f"Resumed {resume_from} validator {replica.name} in {elapsed * 1000:.0f} ms")
+        return ready
+
+    def _demote(self, replica, state):
+        try:
+            if state == PAUSED:
+                replica.container.pause()
+            else:
+                replica.container.reload()
+                if replica.container.status == 'paused':
+                    replica.container.unpause()
+                replica.container.stop()
+        except docker.errors.APIError as e:
+            logger.error(f"Failed to move validator {replica.name} to {state}: {e}")
+            self._discard(replica)
+            return
+        logger.info(f"Validator {replica.name} is now {state}")
+        TRANSITIONS.labels(replica.validator_type, state).inc()
+        with self._cond:
+            replica.state = state
+            if state == STOPPED:
+                replica.memory = 0
+            self._cond.notify_all()
+
+    def _recheck(self, replica):
+        # The registry lost this replica's endpoint; keep it if it still answers
+        try:
+            if self._probe(replica):
+                return
+        except docker.errors.APIError:
+            pass
+        with self._cond:
+            if replica.state != ACTIVE or replica.inflight or self.registry.lookup(replica.id):
+                return
+            self._begin_demotion(replica, STOPPED)
+        logger.warning(f"Validator {replica.name} is unreachable, stopping it")
+        self._demote(replica, STOPPED)
+
+    def _container_name(self, validator_type, host_port):
+        sgx_enabled = os.environ.get('SGX') == 'true'
+        prefix = 'gsc-' if sgx_enabled else ''
+        return f'{prefix}{validator_type}-proof-{host_port - BASE_PORT}'
+
+    def _run_container(self, validator_type):
+        sgx_enabled = os.environ.get('SGX') == 'true'
+        host_port = self._ports.allocate()
+        container_name = self._container_name(validator_type, host_port)
+
+        # Prepare SGX-specific configurations
+        devices = ['/dev/sgx_enclave:/dev/sgx_enclave'] if sgx_enabled else None
+        volumes = {'/var/run/aesmd': {'bind': '/var/run/aesmd', 'mode': 'rw'}, f'/mnt/sealed/{container_name}': {'bind': '/sealed', 'mode': 'rw'}} if sgx_enabled else None
+
+        # Include IAS_API_KEY in the environment variables
+        environment = {'SGX_AESM_ADDR': '1'} if sgx_enabled else {}
+        ias_api_key = os.environ.get('IAS_API_KEY')
+        if ias_api_key:
+            environment['IAS_API_KEY'] = ias_api_key
+        else:
+            logger.warning("IAS_API_KEY not set in the environment")
+
+        # Remove None values to avoid empty specs
+        run_kwargs = {
+            'image': f'gsc-{validator_type}-proof' if sgx_enabled else f'{validator_type}-proof',
+            'detach': True,
+            'name': container_name,
+            'ports': {'8000/tcp': host_port},  # Map container port 8000 to a specific host port
+            'command': ["python", "/validate.py"],
+            'environment': environment,
+            'labels': {VALIDATOR_TYPE_LABEL: validator_type},
+        }
+        if devices:
+            run_kwargs['devices'] = devices
+        if volumes:
+            run_kwargs['volumes'] = volumes
+
+        try:
+            container = self.docker_client.containers.run(**run_kwargs)
+        except docker.errors.APIError as e:
+            # Keep a port that something else holds out of the pool
+            if 'port is already allocated' not in str(e):
+                self._ports.release(host_port)
+            raise
+        logger.info(f"Created new validator: {container_name} on host port {host_port}")
+        return Replica(validator_type, container, host_port)
+
+    def _probe(self, replica):
+        replica.container.reload()
+        ip = container_ip(replica.container.attrs)
+        health = probe_health(ip) if replica.container.status == 'running' and ip else None
+        if not health:
+            return False
+        self._record_health(replica.validator_type, health)
+        return self.registry.put_container(replica.container.attrs) is not None
+
+    def _wait_until_ready(self, replica):
+        replica.container.reload()
+        ip = container_ip(replica.container.attrs)
+
+        def exited():
+            if self._stopped.is_set():
+                return True
+            replica.container.reload()
+            return replica.container.status not in ('created', 'running')
+
+        health = wait_until_healthy(ip, cancelled=exited) if ip else None
+        if health:
+            self._record_health(replica.validator_type, health)
+            replica.container.reload()
+            if self.registry.put_container(replica.container.attrs):
+                return True
+        logger.error(f"Validator {replica.name} failed to become ready. Status: {replica.container.status}")
+        return False
+
+    def _record_health(self, validator_type, health):
+        self._deterministic[validator_type] = bool(health.get('deterministic'))
+        self._versions[validator_type] = health.get('version')
+
+    def _record_cold_start(self, validator_type, seconds):
+        COLD_START.labels(validator_type).observe(seconds)
+        with self._cond:
+            previous = self._cold_start.get(validator_type, seconds)
+            self._cold_start[validator_type] = previous + LATENCY_EWMA_ALPHA * (seconds - previous)
+        logger.info(f"Validator for {validator_type} ready after a {seconds:.2f}s cold start")
+
+    def _remove_container(self, replica):
+        self.registry.invalidate(container_id=replica.id)
+        try:
+            # A paused container cannot be stopped gracefully
+            if replica.state not in (PAUSED, PAUSING, STOPPED):
+                replica.container.stop()
+            replica.container.remove(force=True)
+            logger.info(f"Removed validator {replica.name}")
+        except docker.errors.NotFound:
+            pass
+        except docker.errors.APIError as e:
+            logger.error(f"Error removing validator {replica.name}: {e}")
+        self._ports.release(replica.host_port)
+
+    def _adopt_existing(self):
+        # Pick up validators left behind by a previous node process, in
+        # whichever tier they were in
+        states = {'running': ACTIVE, 'paused': PAUSED, 'exited': STOPPED, 'created': STOPPED}
+        containers = self.docker_client.containers.list(all=True, filters={'label': VALIDATOR_TYPE_LABEL})
+        for container in containers:
+            validator_type = container.labels.get(VALIDATOR_TYPE_LABEL)
+            bindings = (container.attrs.get('HostConfig', {}).get('PortBindings') or {}).get('8000/tcp') or []
+            host_port = int(bindings[0]['HostPort']) if bindings and bindings[0].get('HostPort') else None
+            replica = Replica(validator_type, container, host_port)
+            replica.state = states.get(container.status)
+            with self._cond:
+                if replica.state == ACTIVE:
+                    full = len(self._in_state(ACTIVE)) + sum(self._starting.values()) >= self.max_validators
+                else:
+                    full = len(self._in_state(PAUSED, STOPPED)) >= self.max_hibernated_validators
+            if replica.state is None or full:
+                self._remove_container(replica)
+                continue
+            if host_port is not None:
+                self._ports.reserve(host_port)
+            adopting = replica.state == ACTIVE
+            with self._cond:
+                if adopting:
+                    # Taken up once its /healthz answers, like a replica this pool started
+                    replica.state = RESUMING
+                    self._starting[validator_type] += 1
+                self._replicas[replica.id] = replica
+            if adopting:
+                threading.Thread(target=self._adopt, args=(replica,), name=f'adopt-{replica.name}',
+                                 daemon=True).start()
+            logger.info(f"Reusing existing {container.status} validator: {container.name}")
+
+    def _adopt(self, replica):
+        # Probing also learns whether the type is deterministic, which
+        # hedging and the result cache wait on
+        try:
+            ready = self._wait_until_ready(replica)
+        except docker.errors.APIError as e:
+            logger.error(f"Failed to probe existing validator {replica.name}: {e}")
+            ready = False
+        with self._cond:
+            # Once stopped, shutdown removes it with the rest
+            stopped = self._stopped.is_set()
+            if ready and not stopped:
+                replica.state = ACTIVE
+                replica.last_used = time.monotonic()
+            self._starting[replica.validator_type] -= 1
+            self._cond.notify_all()
+        if not ready and not stopped:
+            self._discard(replica)
+
+    def shutdown(self):
+        self._stopped.set()
+        with self._cond:
+            # Validators still starting remove themselves once they see the pool stopped
+            if not self._cond.wait_for(lambda: not sum(self._starting.values()), SHUTDOWN_TIMEOUT):
+                logger.warning(f"Validators still starting after {SHUTDOWN_TIMEOUT:.0f}s: "
+                               f"{', '.join(t for t, n in self._starting.items() if n)}")
+            replicas = list(self._replicas.values())
+            self._replicas.clear()
+        for replica in replicas:
+            logger.info(f"Stopping validator {replica.name}")
+            self._remove_container(replica)
@@ -0,0 +1,232 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+import docker
+import requests
+
+logger = logging.getLogger(__name__)
+
+VALIDATOR_PORT = 8000
+VALIDATOR_TYPE_LABEL = 'proof.validator_type'
+HEALTH_PATH = '/healthz'
+# How long a starting validator may take to report ready; enclave creation
+# under SGX can take tens of seconds
+READINESS_DEADLINE = float(os.environ.get('READINESS_DEADLINE', 60))
+READINESS_INITIAL_DELAY = 0.05
+READINESS_MAX_DELAY = 2
+
+Endpoint = namedtuple('Endpoint', ['validator_type', 'container_id', 'ip', 'port'])
+
+
+# Containers are named '{type}-proof' or 'gsc-{type}-proof', with a replica
+# number appended when a type has several
+CONTAINER_NAME = re.compile(r'^/?(?:gsc-)?(?P<type>.+?)-proof(?:-\d+)?$')
+
+
+def validator_type_from_name(name):
+    match = CONTAINER_NAME.match(name)
+    return match.group('type') if match else None
+
+
+def validator_type_from_attrs(attrs):
+    labels = attrs.get('Config', {}).get('Labels') or {}
+    return labels.get(VALIDATOR_TYPE_LABEL) or validator_type_from_name(attrs.get('Name', ''))
+
+
+def container_ip(attrs):
+    settings = attrs.get('NetworkSettings', {})
+    if settings.get('IPAddress'):
+        return settings['IPAddress']
+    for network in (settings.get('Networks') or {}).values():
+        if network.get('IPAddress'):
+            return network['IPAddress']
+    return None
+
+
+def probe_health(ip, port=VALIDATOR_PORT, timeout=1):
+    # The validator's /healthz document if it is ready to take work
+    try:
+        response = requests.get(f'http://{ip}:{port}{HEALTH_PATH}', timeout=timeout)
+        health = response.json() if response.status_code == 200 else None
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+    return health if health and health.get('ready') else None
+
+
+def wait_until_healthy(ip, port=VALIDATOR_PORT, deadline=READINESS_DEADLINE, cancelled=None, probe=None):
+    # Probe with exponential backoff, so a validator that is up in 100ms is
+    # seen within a few probes and a slow enclave still gets the full deadline
+    give_up = time.monotonic() + deadline
+    delay = READINESS_INITIAL_DELAY
+    while True:
+        health = probe() if probe else probe_health(ip, port)
+        if health:
+            return health
+        remaining = give_up - time.monotonic()
+        if remaining <= 0 or (cancelled and cancelled()):
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, READINESS_MAX_DELAY)
+
+
+class EndpointRegistry:
+    """In-memory map of running, reachable validator containers.
+
+    Entries are added by the node once a validator is ready and are kept
+    current by a background subscriber to the Docker events API, so the
+    task path never has to ask the daemon where a validator lives.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}  # container id -> Endpoint
+        self._listeners = []
+        self._watcher = None
+        self._events = None  # the open event stream, closed by stop()
+        self._stopped = threading.Event()
+
+    def lookup(self, container_id):
+        with self._lock:
+            return self._endpoints.get(container_id)
+
+    def add_listener(self, callback):
+        # Called with no arguments whenever an endpoint is added or removed
+        self._listeners.append(callback)
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
+
+    def put(self, endpoint):
+        with self._lock:
+            self._endpoints[endpoint.container_id] = endpoint
+        self._notify()
+
+    def put_container(self, attrs):
+        validator_type = validator_type_from_attrs(attrs)
+        ip = container_ip(attrs)
+        state = attrs.get('State', {})
+        # A paused container keeps its address but answers nothing
+        if not validator_type or not ip or not state.get('Running') or state.get('Paused'):
+            return None
+        endpoint = Endpoint(validator_type, attrs['Id'], ip, VALIDATOR_PORT)
+        self.put(endpoint)
+        return endpoint
+
+    def invalidate(self, container_id=None, validator_type=None):
+        removed = False
+        with self._lock:
+            for key, endpoint in list(self._endpoints.items()):
+                if key == container_id or endpoint.validator_type == validator_type:
+                    del self._endpoints[key]
+                    removed = True
+                    logger.info(f"Invalidated endpoint for {endpoint.validator_type}: {endpoint.ip}:{endpoint.port}")
+        if removed:
+            self._notify()
+
+    def watch(self, docker_client):
+        if self._watcher and self._watcher.is_alive():
+            return
+        self._stopped.clear()
+        self._watcher = threading.Thread(target=self._watch_events, args=(docker_client,),
+                                         name='docker-events', daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        self._stopped.set()
+        events = self._events
+        if events is not None:
+            # Unblocks the watcher, which may be waiting for the next event
+            try:
+                events.close()
+            except Exception:
+                pass
+        if self._watcher and self._watcher is not threading.current_thread():
+            self._watcher.join(5)
+
+    def _watch_events(self, docker_client):
+        filters = {
+            'type': ['container', 'network'],
+            'event': ['start', 'die', 'destroy', 'pause', 'unpause', 'connect', 'disconnect'],
+        }
+        while not self._stopped.is_set():
+            try:
+                self._events = docker_client.events(decode=True, filters=filters)
+                # Anything could have happened while we were not listening.
+                # The stream is open first, so nothing after the listing is missed.
+                self._resync(docker_client)
+                for event in self._events:
+                    if self._stopped.is_set():
+                        break
+                    self._handle_event(docker_client, event)
+            except docker.errors.DockerException as e:
+                if not self._stopped.is_set():
+                    logger.error(f"Docker event stream failed: {e}")
+            except Exception as e:
+                if not self._stopped.is_set():
+                    logger.error(f"Unexpected error in Docker event stream: {e}")
+            self._stopped.wait(1)
+        self._events = None
+
+    def _resync(self, docker_client):
+        # Drops endpoints whose containers are no longer running and picks up
+        # running validators it does not know of. Endpoints the node put while
+        # the listing was in flight are left alone.
+        with self._lock:
+            known = set(self._endpoints)
+        containers = docker_client.containers.list(filters={'label': VALIDATOR_TYPE_LABEL, 'status': 'running'})
+        running = {container.id for container in containers}
+        for container_id in known - running:
+            self.invalidate(container_id=container_id)
+        for container_id in running - known:
+            self._refresh(docker_client, container_id)
+
+    def _handle_event(self, docker_client, event):
+        action = event.get('Action', '')
+        attributes = event.get('Actor', {}).get('Attributes', {})
+
+        if event.get('Type') == 'network':
+            container_id = attributes.get('container')
+            if not container_id:
+                return
+            if action == 'disconnect':
+                self.invalidate(container_id=container_id)
+            elif action == 'connect':
+                self._refresh(docker_client, container_id)
+            return
+
+        container_id = event.get('Actor', {}).get('ID') or event.get('id')
+        if action in ('die', 'destroy', 'pause'):
+            self.invalidate(container_id=container_id)
+        elif action in ('start', 'unpause'):
+            validator_type = attributes.get(VALIDATOR_TYPE_LABEL) or validator_type_from_name(attributes.get('name', ''))
+            if validator_type:
+                self._refresh(docker_client, container_id)
+
+    def _refresh(self, docker_client, container_id):
+        try:
+            attrs = docker_client.api.inspect_container(container_id)
+        except docker.errors.NotFound:
+            self.invalidate(container_id=container_id)
+            return
+        except docker.errors.APIError as e:
+            logger.error(f"Error inspecting container {container_id}: {e}")
+            return
+        if not validator_type_from_attrs(attrs) or not container_ip(attrs):
+            return
+        # A started container is not necessarily listening yet, so only
+        # register it once its /healthz reports ready
+        threading.Thread(target=self._register_when_ready, args=(attrs,), daemon=True).start()
+
+    def _register_when_ready(self, attrs):
+        ip = container_ip(attrs)
+        if wait_until_healthy(ip, cancelled=self._stopped.is_set):
+            endpoint = self.put_container(attrs)
+            if endpoint:
+                logger.info(f"Registered endpoint for {endpoint.validator_type}: {endpoint.ip}:{endpoint.port}")
+        elif not self._stopped.is_set():
+            logger.warning(f"Container {attrs['Id'][:12]} did not become ready on {ip}:{VALIDATOR_PORT}")
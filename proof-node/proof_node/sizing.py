@@ -0,0 +1,170 @@
+# Sizes each validator's Gramine manifest from what it actually uses.
+#
+# While the benchmark drives validators as local processes, outside of any
+# enclave, a sampler reads their peak resident memory, thread count and open
+# files from /proc. Each validator runs with the thread budget its manifest
+# gives it (loader.env.SGX_MAX_THREADS), so it starts the same workers it
+# would in the enclave. The manifests are then written out again with
+#
+#   sgx.enclave_size  peak RSS plus MANIFEST_MEMORY_HEADROOM and
+#                     GRAMINE_MEMORY_OVERHEAD, rounded up to a power of two
+#                     as Gramine requires
+#   sgx.max_threads   the thread budget, or the peak threads if the validator
+#                     went over it, plus GRAMINE_HELPER_THREADS and
+#                     MANIFEST_THREAD_HEADROOM
+#
+# The worker pool grows lazily up to the budget, and some threads only start
+# inside an enclave, so the budget rather than the peak a benchmark happens
+# to reach is what the enclave has to hold. The budget itself is left as it
+# was profiled, so the headroom stays free rather than going to more workers:
+#
+#   python -m proof_node.bench --duration 60 --profile manifests
+#   python -m proof_node.bench --duration 60 --profile ../proof-tasks   # in place
+import logging
+import os
+import re
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.05))
+# Share of the peak RSS added on top, for inputs the benchmark did not send
+MANIFEST_MEMORY_HEADROOM = float(os.environ.get('MANIFEST_MEMORY_HEADROOM', 0.5))
+MANIFEST_THREAD_HEADROOM = int(os.environ.get('MANIFEST_THREAD_HEADROOM', 0))
+# TCS slots for Gramine's own helper threads, which a process outside the
+# enclave does not have; the manifests keep sgx.max_threads this far above
+# loader.env.SGX_MAX_THREADS
+GRAMINE_HELPER_THREADS = int(os.environ.get('GRAMINE_HELPER_THREADS', 3))
+# Megabytes for Gramine's LibOS and PAL, which a process outside the
+# enclave does not have
+GRAMINE_MEMORY_OVERHEAD = int(os.environ.get('GRAMINE_MEMORY_OVERHEAD', 64))
+
+MANIFEST = 'python.manifest.template'
+ENCLAVE_SIZE = re.compile(r'^sgx\.enclave_size\s*=.*$', re.MULTILINE)
+MAX_THREADS = re.compile(r'^sgx\.max_threads\s*=.*$', re.MULTILINE)
+THREAD_BUDGET = re.compile(r'^loader\.env\.SGX_MAX_THREADS\s*=\s*"(\d+)"', re.MULTILINE)
+SIZED = re.compile(r'^# Sized from a profiling run:.*\n', re.MULTILINE)
+MB = 1024 * 1024
+
+
+def thread_budget(tasks_dir, validator_type):
+    # The SGX_MAX_THREADS a validator's manifest sets, if it sets one
+    path = Path(tasks_dir) / validator_type / MANIFEST
+    if not path.exists():
+        return None
+    match = THREAD_BUDGET.search(path.read_text())
+    return int(match.group(1)) if match else None
+
+
+def validator_env(tasks_dir, validator_types):
+    # Environment that gives each validator its enclave's thread budget
+    budgets = {validator_type: thread_budget(tasks_dir, validator_type) for validator_type in validator_types}
+    return {validator_type: {'SGX_MAX_THREADS': str(budget)}
+            for validator_type, budget in budgets.items() if budget}
+
+
+def read_usage(pid):
+    # None once the process has exited
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        open_files = len(os.listdir(f'/proc/{pid}/fd'))
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    return {
+        # The kernel's own high-water mark, so nothing between samples is missed
+        'rss_bytes': int(status['VmHWM'].split()[0]) * 1024,
+        'threads': int(status['Threads']),
+        'open_files': open_files,
+    }
+
+
+class ResourceSampler:
+    """Peak memory, threads and open files of validator processes.
+
+    Threads and open files are polled every interval, so a spike shorter
+    than that can be missed; peak memory is read from the kernel's
+    high-water mark and is exact. Peaks are kept per validator type, the
+    highest of any of its processes.
+    """
+
+    def __init__(self, processes, interval=PROFILE_INTERVAL):
+        if not os.path.isdir('/proc/self/fd'):
+            raise RuntimeError("Profiling reads /proc and needs Linux")
+        self.processes = list(processes)  # (validator_type, pid)
+        self.interval = interval
+        self.peaks = defaultdict(lambda: {'rss_bytes': 0, 'threads': 0, 'open_files': 0})
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='resource-sampler', daemon=True)
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        # Call before the processes are stopped, for a last sample
+        self._stopped.set()
+        self._thread.join()
+        self.sample()
+        return dict(self.peaks)
+
+    def sample(self):
+        for validator_type, pid in self.processes:
+            usage = read_usage(pid)
+            if usage is None:
+                continue
+            peaks = self.peaks[validator_type]
+            for key, value in usage.items():
+                peaks[key] = max(peaks[key], value)
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+
+def enclave_size(rss_bytes, headroom=MANIFEST_MEMORY_HEADROOM, overhead=GRAMINE_MEMORY_OVERHEAD):
+    needed = rss_bytes * (1 + headroom) + overhead * MB
+    size = MB
+    while size < needed:
+        size *= 2
+    return f'{size // 1024 // MB}G' if size >= 1024 * MB else f'{size // MB}M'
+
+
+def tune_manifest(text, size, max_threads, peaks):
+    header = (f"# Sized from a profiling run: peak RSS {peaks['rss_bytes'] / MB:.0f} MiB, "
+              f"{peaks['threads']} threads, {peaks['open_files']} open files\n")
+    text = SIZED.sub('', text)
+    lines = ((ENCLAVE_SIZE, f'sgx.enclave_size = "{size}"'), (MAX_THREADS, f'sgx.max_threads = {max_threads}'))
+    for pattern, line in lines:
+        text, found = pattern.subn(line, text, count=1)
+        if not found:
+            text = line + '\n' + text
+    return header + text
+
+
+def write_manifests(peaks, tasks_dir, output_dir, memory_headroom=MANIFEST_MEMORY_HEADROOM,
+                    thread_headroom=MANIFEST_THREAD_HEADROOM, overhead=GRAMINE_MEMORY_OVERHEAD):
+    # Writes output_dir/<type>/python.manifest.template for every profiled
+    # validator type, which updates them in place when output_dir is the
+    # proof-tasks checkout, and returns what each was sized from
+    sized = {}
+    for validator_type, usage in sorted(peaks.items()):
+        template = Path(tasks_dir) / validator_type / MANIFEST
+        if not template.exists():
+            logger.warning(f"No manifest for {validator_type} at {template}, not sizing it")
+            continue
+        size = enclave_size(usage['rss_bytes'], memory_headroom, overhead)
+        budget = thread_budget(tasks_dir, validator_type)
+        if budget and usage['threads'] > budget:
+            logger.warning(f"{validator_type} ran {usage['threads']} threads on a budget of {budget}; "
+                           f"it starts threads after sizing its worker pool")
+        max_threads = max(usage['threads'], budget or 0) + GRAMINE_HELPER_THREADS + thread_headroom
+        path = Path(output_dir) / validator_type / MANIFEST
+        path.parent.mkdir(parents=True, exist_ok=True)
+        text = tune_manifest(template.read_text(), size, max_threads, usage)
+        path.write_text(text)
+        sized[validator_type] = {**usage, 'thread_budget': budget, 'enclave_size': size,
+                                 'max_threads': max_threads, 'manifest': str(path)}
+    return sized
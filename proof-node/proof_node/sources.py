@@ -0,0 +1,328 @@
+# Task ingestion from external producers.
+#
+# Producers write tasks as NDJSON, one {"validator_type": ..., "data": ...}
+# object per line, optionally with a "timeout" in seconds, to any of the
+# sources in TASK_SOURCES:
+#
+#   stdin             the node's standard input
+#   file:PATH         a file, followed as it grows and resumed after a restart
+#   unix:PATH         a Unix socket
+#   tcp:HOST:PORT     a TCP socket
+#
+# Every task is spooled to disk before it is acknowledged, and the spool
+# feeds the dispatcher a bounded number of tasks at a time. A task leaves
+# the spool once it is validated or fails for good; one that failed for a
+# passing reason, such as its validator restarting, is tried again. On sockets the
+# node answers every line, in order, with {"seq": N} once the task is
+# durable or {"error": ...} if the line was not a task. A {"status":true}
+# line is answered, in the same order, with how loaded the node is:
+#
+#   {"status": {"queued": 12, "spooled": 340}}
+#
+# queued counts tasks waiting for a dispatcher worker, and spooled those in
+# the spool that are not yet done.
+import heapq
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+from . import logs, metrics
+from .backends import DeadlineExceeded, ValidationError
+from .spool import Spool
+
+logger = logging.getLogger(__name__)
+
+TASK_SOURCES = os.environ.get('TASK_SOURCES', '')  # comma separated; empty runs the task generator
+# Tasks taken from the spool but not yet completed
+INGEST_PREFETCH = int(os.environ.get('INGEST_PREFETCH', 256))
+# Appends a source may have waiting on the spool before it stops reading
+SOURCE_MAX_UNACKED = int(os.environ.get('SOURCE_MAX_UNACKED', 4096))
+SOURCE_MAX_LINE_BYTES = int(os.environ.get('SOURCE_MAX_LINE_BYTES', 1024 * 1024))
+FILE_POLL_INTERVAL = float(os.environ.get('FILE_POLL_INTERVAL', 0.5))
+STATUS_REQUEST = b'{"status":true}'
+# Backoff before a task that failed for a passing reason is dispatched again
+INGEST_RETRY_BASE_DELAY = float(os.environ.get('INGEST_RETRY_BASE_DELAY', 1))
+INGEST_RETRY_MAX_DELAY = float(os.environ.get('INGEST_RETRY_MAX_DELAY', 60))
+
+INGESTED = metrics.Counter('proof_ingested_tasks_total', 'Tasks spooled from producers', ['source'])
+REJECTED = metrics.Counter('proof_ingest_rejected_total', 'Producer lines that were not tasks', ['source'])
+REQUEUED = metrics.Counter('proof_ingest_requeued_total', 'Spooled tasks dispatched again after a passing failure',
+                           ['validator_type'])
+
+
+def parse_task(line):
+    task = json.loads(line)
+    if not isinstance(task, dict) or not isinstance(task.get('validator_type'), str) or 'data' not in task:
+        raise ValueError("expected an object with validator_type and data")
+    parsed = {'validator_type': task['validator_type'], 'data': task['data']}
+    if 'timeout' in task:
+        if type(task['timeout']) not in (int, float) or task['timeout'] <= 0:
+            raise ValueError("timeout must be a positive number of seconds")
+        parsed['timeout'] = task['timeout']
+    return parsed
+
+
+def transient(error):
+    # Whether a task that failed with error may still succeed, as when its
+    # validator was down or it ran out of time; only a ValidationError that
+    # another try cannot fix is final
+    return not isinstance(error, ValidationError) or error.retryable or isinstance(error, DeadlineExceeded)
+
+
+class Source:
+    # Reads tasks on its own thread and appends them to the spool
+    def __init__(self, name, spool):
+        self.name = name
+        self.spool = spool
+        self._unacked = deque()
+
+    def start(self):
+        threading.Thread(target=self._run, name=f'source-{self.name}', daemon=True).start()
+        logger.info(f"Reading tasks from {self.name}")
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception as e:
+            logger.error(f"Task source {self.name} failed: {e}")
+
+    def run(self):
+        raise NotImplementedError
+
+    def _spool(self, line, offset=None, resumable=False):
+        try:
+            task = parse_task(line)
+        except ValueError as e:
+            logger.error(f"Rejected line from {self.name}: {e}")
+            REJECTED.labels(self.name).inc()
+            return None
+        # Stop reading while too much is still on its way to disk
+        while len(self._unacked) >= SOURCE_MAX_UNACKED:
+            self._unacked.popleft().result()
+        future = self.spool.append(task, self.name if resumable else None, offset)
+        self._unacked.append(future)
+        while self._unacked and self._unacked[0].done():
+            self._unacked.popleft()
+        INGESTED.labels(self.name).inc()
+        return future
+
+
+class StreamSource(Source):
+    def __init__(self, spool, stream=None, name='stdin'):
+        super().__init__(name, spool)
+        self.stream = stream or sys.stdin.buffer
+
+    def run(self):
+        for line in self.stream:
+            if line.strip():
+                self._spool(line)
+        logger.info(f"Reached the end of {self.name}")
+
+
+class FileSource(Source):
+    # Follows the file as it grows, and picks up after its last spooled line
+    def __init__(self, spool, path):
+        super().__init__(f'file:{path}', spool)
+        self.path = path
+
+    def run(self):
+        while not os.path.exists(self.path):
+            time.sleep(FILE_POLL_INTERVAL)
+        with open(self.path, 'rb') as f:
+            offset = self.spool.offset(self.name)
+            if offset > os.fstat(f.fileno()).st_size:
+                logger.warning(f"{self.path} is shorter than where it was left off, reading it from the start")
+                offset = 0
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # At the end of the file, or in the middle of a line still being written
+                    f.seek(offset)
+                    time.sleep(FILE_POLL_INTERVAL)
+                    continue
+                offset = f.tell()
+                if line.strip():
+                    self._spool(line, offset, resumable=True)
+
+
+class SocketSource(Source):
+    def __init__(self, spool, address, status=None):
+        name = f'unix:{address}' if isinstance(address, str) else f'tcp:{address[0]}:{address[1]}'
+        super().__init__(name, spool)
+        self.address = address
+        # Returns the node's load for a status request
+        self.status = status
+
+    def run(self):
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(self.address)
+        server.listen()
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self._serve, args=(conn,), name=f'source-{self.name}-conn', daemon=True).start()
+
+    def _serve(self, conn):
+        # Lines are read here and answered from a second thread as the spool
+        # makes them durable, so a producer can keep many lines in flight
+        replies = queue.Queue(SOURCE_MAX_UNACKED)
+        replier = threading.Thread(target=self._reply, args=(conn, replies), daemon=True)
+        replier.start()
+        try:
+            with conn.makefile('rb') as reader:
+                while True:
+                    line = reader.readline(SOURCE_MAX_LINE_BYTES + 1)
+                    if not line:
+                        break
+                    if len(line) > SOURCE_MAX_LINE_BYTES:
+                        replies.put('line too long')
+                        break
+                    if not line.strip():
+                        continue
+                    if self.status and line.strip() == STATUS_REQUEST:
+                        replies.put(self.status)
+                        continue
+                    try:
+                        task = parse_task(line)
+                    except ValueError as e:
+                        REJECTED.labels(self.name).inc()
+                        replies.put(str(e))
+                        continue
+                    replies.put(self.spool.append(task))
+                    INGESTED.labels(self.name).inc()
+        except OSError as e:
+            logger.error(f"Connection to {self.name} failed: {e}")
+        finally:
+            replies.put(None)
+            replier.join()
+            conn.close()
+
+    def _reply(self, conn, replies):
+        while True:
+            reply = replies.get()
+            if reply is None:
+                return
+            try:
+                if isinstance(reply, str):
+                    message = {'error': reply}
+                elif callable(reply):
+                    # Taken as the reply goes out, after the tasks ahead of it
+                    message = {'status': reply()}
+                else:
+                    try:
+                        message = {'seq': reply.result()}
+                    except Exception as e:
+                        message = {'error': f'not spooled: {e}'}
+                conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            except OSError:
+                # The producer went away; what it sent is spooled regardless
+                pass
+
+
+def make_source(spec, spool, status=None):
+    kind, _, target = spec.partition(':')
+    if kind == 'stdin':
+        return StreamSource(spool)
+    if kind == 'file':
+        return FileSource(spool, target)
+    if kind == 'unix':
+        return SocketSource(spool, target, status)
+    if kind == 'tcp':
+        host, _, port = target.rpartition(':')
+        return SocketSource(spool, (host or '0.0.0.0', int(port)), status)
+    raise ValueError(f"Unknown task source {spec!r}")
+
+
+class Feeder:
+    """Hands spooled tasks to the dispatcher and acknowledges them when done.
+
+    At most prefetch tasks are out of the spool at once, so a burst waits
+    on disk rather than in memory. A task is acknowledged once it has a
+    result or failed for good. One that failed for a passing reason keeps
+    its slot and goes back to the dispatcher after a jittered backoff, and
+    as it was never acknowledged, a restart replays it as well.
+    """
+
+    def __init__(self, spool, dispatcher, prefetch=INGEST_PREFETCH, on_done=None,
+                 retry_base_delay=INGEST_RETRY_BASE_DELAY, retry_max_delay=INGEST_RETRY_MAX_DELAY):
+        self.spool = spool
+        self.dispatcher = dispatcher
+        self.on_done = on_done
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._slots = threading.BoundedSemaphore(prefetch)
+        self._cond = threading.Condition()
+        self._retries = []  # heap of (due, seq, task, attempt)
+
+    def run(self):
+        threading.Thread(target=self._retry_loop, name='ingest-retry', daemon=True).start()
+        while True:
+            self._slots.acquire()
+            record = self.spool.get()
+            if record is None:
+                self._slots.release()
+                return
+            seq, task = record
+            self._submit(seq, task, 0)
+
+    def _submit(self, seq, task, attempt):
+        try:
+            future = self.dispatcher.submit(task)
+        except RuntimeError as e:
+            # Shut down; the task is still in the spool for the next run
+            logger.warning(f"Could not dispatch spooled task {seq}: {e}")
+            self._slots.release()
+            return
+        future.add_done_callback(lambda f: self._done(seq, task, attempt, f))
+
+    def _done(self, seq, task, attempt, future):
+        if future.cancelled():
+            self._slots.release()
+            return
+        error = future.exception()
+        if error is not None and transient(error):
+            delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+            logger.warning("Spooled task %d for %s failed, dispatching it again in %.1fs: %s",
+                           seq, task['validator_type'], delay, error, extra=logs.SAMPLED)
+            with self._cond:
+                heapq.heappush(self._retries, (time.monotonic() + delay, seq, task, attempt + 1))
+                self._cond.notify()
+            return
+        self.spool.ack(seq)
+        self._slots.release()
+        if self.on_done:
+            self.on_done(task, future)
+
+    def _retry_loop(self):
+        while True:
+            with self._cond:
+                while not self._retries or self._retries[0][0] > time.monotonic():
+                    self._cond.wait(self._retries[0][0] - time.monotonic() if self._retries else None)
+                _, seq, task, attempt = heapq.heappop(self._retries)
+            REQUEUED.labels(task['validator_type']).inc()
+            # Outside the lock, as this blocks while the dispatcher is full
+            self._submit(seq, task, attempt)
+
+
+def ingest(dispatcher, spec=TASK_SOURCES, spool=None, on_done=None):
+    # Runs until the spool is closed
+    spool = spool or Spool()
+    spool.open()
+    status = lambda: {'queued': dispatcher.queue_depth(), 'spooled': spool.pending()}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        make_source(item, spool, status).start()
+    Feeder(spool, dispatcher, on_done=on_done).run()
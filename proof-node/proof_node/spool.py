@@ -0,0 +1,392 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.environ.get('SPOOL_DIR', '/var/spool/proof-node')
+SPOOL_SEGMENT_MAX_BYTES = int(os.environ.get('SPOOL_SEGMENT_MAX_BYTES', 16 * 1024 * 1024))
+SPOOL_GROUP_COMMIT_MAX_RECORDS = int(os.environ.get('SPOOL_GROUP_COMMIT_MAX_RECORDS', 1024))
+# How long the writer lets appends pile up before an fsync that is not full
+SPOOL_COMMIT_WINDOW = float(os.environ.get('SPOOL_COMMIT_WINDOW_MS', 2)) / 1000
+SPOOL_ACK_LOG_MAX_BYTES = int(os.environ.get('SPOOL_ACK_LOG_MAX_BYTES', 1024 * 1024))
+# Seconds before acks that failed to write are tried again
+SPOOL_RETRY_DELAY = float(os.environ.get('SPOOL_RETRY_DELAY', 1))
+
+SEGMENT_NAME = re.compile(r'^(\d{8})\.log$')
+ACK_LOG = 'acks.log'
+OFFSETS = 'offsets.json'
+
+COMMIT_TIME = metrics.Histogram('proof_spool_commit_seconds', 'Time to write and fsync a group of spooled tasks')
+COMMIT_SIZE = metrics.Histogram('proof_spool_commit_records', 'Tasks made durable per fsync',
+                                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+PENDING = metrics.Gauge('proof_spool_pending', 'Spooled tasks not yet acknowledged')
+
+
+class Spool:
+    """Append-only on-disk queue of tasks waiting to be processed.
+
+    Tasks are NDJSON records in segment files, numbered in the order they
+    were spooled. Appends are written and fsynced in groups by one writer
+    thread, and an append's future resolves once its task is durable.
+    Consumers take tasks in order with get() and ack() them when done;
+    acks go to their own log, and a segment is deleted once every task in
+    it has been acknowledged. After a restart, the tasks that were spooled
+    but never acknowledged are handed out again.
+    """
+
+    def __init__(self, directory=SPOOL_DIR, segment_max_bytes=SPOOL_SEGMENT_MAX_BYTES,
+                 commit_window=SPOOL_COMMIT_WINDOW):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.commit_window = commit_window
+        self._cond = threading.Condition()  # guards everything below
+        self._appends = deque()  # (task, source, offset, future)
+        self._acks = []  # acknowledged since the last commit
+        self._segments = []  # segment numbers, oldest first
+        self._last_seq = {}  # segment -> last seq in it
+        self._committed = 0  # durable bytes in the active segment
+        self._next_seq = 0
+        self._watermark = 0  # every seq below this has been acknowledged
+        self._acked = set()  # acknowledged seqs at or above the watermark
+        self._offsets = {}  # source -> offset of its last durable task
+        self._cursor = None  # (segment, offset) of the next record for get()
+        self._reader = None
+        self._active = None
+        self._ack_log = None
+        self._writing = False
+        self._closed = False
+        self._opened = False
+
+    def open(self):
+        with self._cond:
+            if self._opened:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._recover_acks()
+            self._offsets = self._read_offsets()
+            self._segments = sorted(
+                int(match.group(1)) for match in map(SEGMENT_NAME.match, os.listdir(self.directory)) if match
+            )
+            for segment in self._segments:
+                self._recover_segment(segment)
+            if not self._segments:
+                self._segments.append(1)
+            self._next_seq = max([self._watermark - 1, *self._last_seq.values()]) + 1
+            self._active = open(self._path(self._segments[-1]), 'ab')
+            self._committed = self._active.tell()
+            self._ack_log = open(os.path.join(self.directory, ACK_LOG), 'ab')
+            self._cursor = (self._segments[0], 0)
+            self._opened = True
+            pending = self._pending()
+        PENDING.set_function(lambda: self.pending())
+        threading.Thread(target=self._write_loop, name='spool-writer', daemon=True).start()
+        logger.info(f"Opened spool in {self.directory} with {pending} pending tasks "
+                    f"in {len(self._segments)} segments")
+
+    def append(self, task, source=None, offset=None):
+        # Resolves to the task's sequence number once it is durable
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Spool is closed")
+            self._appends.append((task, source, offset, future))
+            self._cond.notify_all()
+        return future
+
+    def get(self, timeout=None):
+        # The next task to process as (seq, task), or None on timeout or close
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                record = self._next_record()
+                if record:
+                    return record
+                if self._closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def ack(self, seq):
+        with self._cond:
+            if seq < self._watermark or seq in self._acked:
+                return
+            self._acked.add(seq)
+            while self._watermark in self._acked:
+                self._acked.remove(self._watermark)
+                self._watermark += 1
+            self._acks.append(seq)
+            self._cond.notify_all()
+
+    def offset(self, source):
+        # Where a source left off, as of its last durable task
+        with self._cond:
+            return self._offsets.get(source, 0)
+
+    def pending(self):
+        with self._cond:
+            return self._pending()
+
+    def close(self):
+        # Flushes what has been appended and acknowledged so far
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            while self._appends or self._acks or self._writing:
+                self._cond.wait()
+
+    def _pending(self):
+        return self._next_seq - self._watermark - len(self._acked)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f'{segment:08d}.log')
+
+    # Recovery
+
+    def _recover_acks(self):
+        path = os.path.join(self.directory, ACK_LOG)
+        if not os.path.exists(path):
+            return
+        offset = 0
+        with open(path, 'rb+') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    f.truncate(offset)
+                    break
+                offset += len(line)
+                entry = json.loads(line)
+                if isinstance(entry, dict):
+                    self._watermark = max(self._watermark, entry['watermark'])
+                else:
+                    self._acked.add(entry)
+        self._acked = {seq for seq in self._acked if seq >= self._watermark}
+        while self._watermark in self._acked:
+            self._acked.remove(self._watermark)
+            self._watermark += 1
+
+    def _recover_segment(self, segment):
+        offset = 0
+        with open(self._path(segment), 'rb+') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Torn write from a crash; the producer never got an ack for it
+                    f.truncate(offset)
+                    logger.warning(f"Truncated partial task at {segment:08d}.log:{offset}")
+                    break
+                offset += len(line)
+                record = json.loads(line)
+                self._last_seq[segment] = record['seq']
+                if record.get('source') is not None:
+                    self._offsets[record['source']] = max(self._offsets.get(record['source'], 0), record['offset'])
+
+    def _read_offsets(self):
+        try:
+            with open(os.path.join(self.directory, OFFSETS)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    # Reading, with the lock held
+
+    def _next_record(self):
+        while True:
+            segment, offset = self._cursor
+            active = segment == self._segments[-1]
+            end = self._committed if active else os.path.getsize(self._path(segment))
+            if offset >= end:
+                if active:
+                    return None
+                self._cursor = (self._segments[self._segments.index(segment) + 1], 0)
+                continue
+            if not self._reader or self._reader.name != self._path(segment):
+                if self._reader:
+                    self._reader.close()
+                self._reader = open(self._path(segment), 'rb')
+            self._reader.seek(offset)
+            line = self._reader.readline()
+            self._cursor = (segment, offset + len(line))
+            record = json.loads(line)
+            seq = record['seq']
+            if seq >= self._watermark and seq not in self._acked:
+                return seq, record['task']
+
+    # Writing
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not (self._appends or self._acks or self._closed):
+                    self._cond.wait()
+                if self._closed and not (self._appends or self._acks):
+                    return
+                if self.commit_window and len(self._appends) < SPOOL_GROUP_COMMIT_MAX_RECORDS:
+                    # Let a burst finish arriving so it shares one fsync
+                    self._cond.wait(self.commit_window)
+                batch = [self._appends.popleft()
+                         for _ in range(min(len(self._appends), SPOOL_GROUP_COMMIT_MAX_RECORDS))]
+                acks, self._acks = self._acks, []
+                self._writing = True
+
+            if batch:
+                self._commit_tasks(batch)
+            if acks:
+                self._commit_acks(acks)
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+    def _commit_tasks(self, batch):
+        # Only this thread moves _next_seq, and only past tasks that are durable
+        first_seq = self._next_seq
+        try:
+            offsets = self._write_tasks(batch, first_seq)
+        except Exception as e:
+            logger.error(f"Failed to write {len(batch)} spooled tasks: {e}")
+            self._reset_active()
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        # The tasks are durable whatever happens here
+        try:
+            if offsets:
+                self._write_offsets(offsets)
+            if self._committed >= self.segment_max_bytes:
+                self._rotate()
+        except Exception as e:
+            logger.error(f"Failed to update the spool after a write: {e}")
+        for index, (_, _, _, future) in enumerate(batch):
+            future.set_result(first_seq + index)
+
+    def _write_tasks(self, batch, first_seq):
+        lines = []
+        offsets = {}
+        for index, (task, source, offset, _) in enumerate(batch):
+            record = {'seq': first_seq + index, 'task': task}
+            if source is not None:
+                record.update(source=source, offset=offset)
+                offsets[source] = offset
+            lines.append(json.dumps(record).encode('utf-8') + b'\n')
+
+        with COMMIT_TIME.time():
+            self._active.write(b''.join(lines))
+            self._active.flush()
+            os.fsync(self._active.fileno())
+        COMMIT_SIZE.observe(len(batch))
+
+        with self._cond:
+            self._committed = self._active.tell()
+            self._next_seq = first_seq + len(batch)
+            self._last_seq[self._segments[-1]] = first_seq + len(batch) - 1
+            self._offsets.update(offsets)
+            return dict(self._offsets) if offsets else None
+
+    def _reset_active(self):
+        # Cuts whatever part of a failed write reached the active segment, so
+        # readers never meet it and the next write starts on a line boundary
+        path = self._path(self._segments[-1])
+        try:
+            self._active.close()
+        except Exception:
+            # Closing flushes the rest of the failed write, and fails the same way
+            pass
+        try:
+            os.truncate(path, self._committed)
+            self._active = open(path, 'ab')
+        except OSError as e:
+            logger.error(f"Failed to reopen {path} after a failed write: {e}")
+
+    def _write_offsets(self, offsets):
+        # Kept apart from the segments, which are deleted once acknowledged
+        path = os.path.join(self.directory, OFFSETS)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(offsets, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _rotate(self):
+        # The new segment is opened first, so a failure leaves the active one in place
+        segment = self._segments[-1] + 1
+        active = open(self._path(segment), 'ab')
+        with self._cond:
+            self._segments.append(segment)
+            previous, self._active = self._active, active
+            self._committed = 0
+        previous.close()
+
+    def _commit_acks(self, acks):
+        position = None
+        try:
+            position = self._ack_log.tell()
+            self._write_acks(acks)
+        except Exception as e:
+            logger.error(f"Failed to write {len(acks)} acks, retrying: {e}")
+            self._reset_ack_log(position)
+            with self._cond:
+                self._acks[:0] = acks
+            # Not straight away, in case the disk is full
+            time.sleep(SPOOL_RETRY_DELAY)
+            return
+
+        # Only once the acks are durable can the tasks they cover go
+        try:
+            self._release_segments()
+            if self._ack_log.tell() >= SPOOL_ACK_LOG_MAX_BYTES:
+                self._compact_acks()
+        except Exception as e:
+            logger.error(f"Failed to clean up the spool after writing acks: {e}")
+
+    def _write_acks(self, acks):
+        self._ack_log.write(b''.join(b'%d\n' % seq for seq in acks))
+        self._ack_log.flush()
+        os.fsync(self._ack_log.fileno())
+
+    def _reset_ack_log(self, position):
+        path = os.path.join(self.directory, ACK_LOG)
+        try:
+            self._ack_log.close()
+        except Exception:
+            pass
+        try:
+            if position is not None:
+                os.truncate(path, position)
+            self._ack_log = open(path, 'ab')
+        except OSError as e:
+            logger.error(f"Failed to reopen {path} after a failed write: {e}")
+
+    def _release_segments(self):
+        with self._cond:
+            done = [segment for segment in self._segments[:-1]
+                    if self._last_seq.get(segment, -1) < self._watermark and segment < self._cursor[0]]
+            self._segments = [segment for segment in self._segments if segment not in done]
+            for segment in done:
+                self._last_seq.pop(segment, None)
+        for segment in done:
+            os.remove(self._path(segment))
+
+    def _compact_acks(self):
+        # Everything below the watermark needs no more than one line
+        with self._cond:
+            watermark = self._watermark
+            acked = sorted(self._acked)
+        path = os.path.join(self.directory, ACK_LOG)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(json.dumps({'watermark': watermark}).encode('utf-8') + b'\n')
+            f.write(b''.join(b'%d\n' % seq for seq in acked))
+            f.flush()
+            os.fsync(f.fileno())
+        self._ack_log.close()
+        try:
+            os.replace(path + '.tmp', path)
+        finally:
+            self._ack_log = open(path, 'ab')
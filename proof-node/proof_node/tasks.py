@@ -0,0 +1,27 @@
+import random
+
+def generate_task(rng=random):
+    task = rng.choice([
+        {
+            "validator_type": "doordash",
+            "data": {
+                "id": str(rng.randint(1, 1000)),
+                "name": f"User {rng.randint(1, 100)}",
+                "email": f"user{rng.randint(1, 100)}@example.com",
+                "phone": f"{rng.randint(1000000000, 9999999999)}"
+            }
+        },
+        {
+            "validator_type": "analytics",
+            "data": {
+                "duration": rng.randint(30, 300),
+                "pages": [f"page_{rng.randint(1, 10)}" for _ in range(rng.randint(1, 10))] +
+                         rng.choice([["cart"], ["checkout"], ["buy"], []])
+            }
+        }
+    ])
+
+    if task["validator_type"] == "doordash" and rng.random() < 0.2:
+        task["data"].pop("phone", None)
+
+    return task
@@ -0,0 +1,207 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from proof_node import backends
+from proof_node.backends import HttpBackend, LatencyTracker, RetryBudget, ValidationError, refused
+
+
+class Validator:
+    # A validator server answering with the given statuses in turn, then 200
+    def __init__(self, statuses=(), delay=0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.requests = 0
+        validator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                validator.requests += 1
+                time.sleep(validator.delay)
+                status = validator.statuses.pop(0) if validator.statuses else 200
+                body = json.dumps({'is_valid': True} if status == 200 else {'error': 'busy'}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.port = self.server.server_address[1]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Pool:
+    # Hands out replicas in order, skipping those excluded
+    def __init__(self, ports, deterministic=False):
+        self.replicas_ = [
+            SimpleNamespace(name=f'analytics-proof-{i}', endpoint=SimpleNamespace(ip='127.0.0.1', port=port,
+                                                                                  container_id=str(i)))
+            for i, port in enumerate(ports)
+        ]
+        self.deterministic_ = deterministic
+        self.acquired = 0
+
+    def acquire(self, validator_type, timeout=0, exclude=()):
+        self.acquired += 1
+        return next((r for r in self.replicas_ if r not in exclude), None)
+
+    def release(self, replica, latency=None):
+        pass
+
+    def replicas(self, validator_type):
+        return len(self.replicas_)
+
+    def deterministic(self, validator_type):
+        return self.deterministic_
+
+    def version(self, validator_type):
+        return None
+
+    def shutdown(self):
+        pass
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def task(timeout=5):
+    return {'validator_type': 'analytics', 'data': {'duration': 90}, 'timeout': timeout}
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(backends, 'RETRY_BASE_DELAY', 0.001)
+
+
+@pytest.fixture
+def validators():
+    started = []
+
+    def start(*args, **kwargs):
+        started.append(Validator(*args, **kwargs))
+        return started[-1]
+
+    yield start
+    for validator in started:
+        validator.close()
+
+
+def test_refused_looks_through_wrapped_errors():
+    with pytest.raises(requests.exceptions.ConnectionError) as info:
+        requests.post(f'http://127.0.0.1:{closed_port()}/', timeout=1)
+    assert refused(info.value)
+    assert not refused(requests.exceptions.ConnectionError('Connection reset by peer'))
+
+
+def test_retry_budget_is_earned_per_task_up_to_burst():
+    budget = RetryBudget(ratio=0.5, burst=2)
+    assert budget.withdraw('analytics') and budget.withdraw('analytics')
+    assert not budget.withdraw('analytics')
+    budget.deposit('analytics')
+    assert not budget.withdraw('analytics')
+    budget.deposit('analytics')
+    assert budget.withdraw('analytics')
+    assert budget.withdraw('doordash')
+
+
+def test_latency_tracker_reports_its_quantile_once_it_has_enough_samples():
+    tracker = LatencyTracker(quantile=0.9, window=100, min_samples=10, every=1)
+    for ms in range(9):
+        tracker.observe('analytics', ms / 1000)
+    assert tracker.get('analytics') is None
+    for ms in range(9, 100):
+        tracker.observe('analytics', ms / 1000)
+    assert tracker.get('analytics') == 0.09
+
+
+def test_validator_not_taking_work_is_retried(validators):
+    validator = validators(statuses=[503, 503])
+    backend = HttpBackend(Pool([validator.port]))
+
+    assert backend.process_task(task()) is True
+    assert validator.requests == 3
+
+
+def test_refused_connection_is_retried_up_to_max_attempts():
+    pool = Pool([closed_port()])
+    backend = HttpBackend(pool)
+
+    with pytest.raises(ValidationError) as info:
+        backend.process_task(task())
+    assert info.value.retryable
+    assert pool.acquired == backends.RETRY_MAX_ATTEMPTS
+
+
+def test_final_errors_are_not_retried(validators):
+    validator = validators(statuses=[400])
+    backend = HttpBackend(Pool([validator.port]))
+
+    with pytest.raises(ValidationError) as info:
+        backend.process_task(task())
+    assert info.value.reason == 'http_400' and not info.value.retryable
+    assert validator.requests == 1
+
+
+def test_retries_stop_when_the_budget_runs_out(validators):
+    validator = validators(statuses=[503] * 10)
+    backend = HttpBackend(Pool([validator.port]))
+    backend.retries = RetryBudget(ratio=0, burst=1)
+
+    with pytest.raises(ValidationError):
+        backend.process_task(task())
+    assert validator.requests == 2
+    with pytest.raises(ValidationError):
+        backend.process_task(task())
+    assert validator.requests == 3
+
+
+def test_retries_stop_at_the_deadline(validators, monkeypatch):
+    monkeypatch.setattr(backends, 'backoff', lambda attempt: 1)
+    validator = validators(statuses=[503] * 10)
+    backend = HttpBackend(Pool([validator.port]))
+
+    with pytest.raises(ValidationError):
+        backend.process_task(task(timeout=0.5))
+    assert validator.requests == 1
+
+
+def test_slow_request_is_hedged_on_a_second_replica(validators):
+    slow, fast = validators(delay=2), validators()
+    backend = HttpBackend(Pool([slow.port, fast.port], deterministic=True))
+    backend.latency = LatencyTracker(min_samples=1, every=1)
+    backend.latency.observe('analytics', 0.01)
+
+    started = time.monotonic()
+    assert backend.process_task(task()) is True
+    assert time.monotonic() - started < 1
+    assert (slow.requests, fast.requests) == (1, 1)
+    backend.shutdown()
+
+
+def test_nondeterministic_validators_are_not_hedged(validators):
+    slow, fast = validators(delay=0.3), validators()
+    backend = HttpBackend(Pool([slow.port, fast.port]))
+    backend.latency = LatencyTracker(min_samples=1, every=1)
+    backend.latency.observe('analytics', 0.01)
+
+    assert backend.process_task(task()) is True
+    assert (slow.requests, fast.requests) == (1, 0)
+    backend.shutdown()
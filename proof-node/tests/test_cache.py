@@ -0,0 +1,76 @@
+from proof_node.backends import Backend
+from proof_node.cache import ResultCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingBackend(Backend):
+    # A deterministic validator that says every task is valid under version v1
+    # and invalid under any other
+    def __init__(self):
+        super().__init__()
+        self.cache = ResultCache()
+        self.current_version = 'v1'
+        self.calls = 0
+
+    def deterministic(self, validator_type):
+        return True
+
+    def version(self, validator_type):
+        return self.current_version
+
+    def _process_task(self, task, deadline):
+        self.calls += 1
+        result = self.current_version == 'v1'
+        self._remember(task, result)
+        return result
+
+
+def test_equal_payloads_share_an_entry_whatever_their_key_order():
+    cache = ResultCache()
+    cache.put('analytics', {'duration': 90, 'pages': ['a']}, True)
+    assert cache.get('analytics', {'pages': ['a'], 'duration': 90}) == (True, True)
+    assert cache.get('doordash', {'pages': ['a'], 'duration': 90}) == (False, None)
+
+
+def test_least_recently_used_and_expired_results_go():
+    clock = Clock()
+    cache = ResultCache(max_entries=2, ttl=10, clock=clock)
+    cache.put('analytics', 1, True)
+    cache.put('analytics', 2, False)
+    cache.get('analytics', 1)
+    cache.put('analytics', 3, True)
+    assert cache.get('analytics', 2) == (False, None)
+    assert cache.get('analytics', 1) == (True, True)
+    clock.now = 10
+    assert cache.get('analytics', 3) == (False, None)
+    assert cache.stats()['evictions'] == {'size': 1, 'expired': 1}
+
+
+def test_a_new_version_drops_the_types_results():
+    cache = ResultCache()
+    cache.put('analytics', 1, True, 'v1')
+    cache.put('doordash', 1, True)
+    assert cache.get('analytics', 1, 'v1') == (True, True)
+    assert cache.get('analytics', 1, 'v2') == (False, None)
+    assert len(cache) == 1
+    assert cache.get('doordash', 1) == (True, True)
+    assert cache.stats()['evictions'] == {'version': 1}
+
+
+def test_backend_stops_serving_results_of_an_old_version():
+    backend = CountingBackend()
+    task = {'validator_type': 'analytics', 'data': {'duration': 90}}
+    assert backend.process_task(task) is True
+    assert backend.process_task(task) is True
+    assert backend.calls == 1
+    backend.current_version = 'v2'
+    assert backend.process_task(task) is False
+    assert backend.process_batch([task, task]) == [False, False]
+    assert backend.calls == 2
@@ -0,0 +1,158 @@
+import random
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from proof_node.coordinator import HashRing, LocalCluster, NodeLink, Router
+from proof_node.sources import SocketSource
+from proof_node.spool import Spool
+from proof_node.tasks import generate_task
+
+KEYS = [f'type-{i}' for i in range(5000)]
+
+
+def owners(ring):
+    return {key: ring.owner(key) for key in KEYS}
+
+
+def test_join_only_moves_keys_to_the_new_node():
+    ring = HashRing()
+    for i in range(4):
+        ring.add(f'node-{i}')
+    before = owners(ring)
+    ring.add('node-4')
+    after = owners(ring)
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert {after[key] for key in moved} == {'node-4'}
+    assert 0.1 < len(moved) / len(KEYS) < 0.3
+
+
+def test_leave_only_moves_the_keys_of_the_node_that_left():
+    ring = HashRing()
+    for i in range(5):
+        ring.add(f'node-{i}')
+    before = owners(ring)
+    ring.remove('node-2')
+    after = owners(ring)
+
+    assert 'node-2' not in ring
+    assert [key for key in KEYS if before[key] != after[key]] == [key for key in KEYS if before[key] == 'node-2']
+
+
+def test_owners_do_not_depend_on_join_order():
+    nodes = [f'node-{i}' for i in range(5)]
+    first, second = HashRing(), HashRing()
+    for node in nodes:
+        first.add(node)
+    for node in reversed(nodes):
+        second.add(node)
+    assert owners(first) == owners(second)
+    assert sum(first.shares().values()) == pytest.approx(1)
+
+
+class FailingSocket:
+    # The reader fails the link while a send is under way
+    def __init__(self, link):
+        self.link = link
+
+    def sendall(self, data):
+        self.link._failed(self, ConnectionError('reader failed'))
+        raise OSError('broken pipe')
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_task_taken_over_by_a_failing_reader_is_not_sent_twice():
+    handed_over = []
+    link = NodeLink('unix:/nonexistent', lambda link, pending: handed_over.extend(pending))
+    link._sock = FailingSocket(link)
+    link.up = True
+    future = Future()
+
+    link.send({'validator_type': 'analytics', 'data': {}}, future)
+    assert [f for _, f in handed_over] == [future]
+    assert not link.up
+
+
+def test_answer_for_a_resolved_future_keeps_the_link_up(tmp_path):
+    path = str(tmp_path / 'node.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    def node():
+        conn, _ = server.accept()
+        with conn, conn.makefile('rb') as reader:
+            for seq, _ in enumerate(reader):
+                conn.sendall(b'{"seq": %d}\n' % seq)
+
+    threading.Thread(target=node, daemon=True).start()
+    failures = []
+    link = NodeLink(f'unix:{path}', lambda link, pending: failures.append(pending))
+    link.connect()
+
+    # Resolved elsewhere, as when a resend won the race
+    answered = Future()
+    answered.set_result('another node')
+    link.send({'validator_type': 'analytics', 'data': {}}, answered)
+    later = Future()
+    link.send({'validator_type': 'analytics', 'data': {}}, later)
+
+    assert later.result(5) == f'unix:{path}'
+    assert link.up and not failures
+    link.close(0)
+
+
+def test_router_reports_the_load_nodes_give_after_their_tasks(tmp_path):
+    path = str(tmp_path / 'node.sock')
+    spool = Spool(str(tmp_path / 'spool'))
+    spool.open()
+    SocketSource(spool, path, status=lambda: {'queued': 7, 'spooled': spool.pending()}).start()
+    router = Router(retry_interval=0.05, status_interval=3600)
+    router.start()
+    router.join(f'unix:{path}')
+
+    futures = [router.submit({'validator_type': 'analytics', 'data': {}}) for _ in range(3)]
+    router.poll_status()
+    assert all(future.done() for future in futures)
+    status = router.status()[f'unix:{path}']
+    assert (status['queued'], status['spooled'], status['unanswered']) == (7, 3, 0)
+    router.leave(f'unix:{path}')
+    spool.close()
+
+
+def test_local_cluster_routes_by_type_and_survives_a_leave(tmp_path):
+    cluster = LocalCluster(tmp_path, env={'LOG_LEVEL': 'WARNING'})
+    router = Router(retry_interval=0.2)
+    router.start()
+    try:
+        nodes = [cluster.start_node() for _ in range(2)]
+        for node in nodes:
+            router.join(node)
+        # Nodes take a few seconds to start their validators and take tasks
+        deadline = time.monotonic() + 60
+        while not all(link.up for link in router.links()) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        rng = random.Random(1)
+        tasks = [generate_task(rng) for _ in range(20)]
+        routed = [(task, router.submit(task)) for task in tasks]
+        for task, future in routed:
+            assert future.result(30) == router.ring.owner(task['validator_type'])
+
+        status = router.status()
+        assert sum(sum(node['forwarded'].values()) for node in status.values()) == len(tasks)
+        assert all(node['up'] for node in status.values())
+
+        router.leave(nodes[0])
+        for task in tasks[:5]:
+            assert router.submit(task).result(30) == nodes[1]
+    finally:
+        cluster.stop()
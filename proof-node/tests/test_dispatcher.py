@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from proof_node.dispatcher import Dispatcher, parse_limits
+
+
+def task(validator_type, n=0):
+    return {'validator_type': validator_type, 'data': {'n': n}}
+
+
+def test_parse_limits():
+    assert parse_limits(' doordash=4, analytics=8,') == {'doordash': 4, 'analytics': 8}
+    assert parse_limits(None) == {}
+
+
+def test_saturated_type_does_not_hold_up_the_others():
+    release = threading.Event()
+
+    def handler(task):
+        if task['validator_type'] == 'doordash':
+            release.wait(5)
+        return True
+
+    dispatcher = Dispatcher(handler, workers=4, limits={'doordash': 1})
+    slow = [dispatcher.submit(task('doordash', n)) for n in range(3)]
+    fast = [dispatcher.submit(task('analytics', n)) for n in range(5)]
+
+    for future in fast:
+        assert future.result(5) is True
+    assert dispatcher.inflight('doordash') == 1
+    assert dispatcher.queue_depth('doordash') == 2
+    release.set()
+    assert [future.result(5) for future in slow] == [True] * 3
+    dispatcher.shutdown()
+
+
+def test_full_queue_rejects_or_blocks():
+    release = threading.Event()
+    dispatcher = Dispatcher(lambda task: release.wait(5), workers=1, max_queue=2)
+    futures = [dispatcher.submit(task('analytics', n)) for n in range(2)]
+
+    with pytest.raises(queue.Full):
+        dispatcher.submit(task('analytics'), block=False)
+    with pytest.raises(queue.Full):
+        dispatcher.submit(task('analytics'), timeout=0.05)
+    release.set()
+    assert all(future.result(5) for future in futures)
+    assert dispatcher.submit(task('analytics'), timeout=5).result(5)
+    dispatcher.shutdown()
+
+
+def test_tasks_of_a_type_are_batched_up_to_batch_size():
+    batches = []
+
+    def batch_handler(tasks):
+        batches.append([task['data']['n'] for task in tasks])
+        return [task['data']['n'] % 2 == 0 for task in tasks]
+
+    dispatcher = Dispatcher(lambda task: True, workers=1, batch_handler=batch_handler,
+                            batch_size=4, batch_window=5)
+    futures = [dispatcher.submit(task('analytics', n)) for n in range(8)]
+
+    assert [future.result(5) for future in futures] == [n % 2 == 0 for n in range(8)]
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    dispatcher.shutdown()
+
+
+def test_partial_batch_runs_once_its_window_passes():
+    batches = []
+
+    def batch_handler(tasks):
+        batches.append(len(tasks))
+        return [True] * len(tasks)
+
+    dispatcher = Dispatcher(lambda task: True, workers=2, batch_handler=batch_handler, batch_size=10,
+                            batch_window=0.1)
+    started = time.monotonic()
+    futures = [dispatcher.submit(task('analytics', n)) for n in range(3)]
+
+    assert all(future.result(5) for future in futures)
+    assert time.monotonic() - started >= 0.1
+    assert batches == [3]
+    dispatcher.shutdown()
+
+
+def test_failure_in_a_batch_only_fails_its_own_task():
+    def batch_handler(tasks):
+        return [ValueError('bad record') if task['data']['n'] == 1 else True for task in tasks]
+
+    dispatcher = Dispatcher(lambda task: True, workers=1, batch_handler=batch_handler, batch_size=3,
+                            batch_window=5)
+    futures = [dispatcher.submit(task('analytics', n)) for n in range(3)]
+
+    assert futures[0].result(5) is True
+    with pytest.raises(ValueError, match='bad record'):
+        futures[1].result(5)
+    assert futures[2].result(5) is True
+    dispatcher.shutdown()
+
+
+def test_shutdown_runs_what_is_queued_then_refuses_more():
+    dispatcher = Dispatcher(lambda task: True, workers=1, batch_handler=lambda tasks: [True] * len(tasks),
+                            batch_size=10, batch_window=60)
+    futures = [dispatcher.submit(task('analytics', n)) for n in range(3)]
+
+    dispatcher.shutdown()
+    assert all(future.done() and future.result() for future in futures)
+    with pytest.raises(RuntimeError):
+        dispatcher.submit(task('analytics'))
@@ -0,0 +1,38 @@
+import logging
+import queue
+
+from proof_node.logs import _QueueHandler, _RedactingFormatter
+
+
+def record(message, *args, exc_info=None):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, message, args, exc_info)
+
+
+def test_messages_are_formatted_when_logged():
+    log_queue = queue.Queue()
+    handler = _QueueHandler(log_queue)
+    state = {'inflight': 1}
+    handler.handle(record("Pool state: %s", state))
+    state['inflight'] = 2
+    queued = log_queue.get_nowait()
+    assert queued.getMessage() == "Pool state: {'inflight': 1}"
+    assert queued.args is None
+
+
+def test_tracebacks_travel_with_the_message():
+    log_queue = queue.Queue()
+    handler = _QueueHandler(log_queue)
+    try:
+        raise ValueError("bad record")
+    except ValueError as e:
+        handler.handle(record("Failed: %s", e, exc_info=(type(e), e, e.__traceback__)))
+    queued = log_queue.get_nowait()
+    assert queued.exc_info is None
+    assert 'ValueError: bad record' in queued.getMessage()
+
+
+def test_secrets_are_redacted_by_the_writer(monkeypatch):
+    monkeypatch.setattr('proof_node.logs._secrets', {'hunter22'})
+    log_queue = queue.Queue()
+    _QueueHandler(log_queue).handle(record("Using key %s", 'hunter22'))
+    assert _RedactingFormatter('%(message)s').format(log_queue.get_nowait()) == "Using key [REDACTED]"
@@ -0,0 +1,229 @@
+import itertools
+import time
+
+import docker
+import pytest
+
+from proof_node import pool as pool_module
+from proof_node import registry as registry_module
+from proof_node.pool import ACTIVE, PAUSED, STOPPED, ValidatorPool
+from proof_node.registry import VALIDATOR_TYPE_LABEL, EndpointRegistry
+
+
+class Container:
+    def __init__(self, client, name, validator_type, host_port, status='running'):
+        self.client = client
+        self.id = f'{name}-{next(client.ids)}'
+        self.name = name
+        self.labels = {VALIDATOR_TYPE_LABEL: validator_type}
+        self.ip = f'10.0.0.{next(client.ips)}'
+        self.host_port = host_port
+        self.status = status
+        self.removed = False
+        self.reload()
+
+    def reload(self):
+        if self.removed:
+            raise docker.errors.NotFound(f"No such container: {self.id}")
+        self.attrs = {
+            'Id': self.id,
+            'Name': f'/{self.name}',
+            'Config': {'Labels': self.labels},
+            'NetworkSettings': {'IPAddress': self.ip if self.status in ('running', 'paused') else ''},
+            'State': {'Running': self.status in ('running', 'paused'), 'Paused': self.status == 'paused'},
+            'HostConfig': {'PortBindings': {'8000/tcp': [{'HostPort': str(self.host_port)}]}},
+        }
+
+    def start(self):
+        self.status = 'running'
+
+    def stop(self):
+        self.status = 'exited'
+
+    def pause(self):
+        self.status = 'paused'
+
+    def unpause(self):
+        self.status = 'running'
+
+    def remove(self, force=False):
+        self.removed = True
+        self.client.removed.append(self.name)
+
+    def stats(self, stream=False):
+        return {'memory_stats': {'usage': 0}}
+
+
+class DockerClient:
+    # Just enough of docker.DockerClient for the pool, with containers that
+    # are healthy while running unless listed in unhealthy
+    def __init__(self, deterministic=True):
+        self.ids = itertools.count(1)
+        self.ips = itertools.count(2)
+        self.deterministic = deterministic
+        self.all = []
+        self.removed = []
+        self.unhealthy = set()
+        self.containers = self
+
+    def add(self, name, validator_type, host_port, status='running'):
+        container = Container(self, name, validator_type, host_port, status)
+        self.all.append(container)
+        return container
+
+    def list(self, all=False, filters=None):
+        return [c for c in self.all if not c.removed and (all or c.status == 'running')]
+
+    def run(self, name, labels, ports, **kwargs):
+        return self.add(name, labels[VALIDATOR_TYPE_LABEL], ports['8000/tcp'])
+
+    def health(self, ip):
+        for container in self.all:
+            if container.ip == ip and container.status == 'running' and not container.removed:
+                if container.name in self.unhealthy:
+                    return None
+                return {'ready': True, 'deterministic': self.deterministic}
+        return None
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = DockerClient()
+    probe = lambda ip, port=None, timeout=1: client.health(ip)
+    monkeypatch.setattr(registry_module, 'probe_health', probe)
+    monkeypatch.setattr(pool_module, 'probe_health', probe)
+    return client
+
+
+def make_pool(client, **kwargs):
+    pool = ValidatorPool(client, EndpointRegistry(), **kwargs)
+    pool.start()
+    return pool
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_adopted_validators_are_probed_before_use(client):
+    container = client.add('analytics-proof-0', 'analytics', 8000)
+    pool = make_pool(client)
+    try:
+        replica = pool.acquire('analytics', timeout=5)
+        assert replica.id == container.id
+        assert replica.state == ACTIVE
+        # Learned from the adopted replica's /healthz, without starting another
+        assert pool.deterministic('analytics')
+        assert len(client.all) == 1
+        pool.release(replica)
+    finally:
+        pool.shutdown()
+
+
+def test_adopted_validators_that_do_not_answer_are_removed(client):
+    client.add('analytics-proof-0', 'analytics', 8000)
+    client.unhealthy.add('analytics-proof-0')
+    pool = make_pool(client)
+    try:
+        # Crashes while it is probed
+        client.all[0].status = 'exited'
+        wait_for(lambda: client.removed == ['analytics-proof-0'])
+        assert pool.stats().get('analytics', {}).get('starting', 0) == 0
+        assert not pool.deterministic('analytics')
+    finally:
+        pool.shutdown()
+
+
+@pytest.fixture
+def scaler(monkeypatch):
+    # The tests run the scaler themselves, with replicas idle at once
+    monkeypatch.setattr(pool_module, 'SCALE_INTERVAL', 3600)
+    monkeypatch.setattr(pool_module, 'PAUSE_AFTER_IDLE', 0)
+    monkeypatch.setattr(pool_module, 'STOP_AFTER_IDLE', 0)
+    monkeypatch.setattr(pool_module, 'REMOVE_AFTER_IDLE', 0)
+
+
+def states(pool, validator_type):
+    return sorted(r.state for r in pool._replicas.values() if r.validator_type == validator_type)
+
+
+def test_backlog_scales_a_type_up_to_its_replica_limit(client, scaler):
+    pool = make_pool(client, max_validators=3, max_replicas_per_type=2)
+    try:
+        replica = pool.acquire('analytics', timeout=5)
+        pool.queue_depth = lambda validator_type: 10
+        for _ in range(3):
+            pool._scale()
+            wait_for(lambda: not pool.stats()['analytics']['starting'])
+        assert pool.replicas('analytics') == 2
+        assert pool.capacity('analytics') == 2 * pool_module.REPLICA_CONCURRENCY
+        assert len(client.all) == 2
+        pool.release(replica)
+    finally:
+        pool.shutdown()
+
+
+def test_full_pool_evicts_another_types_idle_replica_by_pausing_it(client, scaler):
+    pool = make_pool(client, max_validators=1)
+    try:
+        pool.release(pool.acquire('analytics', timeout=5))
+        doordash = pool.acquire('doordash', timeout=5)
+        assert doordash.validator_type == 'doordash'
+        wait_for(lambda: states(pool, 'analytics') == [PAUSED])
+        assert [c.status for c in client.all] == ['paused', 'running']
+        pool.release(doordash)
+
+        # Demand for analytics unpauses its replica instead of starting another
+        analytics = pool.acquire('analytics', timeout=5)
+        assert analytics.id == client.all[0].id
+        wait_for(lambda: states(pool, 'doordash') == [PAUSED])
+        assert [c.status for c in client.all] == ['running', 'paused']
+        pool.release(analytics)
+    finally:
+        pool.shutdown()
+
+
+def test_idle_replicas_are_paused_then_stopped_then_removed(client, scaler):
+    pool = make_pool(client)
+    try:
+        pool.release(pool.acquire('analytics', timeout=5))
+        container = client.all[0]
+
+        pool._scale()
+        wait_for(lambda: states(pool, 'analytics') == [PAUSED])
+        assert container.status == 'paused'
+        pool._scale()
+        wait_for(lambda: states(pool, 'analytics') == [STOPPED])
+        assert container.status == 'exited'
+
+        # A stopped replica is started again rather than recreated
+        pool.release(pool.acquire('analytics', timeout=5))
+        assert client.all == [container] and container.status == 'running'
+
+        for _ in range(3):
+            pool._scale()
+            wait_for(lambda: pool_module.PAUSING not in states(pool, 'analytics') and
+                     pool_module.STOPPING not in states(pool, 'analytics'))
+        assert states(pool, 'analytics') == []
+        assert client.removed == [container.name]
+    finally:
+        pool.shutdown()
+
+
+def test_hibernated_replicas_beyond_the_limit_are_removed(client, scaler, monkeypatch):
+    for name in ('PAUSE_AFTER_IDLE', 'STOP_AFTER_IDLE', 'REMOVE_AFTER_IDLE'):
+        monkeypatch.setattr(pool_module, name, 3600)
+    pool = make_pool(client, max_validators=1, max_hibernated_validators=0)
+    try:
+        pool.release(pool.acquire('analytics', timeout=5))
+        pool.release(pool.acquire('doordash', timeout=5))
+        wait_for(lambda: states(pool, 'analytics') == [PAUSED])
+
+        pool._scale()
+        assert states(pool, 'analytics') == []
+        assert client.removed == [client.all[0].name]
+    finally:
+        pool.shutdown()
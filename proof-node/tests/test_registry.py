@@ -0,0 +1,136 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from proof_node import registry as registry_module
+from proof_node.registry import VALIDATOR_TYPE_LABEL, EndpointRegistry
+
+
+def attrs(container_id, validator_type='analytics', ip='10.0.0.2', running=True):
+    return {
+        'Id': container_id,
+        'Name': f'/{validator_type}-proof-1',
+        'Config': {'Labels': {VALIDATOR_TYPE_LABEL: validator_type}},
+        'NetworkSettings': {'IPAddress': ip},
+        'State': {'Running': running, 'Paused': False},
+    }
+
+
+class Container:
+    def __init__(self, container_attrs):
+        self.id = container_attrs['Id']
+        self.attrs = container_attrs
+
+
+class EventStream:
+    # Blocks like the Docker event stream until an event or close()
+    def __init__(self):
+        self.events = queue.Queue()
+        self.closed = False
+
+    def __iter__(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        self.closed = True
+        self.events.put(None)
+
+
+class DockerClient:
+    def __init__(self):
+        self.running = {}  # container id -> attrs
+        self.streams = []
+        self.api = self
+        self.containers = self
+
+    def events(self, decode, filters):
+        stream = EventStream()
+        self.streams.append(stream)
+        return stream
+
+    def list(self, filters):
+        assert filters == {'label': VALIDATOR_TYPE_LABEL, 'status': 'running'}
+        return [Container(container_attrs) for container_attrs in self.running.values()]
+
+    def inspect_container(self, container_id):
+        return self.running[container_id]
+
+
+@pytest.fixture(autouse=True)
+def healthy(monkeypatch):
+    monkeypatch.setattr(registry_module, 'probe_health', lambda ip, port=None: {'ready': True})
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_connecting_keeps_endpoints_the_node_registered():
+    client = DockerClient()
+    client.running['adopted'] = attrs('adopted')
+    endpoints = EndpointRegistry()
+    endpoints.put_container(client.running['adopted'])
+    endpoints.watch(client)
+    try:
+        wait_for(lambda: client.streams)
+        time.sleep(0.1)
+        assert endpoints.lookup('adopted') is not None
+    finally:
+        endpoints.stop()
+
+
+def test_reconnecting_resyncs_with_running_containers():
+    client = DockerClient()
+    client.running['kept'] = attrs('kept')
+    endpoints = EndpointRegistry()
+    for container_id in ('kept', 'died'):
+        endpoints.put_container(attrs(container_id))
+    endpoints.watch(client)
+    try:
+        wait_for(lambda: len(client.streams) == 1)
+        # Events missed while the stream was down
+        client.running['started'] = attrs('started', 'doordash', '10.0.0.3')
+        client.streams[0].close()
+        wait_for(lambda: endpoints.lookup('started') is not None)
+        assert endpoints.lookup('started').validator_type == 'doordash'
+        assert endpoints.lookup('kept') is not None
+        assert endpoints.lookup('died') is None
+    finally:
+        endpoints.stop()
+
+
+def test_events_update_endpoints():
+    client = DockerClient()
+    endpoints = EndpointRegistry()
+    endpoints.watch(client)
+    try:
+        wait_for(lambda: client.streams)
+        client.running['new'] = attrs('new')
+        client.streams[0].events.put({'Type': 'container', 'Action': 'start', 'Actor': {
+            'ID': 'new', 'Attributes': {VALIDATOR_TYPE_LABEL: 'analytics'}}})
+        wait_for(lambda: endpoints.lookup('new') is not None)
+        client.streams[0].events.put({'Type': 'container', 'Action': 'pause', 'Actor': {'ID': 'new'}})
+        wait_for(lambda: endpoints.lookup('new') is None)
+    finally:
+        endpoints.stop()
+
+
+def test_stop_ends_the_watcher():
+    client = DockerClient()
+    endpoints = EndpointRegistry()
+    endpoints.watch(client)
+    wait_for(lambda: client.streams)
+    watcher = endpoints._watcher
+    endpoints.stop()
+    assert not watcher.is_alive()
+    assert client.streams[-1].closed
+    assert not [thread for thread in threading.enumerate() if thread.name == 'docker-events']
@@ -0,0 +1,35 @@
+import ast
+from pathlib import Path
+
+import pytest
+
+# The validators' images are built from proof-tasks, so they carry their own
+# copies of these modules. The node's copies add the client side of framing
+# and the metrics endpoint; whatever both define has to stay the same.
+NODE_DIR = Path(__file__).resolve().parents[1] / 'proof_node'
+TASKS_DIR = Path(__file__).resolve().parents[2] / 'proof-tasks' / 'common'
+
+
+def definitions(path):
+    found = {}
+    for node in ast.parse(path.read_text()).body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            found[node.name] = ast.dump(node)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    found[target.id] = ast.dump(node.value)
+    return found
+
+
+@pytest.mark.parametrize('module', ['framing', 'logs', 'metrics'])
+def test_shared_definitions_match(module):
+    node = definitions(NODE_DIR / f'{module}.py')
+    tasks = definitions(TASKS_DIR / f'{module}.py')
+    shared = node.keys() & tasks.keys()
+    assert shared
+    assert [name for name in sorted(shared) if node[name] != tasks[name]] == []
+
+
+def test_logs_are_one_module():
+    assert (NODE_DIR / 'logs.py').read_text() == (TASKS_DIR / 'logs.py').read_text()
@@ -0,0 +1,47 @@
+from proof_node import sizing
+
+TEMPLATE = '''sgx.enclave_size = "512M"
+sgx.max_threads = 11
+
+loader.env.SGX_MAX_THREADS = "8"
+'''
+
+
+def write_template(tasks_dir, validator_type='doordash'):
+    (tasks_dir / validator_type).mkdir(parents=True)
+    (tasks_dir / validator_type / sizing.MANIFEST).write_text(TEMPLATE)
+
+
+def test_enclave_size_is_a_power_of_two():
+    assert sizing.enclave_size(36 * sizing.MB, 0.5, 64) == '128M'
+    assert sizing.enclave_size(400 * sizing.MB, 0.5, 64) == '1G'
+
+
+def test_max_threads_covers_the_budget_and_gramine_helpers(tmp_path):
+    write_template(tmp_path)
+    # A benchmark that never filled the lazily grown worker pool
+    peaks = {'doordash': {'rss_bytes': 41 * sizing.MB, 'threads': 6, 'open_files': 17}}
+    sized = sizing.write_manifests(peaks, tmp_path, tmp_path / 'out', thread_headroom=0)
+
+    text = (tmp_path / 'out' / 'doordash' / sizing.MANIFEST).read_text()
+    assert sized['doordash']['max_threads'] == 8 + sizing.GRAMINE_HELPER_THREADS
+    assert f"sgx.max_threads = {8 + sizing.GRAMINE_HELPER_THREADS}\n" in text
+    assert 'sgx.enclave_size = "128M"\n' in text
+    assert 'loader.env.SGX_MAX_THREADS = "8"\n' in text
+
+
+def test_threads_over_the_budget_raise_max_threads(tmp_path):
+    write_template(tmp_path)
+    peaks = {'doordash': {'rss_bytes': 41 * sizing.MB, 'threads': 10, 'open_files': 17}}
+    sized = sizing.write_manifests(peaks, tmp_path, tmp_path, thread_headroom=1)
+    assert sized['doordash']['max_threads'] == 10 + sizing.GRAMINE_HELPER_THREADS + 1
+
+
+def test_sizing_in_place_twice_keeps_one_header(tmp_path):
+    write_template(tmp_path)
+    peaks = {'doordash': {'rss_bytes': 41 * sizing.MB, 'threads': 8, 'open_files': 17}}
+    sizing.write_manifests(peaks, tmp_path, tmp_path)
+    sizing.write_manifests(peaks, tmp_path, tmp_path)
+    text = (tmp_path / 'doordash' / sizing.MANIFEST).read_text()
+    assert text.count('# Sized from a profiling run') == 1
+    assert text.count('sgx.max_threads') == 1
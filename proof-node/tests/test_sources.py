@@ -0,0 +1,94 @@
+import threading
+import time
+
+from proof_node.backends import DeadlineExceeded, ValidationError
+from proof_node.dispatcher import Dispatcher
+from proof_node.sources import Feeder
+from proof_node.spool import Spool
+
+
+def open_spool(directory):
+    spool = Spool(str(directory), commit_window=0)
+    spool.open()
+    return spool
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def feed(spool, handler, **kwargs):
+    dispatcher = Dispatcher(handler, workers=2, batch_window=0)
+    feeder = Feeder(spool, dispatcher, retry_base_delay=0.01, retry_max_delay=0.05, **kwargs)
+    thread = threading.Thread(target=feeder.run, daemon=True)
+    thread.start()
+    return dispatcher, thread
+
+
+def stop(spool, dispatcher, thread):
+    spool.close()
+    thread.join(5)
+    dispatcher.shutdown()
+
+
+def test_tasks_that_fail_for_a_passing_reason_survive_a_restart(tmp_path):
+    spool = open_spool(tmp_path)
+    task = {'validator_type': 'analytics', 'data': {'duration': 90}}
+    spool.append(task).result(5)
+    attempts = []
+
+    def handler(task):
+        attempts.append(task)
+        raise ValidationError("No analytics validator was ready", 'no_validator', retryable=True)
+
+    dispatcher, thread = feed(spool, handler)
+    # Sent again rather than dropped
+    wait_for(lambda: len(attempts) >= 3)
+    stop(spool, dispatcher, thread)
+    assert spool.pending() == 1
+
+    reopened = open_spool(tmp_path)
+    assert reopened.pending() == 1
+    assert reopened.get(timeout=0) == (0, task)
+
+
+def test_tasks_are_retried_until_they_succeed(tmp_path):
+    spool = open_spool(tmp_path)
+    for i in range(3):
+        spool.append({'validator_type': 'analytics', 'data': i}).result(5)
+    failures = {'deadline': 2, 'connection': 2}
+    done = []
+
+    def handler(task):
+        for reason, left in failures.items():
+            if left:
+                failures[reason] -= 1
+                if reason == 'deadline':
+                    raise DeadlineExceeded("Task ran out of time before it was sent")
+                raise OSError("Connection refused")
+        return True
+
+    dispatcher, thread = feed(spool, handler, on_done=lambda task, future: done.append(future.result()))
+    wait_for(lambda: len(done) == 3)
+    stop(spool, dispatcher, thread)
+    assert done == [True] * 3
+    assert spool.pending() == 0
+
+
+def test_tasks_that_fail_for_good_are_acknowledged(tmp_path):
+    spool = open_spool(tmp_path)
+    spool.append({'validator_type': 'doordash', 'data': {}}).result(5)
+    errors = []
+
+    def handler(task):
+        raise ValidationError("Validator answered 400", 'http_400')
+
+    dispatcher, thread = feed(spool, handler, on_done=lambda task, future: errors.append(future.exception()))
+    wait_for(lambda: errors)
+    stop(spool, dispatcher, thread)
+    assert errors[0].reason == 'http_400'
+    assert spool.pending() == 0
+    assert open_spool(tmp_path).pending() == 0
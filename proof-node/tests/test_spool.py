@@ -0,0 +1,119 @@
+import errno
+import os
+
+import pytest
+
+from proof_node.spool import Spool
+
+
+class TornFile:
+    # Writes the first bytes of whatever it is given, then fails like a full disk
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        self.f.write(data[:7])
+        self.f.flush()
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def open_spool(directory, **kwargs):
+    spool = Spool(str(directory), commit_window=0, **kwargs)
+    spool.open()
+    return spool
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.log') and name != 'acks.log')
+
+
+def drain(spool):
+    records = []
+    while (record := spool.get(timeout=0)) is not None:
+        records.append(record)
+    return records
+
+
+def test_tasks_come_back_in_order_with_their_seq(tmp_path):
+    spool = open_spool(tmp_path)
+    seqs = [spool.append({'n': i}).result(5) for i in range(5)]
+    assert seqs == list(range(5))
+    assert drain(spool) == [(i, {'n': i}) for i in range(5)]
+    assert spool.pending() == 5
+
+
+def test_unacknowledged_tasks_are_replayed_after_a_restart(tmp_path):
+    spool = open_spool(tmp_path)
+    for i in range(6):
+        spool.append({'n': i}).result(5)
+    for seq, _ in drain(spool):
+        if seq % 2 == 0:
+            spool.ack(seq)
+    spool.close()
+
+    reopened = open_spool(tmp_path)
+    assert reopened.pending() == 3
+    assert drain(reopened) == [(1, {'n': 1}), (3, {'n': 3}), (5, {'n': 5})]
+    assert reopened.append({'n': 6}).result(5) == 6
+
+
+def test_source_offsets_survive_a_restart(tmp_path):
+    spool = open_spool(tmp_path)
+    spool.append({'n': 0}, 'file:tasks', 10).result(5)
+    spool.append({'n': 1}, 'file:tasks', 25).result(5)
+    spool.close()
+    assert open_spool(tmp_path).offset('file:tasks') == 25
+
+
+def test_acknowledged_segments_are_deleted(tmp_path):
+    spool = open_spool(tmp_path, segment_max_bytes=100)
+    for i in range(50):
+        spool.append({'n': i}).result(5)
+    assert len(segments(tmp_path)) > 5
+    for seq, _ in drain(spool):
+        spool.ack(seq)
+    spool.close()
+    assert len(segments(tmp_path)) == 1
+    assert spool.pending() == 0
+    assert open_spool(tmp_path).pending() == 0
+
+
+def test_failed_append_leaves_no_gap_or_torn_bytes(tmp_path):
+    spool = open_spool(tmp_path, segment_max_bytes=100)
+    assert spool.append({'n': 0}).result(5) == 0
+    spool._active = TornFile(spool._active)
+    with pytest.raises(OSError):
+        spool.append({'n': 'lost'}).result(5)
+    seqs = [spool.append({'n': i}).result(5) for i in range(1, 20)]
+    assert seqs == list(range(1, 20))
+
+    records = drain(spool)
+    assert [task for _, task in records] == [{'n': i} for i in range(20)]
+    for seq, _ in records:
+        spool.ack(seq)
+    spool.close()
+    assert spool.pending() == 0
+    assert spool._watermark == 20
+    assert len(segments(tmp_path)) == 1
+
+    reopened = open_spool(tmp_path)
+    assert reopened.pending() == 0
+    assert drain(reopened) == []
+
+
+def test_failed_ack_write_is_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr('proof_node.spool.SPOOL_RETRY_DELAY', 0)
+    spool = open_spool(tmp_path)
+    for i in range(3):
+        spool.append({'n': i}).result(5)
+    spool._ack_log = TornFile(spool._ack_log)
+    for seq, _ in drain(spool):
+        spool.ack(seq)
+    spool.close()
+
+    reopened = open_spool(tmp_path)
+    assert reopened.pending() == 0
+    assert drain(reopened) == []
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# A JSON file with the rules a valid session has to meet; without it the
+# defaults below apply
+ANALYTICS_RULES = os.environ.get('ANALYTICS_RULES')
+
+# At least a minute, at least three pages, and a page that shows intent to buy
+DEFAULT_RULES = [
+    {'rule': 'min', 'field': 'duration', 'value': 60, 'default': 0},
+    {'rule': 'min_length', 'field': 'pages', 'value': 3, 'default': []},
+    {'rule': 'contains_any', 'field': 'pages', 'keywords': ['buy', 'cart', 'checkout'], 'default': []},
+]
+
+
+class Rule:
+    def __init__(self, field, default=None):
+        self.field = field
+        self.default = default
+
+    def __call__(self, session):
+        return self.check(session.get(self.field, self.default))
+
+    def check(self, value):
+        raise NotImplementedError
+
+    def check_column(self, values):
+        # Results for a batch of field values, and which of them could not be
+        # evaluated in bulk and need check() to raise or decide
+        raise NotImplementedError
+
+
+class Threshold(Rule):
+    def __init__(self, field, value, minimum=True, default=None):
+        super().__init__(field, default)
+        self.value = value
+        self.minimum = minimum
+
+    def check(self, value):
+        return self._compare(value)
+
+    def _compare(self, value):
+        return value >= self.value if self.minimum else value <= self.value
+
+    def check_column(self, values):
+        # Integers too large for a float are left to check()
+        irregular = [type(value) not in (int, float, bool) or (type(value) is int and abs(value) > 2 ** 53)
+                     for value in values]
+        numbers = [0 if odd else value for value, odd in zip(values, irregular)]
+        if np is not None:
+            numbers = np.asarray(numbers, dtype=np.float64)
+            passed = numbers >= self.value if self.minimum else numbers <= self.value
+            return passed, np.asarray(irregular)
+        return [self._compare(number) for number in numbers], irregular
+
+
+class Length(Threshold):
+    def check(self, value):
+        return self._compare(len(value))
+
+    def check_column(self, values):
+        irregular = [type(value) is not list for value in values]
+        return super().check_column([0 if odd else len(value) for value, odd in zip(values, irregular)])[0], irregular
+
+
+class ContainsAny(Rule):
+    """Whether any keyword occurs in the field's items, joined and lowercased.
+
+    Keywords that contain another keyword are dropped when compiling, as
+    the shorter one matches wherever they would, and the items are joined
+    and lowercased once per session rather than once per keyword.
+    """
+
+    def __init__(self, field, keywords, default=None):
+        super().__init__(field, default)
+        self.keywords = list(keywords)
+        self._keywords = []
+        for keyword in sorted(set(self.keywords), key=len):
+            if not any(shorter in keyword for shorter in self._keywords):
+                self._keywords.append(keyword)
+
+    def check(self, value):
+        return self._match(' '.join(value).lower())
+
+    def _match(self, text):
+        # CPython's substring search beats a regular expression alternation
+        # of the keywords, even for a few dozen of them
+        for keyword in self._keywords:
+            if keyword in text:
+                return True
+        return False
+
+    def check_column(self, values):
+        passed = []
+        irregular = []
+        match = self._match
+        for value in values:
+            if type(value) is list:
+                try:
+                    passed.append(match(' '.join(value).lower()))
+                    irregular.append(False)
+                    continue
+                except TypeError:
+                    pass
+            passed.append(False)
+            irregular.append(True)
+        return passed, irregular
+
+
+RULES = {
+    'min': lambda spec: Threshold(spec['field'], spec['value'], True, spec.get('default')),
+    'max': lambda spec: Threshold(spec['field'], spec['value'], False, spec.get('default')),
+    'min_length': lambda spec: Length(spec['field'], spec['value'], True, spec.get('default', [])),
+    'max_length': lambda spec: Length(spec['field'], spec['value'], False, spec.get('default', [])),
+    'contains_any': lambda spec: ContainsAny(spec['field'], spec['keywords'], spec.get('default', [])),
+}
+
+
+class Ruleset:
+    """Rules compiled once, all of which a valid session has to meet.
+
+    evaluate() checks one session, stopping at the first rule it fails.
+    evaluate_batch() checks a list of sessions column by column, with
+    NumPy when it is installed, and falls back to evaluate() for sessions
+    whose fields are not plain numbers and lists of strings, so the
+    results, and the errors raised for malformed sessions, are the same.
+    """
+
+    def __init__(self, rules, digest=None):
+        self.rules = rules
+        # Identifies the rules the results came from, for caches of them
+        self.digest = digest
+
+    def evaluate(self, session):
+        for rule in self.rules:
+            if not rule(session):
+                return False
+        return True
+
+    def evaluate_batch(self, sessions):
+        # A result or the exception evaluate() raised, for every session.
+        # Like evaluate(), each rule only sees the sessions that met the
+        # rules before it.
+        results = [False] * len(sessions)
+        active = [index for index, session in enumerate(sessions) if type(session) is dict]
+        fallback = [index for index, session in enumerate(sessions) if type(session) is not dict]
+        for rule in self.rules:
+            if not len(active):
+                break
+            values = [sessions[index].get(rule.field, rule.default) for index in active]
+            passed, irregular = rule.check_column(values)
+            if np is not None:
+                active = np.asarray(active)
+                irregular = np.asarray(irregular, dtype=bool)
+                fallback.extend(active[irregular].tolist())
+                active = active[np.asarray(passed, dtype=bool) & ~irregular]
+            else:
+                fallback.extend(index for index, odd in zip(active, irregular) if odd)
+                active = [index for index, ok, odd in zip(active, passed, irregular) if ok and not odd]
+
+        for index in (active.tolist() if np is not None and not isinstance(active, list) else active):
+            results[index] = True
+        for index in fallback:
+            try:
+                results[index] = self.evaluate(sessions[index])
+            except Exception as e:
+                results[index] = e
+        return results
+
+
+def compile_rules(specs):
+    rules = []
+    for spec in specs:
+        if spec.get('rule') not in RULES:
+            raise ValueError(f"Unknown rule {spec.get('rule')!r}, expected one of {sorted(RULES)}")
+        try:
+            rules.append(RULES[spec['rule']](spec))
+        except KeyError as e:
+            raise ValueError(f"Rule {spec['rule']!r} is missing {e}")
+    canonical = json.dumps(specs, sort_keys=True, separators=(',', ':'))
+    return Ruleset(rules, hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16])
+
+
+def load_ruleset(path=ANALYTICS_RULES):
+    if not path:
+        return compile_rules(DEFAULT_RULES)
+    with open(path) as f:
+        specs = json.load(f)
+    logger.info(f"Loaded {len(specs)} analytics rules from {path}")
+    return compile_rules(specs)
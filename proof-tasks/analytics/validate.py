@@ -1,48 +1,55 @@
-import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import logs
+from rules import load_ruleset
+from validator_server import PHASE_TIME, ValidatorRequestHandler, run_server
+
+logs.setup()
 logger = logging.getLogger(__name__)
 
+# Compiled once, from ANALYTICS_RULES or the default rules (a minute, three
+# pages and one of buy, cart or checkout)
+ruleset = load_ruleset()
+
 def validate_browsing_session(session):
-    MIN_DURATION = 60  # 1 minute in seconds
-    MIN_PAGES = 3
-    VALUABLE_KEYWORDS = {'buy', 'cart', 'checkout'}
-
-    duration = session.get('duration', 0)
-    pages = session.get('pages', [])
-    
-    return (
-        duration >= MIN_DURATION and
-        len(pages) >= MIN_PAGES and
-        any(kw in ' '.join(pages).lower() for kw in VALUABLE_KEYWORDS)
-    )
-
-class ValidatorHandler(BaseHTTPRequestHandler):
+    return ruleset.evaluate(session)
+
+def process_session(session):
+    with PHASE_TIME.labels('validate').time():
+        is_valid = validate_browsing_session(session)
+    return {"is_valid": is_valid}
+
+def process_sessions(sessions):
+    with PHASE_TIME.labels('validate_batch').time():
+        results = ruleset.evaluate_batch(sessions)
+    return [result if isinstance(result, Exception) else {"is_valid": result} for result in results]
+
+# Entry point for the node's in-process backend
+process_record = process_session
+
+class ValidatorHandler(ValidatorRequestHandler):
+    # A pure function of duration and pages, under the ruleset it was given
+    deterministic = True
+    version = ruleset.digest
+
     def do_POST(self):
-        logger.info(f"Received POST request from {self.client_address}")
-        content_length = int(self.headers['Content-Length'])
-        session_data = json.loads(self.rfile.read(content_length))
+        if self.path == '/batch':
+            logger.debug("Received batch request from %s", self.client_address)
+            self.send_batch_results(process_session, process_sessions)
+            logger.debug("Processed batch validation request")
+            return
 
-        is_valid = validate_browsing_session(session_data)
-        result = {"is_valid": is_valid}
+        logger.debug("Received POST request from %s", self.client_address)
+        session_data = self.read_json()
 
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps(result).encode('utf-8'))
-        logger.info(f"Processed validation request. Result: {result}")
+        result = process_session(session_data)
 
-def run_server():
-    server_address = ('0.0.0.0', 8000)
-    httpd = HTTPServer(server_address, ValidatorHandler)
-    logger.info('Starting validator server on 0.0.0.0:8000...')
-    httpd.serve_forever()
+        self.send_json(result)
+        logger.debug("Processed validation request. Result: %s", result)
 
 if __name__ == "__main__":
     logger.info("Starting validator server...")
     try:
-        run_server()
+        run_server(ValidatorHandler, process_record=process_session, process_records=process_sessions)
     except Exception as e:
         logger.error(f"Error starting server: {e}")
\ No newline at end of file
@@ -0,0 +1,92 @@
+# Length-prefixed frames for persistent connections from the node, served
+# on the same port or socket as HTTP.
+#
+# The node opens a connection with a hello: MAGIC, the protocol version and
+# the encoding it would like (b'm' for msgpack, b'j' for JSON), ending in
+# CRLF so a server that only speaks HTTP answers it with a 400 instead of
+# waiting for more. The validator answers with a hello carrying the
+# encoding both sides then use. After that every message is a 4-byte
+# big-endian length followed by the encoded message.
+#
+# Requests carry an id that their response repeats, so one connection
+# carries many requests at once and responses go out as they finish:
+#   {"id": 1, "data": record}      -> {"id": 1, "result": {...}} or {"id": 1, "error": "..."}
+#   {"id": 2, "batch": [records]}  -> {"id": 2, "results": [{...} or {"error": "..."}, ...]}
+#
+# A request may carry timeout_ms, how long the node will wait for it; one
+# that waited for a worker past that gets {"id": ..., "error": ..., "expired": true}.
+import json
+import os
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FRAME_MAX_BYTES = int(os.environ.get('FRAME_MAX_BYTES', 64 * 1024 * 1024))
+
+# No HTTP request starts with a NUL byte
+MAGIC = b'\x00PVF'
+VERSION = 1
+MSGPACK = b'm'
+JSON = b'j'
+HELLO_SIZE = len(MAGIC) + 4
+HEADER = struct.Struct('>I')
+
+
+class EncodeError(ValueError):
+    # A message the connection's encoding cannot carry, such as an integer
+    # too large for msgpack
+    pass
+
+
+def hello(encoding):
+    return MAGIC + bytes([VERSION]) + encoding + b'\r\n'
+
+
+def parse_hello(data):
+    # The encoding a hello asks for, or None if it is not one
+    if len(data) != HELLO_SIZE or not data.startswith(MAGIC) or data[len(MAGIC)] != VERSION \
+            or not data.endswith(b'\r\n'):
+        return None
+    return data[len(MAGIC) + 1:len(MAGIC) + 2]
+
+
+def accept_encoding(requested):
+    return MSGPACK if requested == MSGPACK and msgpack else JSON
+
+
+def encode(message, encoding):
+    try:
+        if encoding == MSGPACK:
+            body = msgpack.packb(message, use_bin_type=True)
+        else:
+            body = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    except (TypeError, ValueError, OverflowError) as e:
+        raise EncodeError(str(e)) from e
+    return HEADER.pack(len(body)) + body
+
+
+def decode(body, encoding):
+    if encoding == MSGPACK:
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+def split_frames(buffer):
+    # Removes the complete frames from the start of buffer, a bytearray, and
+    # returns their bodies
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= HEADER.size:
+        (size,) = HEADER.unpack_from(buffer, offset)
+        if size > FRAME_MAX_BYTES:
+            raise ValueError(f"Frame of {size} bytes is over the limit of {FRAME_MAX_BYTES}")
+        end = offset + HEADER.size + size
+        if len(buffer) < end:
+            break
+        frames.append(bytes(buffer[offset + HEADER.size:end]))
+        offset = end
+    del buffer[:offset]
+    return frames
@@ -0,0 +1,112 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import signal
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# Records waiting for the writer thread; beyond this they are dropped rather
+# than block the thread that logged them
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Share of per-task records logged with extra=SAMPLED that are kept
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+# Values of environment variables named like this never reach the log
+SECRET_NAME = re.compile(r'KEY|TOKEN|SECRET|PASSWORD', re.IGNORECASE)
+REDACTED = '[REDACTED]'
+
+# Marks a record that may be sampled away, e.g.
+#   logger.info("Task for %s finished", validator_type, extra=SAMPLED)
+SAMPLED = {'sampled': True}
+
+_listener = None
+_secrets = set()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # The stdlib's prepare() formats the message on the thread that logged
+    # it, while its arguments still hold what they did then; the writer
+    # thread only adds the timestamp and level, and redacts
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room, so everything logged before exit is written
+        self.queue.put(self._sentinel)
+
+
+class _SamplingFilter(logging.Filter):
+    def filter(self, record):
+        return (not getattr(record, 'sampled', False) or record.levelno >= logging.WARNING
+                or random.random() < LOG_SAMPLE_RATE)
+
+
+class _RedactingFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        for secret in _secrets:
+            message = message.replace(secret, REDACTED)
+        return message
+
+
+def add_secret(value):
+    # Very short values would redact ordinary words
+    if value and len(value) >= 4:
+        _secrets.add(value)
+
+
+def setup(level=LOG_LEVEL):
+    """Send all logging through a queue to a background writer thread.
+
+    Logging never waits on stderr: records are formatted, redacted and
+    written by the writer, and dropped if it falls too far behind. Call
+    once at startup, before any threads that log are running.
+    """
+    global _listener
+    if _listener:
+        return
+    for name, value in os.environ.items():
+        if SECRET_NAME.search(name):
+            add_secret(value)
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(_RedactingFormatter(LOG_FORMAT))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(_SamplingFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+    _listener = _QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def set_level(level):
+    # Per-request detail is logged at DEBUG, so this switches it on and off
+    level = str(level).strip().upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise ValueError(f"Unknown log level {level!r}")
+    logging.getLogger().setLevel(level)
+    return level
+
+
+def get_level():
+    return logging.getLevelName(logging.getLogger().level)
+
+
+def install_signal_handlers():
+    # SIGUSR1 turns on DEBUG, SIGUSR2 goes back to LOG_LEVEL
+    signal.signal(signal.SIGUSR1, lambda signum, frame: set_level('DEBUG'))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: set_level(LOG_LEVEL))
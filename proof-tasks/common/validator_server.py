@@ -0,0 +1,690 @@
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import framing
+import logs
+import metrics
+
+logger = logging.getLogger(__name__)
+
+VALIDATOR_HOST = os.environ.get('VALIDATOR_HOST', '0.0.0.0')
+VALIDATOR_PORT = int(os.environ.get('VALIDATOR_PORT', 8000))
+# Listen on this Unix socket instead of a TCP port, when the node runs
+# validators as local processes
+VALIDATOR_SOCKET = os.environ.get('VALIDATOR_SOCKET')
+# The validator's share of the enclave's threads: the main thread that
+# accepts and parks connections, any background threads the validator has
+# started, and the workers, which get whatever is left. sgx.max_threads in the
+# Gramine manifest also counts Gramine's own helper threads, so the manifests
+# set it three above this
+SGX_MAX_THREADS = int(os.environ.get('SGX_MAX_THREADS', 4))
+VALIDATOR_WORKERS = int(os.environ['VALIDATOR_WORKERS']) if os.environ.get('VALIDATOR_WORKERS') else None
+KEEPALIVE_TIMEOUT = float(os.environ.get('VALIDATOR_KEEPALIVE_TIMEOUT', 15))
+REQUEST_TIMEOUT = float(os.environ.get('VALIDATOR_REQUEST_TIMEOUT', 30))
+DRAIN_TIMEOUT = float(os.environ.get('VALIDATOR_DRAIN_TIMEOUT', 30))
+# Records handed at once to validators that evaluate batches as a whole
+BATCH_CHUNK_SIZE = int(os.environ.get('VALIDATOR_BATCH_CHUNK_SIZE', 1024))
+# Milliseconds the node will still wait for a response when it sends a
+# request; frames carry the same as timeout_ms
+DEADLINE_HEADER = 'X-Deadline-Ms'
+
+REQUESTS = metrics.Counter('validator_requests_total', 'Requests served, by route and status', ['route', 'status'])
+REQUEST_TIME = metrics.Histogram('validator_request_seconds', 'Time to serve a request, by route', ['route'])
+# Validators time their own phases (validation, sealing, attestation) with this
+PHASE_TIME = metrics.Histogram('validator_phase_seconds', 'Time spent in each phase of validation', ['phase'])
+ACTIVE_REQUESTS = metrics.Gauge('validator_active_requests', 'Requests being served')
+IDLE_CONNECTIONS = metrics.Gauge('validator_idle_connections', 'Keep-alive connections waiting for a request')
+
+
+class ValidatorRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between requests, so every response
+    # must carry a Content-Length
+    protocol_version = 'HTTP/1.1'
+    timeout = REQUEST_TIMEOUT
+    disable_nagle_algorithm = True
+    # Validators whose result depends on nothing but the request, with no
+    # side effects, set this so the node may cache their results
+    deterministic = False
+    # Deterministic validators whose results also depend on configuration
+    # set this to a digest of it, and the node drops cached results when it
+    # changes
+    version = None
+
+    def setup(self):
+        # TCP_NODELAY does not apply to Unix sockets
+        if self.request.family == socket.AF_UNIX:
+            self.disable_nagle_algorithm = False
+        super().setup()
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            self.send_health()
+        elif self.path == '/metrics':
+            self.send_metrics()
+        else:
+            self.send_error(404)
+
+    def handle_one_request(self):
+        start = time.perf_counter()
+        self.status = None
+        # A request line that does not parse, such as a frame hello sent to a
+        # server without process_record, leaves no path of its own
+        self.path = ''
+        try:
+            super().handle_one_request()
+        except OSError:
+            raise
+        except Exception as e:
+            if self.status is not None:
+                raise
+            # Answer rather than drop the connection, so the node can tell a
+            # record that failed from a validator that went away
+            logger.error(f"Failed to serve {self.command} {self.path}: {e}")
+            self.close_connection = True  # the body may be partly unread
+            self.send_error(500, explain=str(e))
+        if self.status is not None:
+            route = self.route()
+            REQUEST_TIME.labels(route).observe(time.perf_counter() - start)
+            REQUESTS.labels(route, self.status).inc()
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        if expired(self.received_at, self.headers.get(DEADLINE_HEADER)):
+            # The node has given up on it, and serving it anyway would only
+            # delay the requests queued behind it
+            self.close_connection = True  # the body is left unread
+            self.send_error(504, "Deadline passed before the request was served")
+            return False
+        return True
+
+    def route(self):
+        # First path segment only, so ids in paths do not become labels
+        return '/' + self.path.split('?', 1)[0].strip('/').split('/', 1)[0]
+
+    def health(self):
+        # Extra fields for /healthz; a validator that is not ready to take
+        # work yet sets 'ready' to False
+        return {}
+
+    def send_health(self):
+        # Served by the same workers as validation requests, so an answer
+        # also means there is a worker free to take one
+        health = {
+            'ready': not self.server.draining,
+            'active': self.server.active_requests - 1,  # not counting this request
+            'workers': self.server.workers,
+            'idle_connections': self.server.idle_connections,
+            'framed_connections': self.server.framed_connections,
+            'deterministic': self.deterministic,
+            'version': self.version,
+        }
+        health.update(self.health())
+        self.send_json(health, status=200 if health['ready'] else 503)
+
+    def send_metrics(self):
+        body = metrics.REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        # Health checks and scrapes would drown out everything else
+        if self.path not in ('/healthz', '/metrics'):
+            super().log_request(code, size)
+
+    def log_message(self, format, *args):
+        # The access log is per-request detail, through logging rather than
+        # straight to stderr
+        logger.debug("%s - " + format, self.address_string(), *args)
+
+    def log_error(self, format, *args):
+        logger.warning("%s - " + format, self.address_string(), *args)
+
+    def do_PUT(self):
+        # Switches the log level at runtime; signals other than SIGTERM
+        # do not reach a process in an enclave
+        if self.path != '/loglevel':
+            self.send_error(404)
+            return
+        try:
+            level = logs.set_level(self.read_body().decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            self.send_json({"error": str(e)}, status=400)
+            return
+        logger.info(f"Log level set to {level}")
+        self.send_json({"level": level})
+
+    def read_body(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(content_length)
+
+    def read_json(self):
+        return json.loads(self.read_body())
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def iter_records(self):
+        # A /batch body is either a JSON array or NDJSON, one record per line.
+        # NDJSON may be sent chunked and is parsed as it arrives.
+        content_type = self.headers.get('Content-Type', '')
+        if 'ndjson' not in content_type:
+            body = b''.join(self._iter_body())
+            yield from json.loads(body)
+            return
+        pending = b''
+        for chunk in self._iter_body():
+            pending += chunk
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        if pending.strip():
+            yield json.loads(pending)
+
+    def send_batch_results(self, process_record, process_records=None):
+        # Stream one NDJSON result line per record, in order, as soon as it
+        # has been processed. process_records, if given, takes up to
+        # BATCH_CHUNK_SIZE records at once and returns a result or an
+        # exception for each.
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunk_size = BATCH_CHUNK_SIZE if process_records else 1
+        index = 0
+        records = []
+        try:
+            for record in self.iter_records():
+                records.append(record)
+                if len(records) >= chunk_size:
+                    index = self._send_records(records, index, process_record, process_records)
+                    records = []
+        except ValueError as e:
+            index = self._send_records(records, index, process_record, process_records)
+            # The rest of the body cannot be parsed, so the connection cannot be reused
+            logger.error(f"Malformed batch body after record {index}: {e}")
+            self._write_chunk(json.dumps({"error": f"Malformed batch body: {e}"}).encode('utf-8') + b'\n')
+            self.close_connection = True
+        else:
+            self._send_records(records, index, process_record, process_records)
+        self._write_chunk(b'')
+
+    def _send_records(self, records, index, process_record, process_records):
+        results = process_chunk(records, process_record, process_records)
+        lines = []
+        for offset, result in enumerate(results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to process batch record {index + offset}: {result}")
+                result = {"error": str(result)}
+            lines.append(json.dumps({"index": index + offset, **result}).encode('utf-8') + b'\n')
+        if lines:
+            self._write_chunk(b''.join(lines))
+        return index + len(results)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+
+    def _iter_body(self, chunk_size=65536):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';', 1)[0], 16)
+                if size == 0:
+                    # Skip trailers up to the terminating blank line
+                    while self.rfile.readline().strip():
+                        pass
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                chunk = self.rfile.read(min(chunk_size, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def end_headers(self):
+        if self.server.draining:
+            self.send_header('Connection', 'close')
+        super().end_headers()
+
+
+def expired(received_at, timeout_ms):
+    # Whether a request that arrived at received_at with the given timeout,
+    # if any, has waited past it
+    try:
+        return timeout_ms is not None and time.monotonic() - received_at > float(timeout_ms) / 1000
+    except (TypeError, ValueError):
+        return False
+
+
+def process_chunk(records, process_record, process_records=None):
+    # A result or the exception raised, for each record
+    if process_records and len(records) > 1:
+        try:
+            return process_records(records)
+        except Exception as e:
+            return [e] * len(records)
+    results = []
+    for record in records:
+        try:
+            results.append(process_record(record))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class FramedConnection:
+    # A connection that switched from HTTP to frames. Only the main thread
+    # reads from it and registers or closes it; workers write responses.
+    def __init__(self, handler, encoding, buffer=b''):
+        self.handler = handler
+        self.sock = handler.request
+        self.encoding = encoding
+        self.buffer = bytearray(buffer)
+        self.inflight = 0  # guarded by the server's lock
+        self.stopped = False  # no more requests are read from it
+        self.registered = False
+        self.closed = False
+        self._write_lock = threading.Lock()
+
+    def send(self, message):
+        data = framing.encode(message, self.encoding)
+        with self._write_lock:
+            self.sock.sendall(data)
+
+
+class ValidatorServer(HTTPServer):
+    """HTTP server that runs requests on a fixed pool of worker threads.
+
+    New and idle keep-alive connections are parked in a selector on the
+    main thread rather than pinning a worker, so the thread count stays
+    within the enclave's budget no matter how many connections the node
+    holds open, and a client that connects and sends nothing holds no
+    worker at all.
+    """
+
+    def __init__(self, server_address, handler_class, workers=None, process_record=None, process_records=None):
+        if isinstance(server_address, str):
+            self.address_family = socket.AF_UNIX
+        super().__init__(server_address, handler_class)
+        workers = workers or default_workers()
+        self.workers = workers
+        self.draining = False
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='validator')
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._lock = threading.Lock()
+        self._parked = deque()  # handlers returned by workers, waiting to be watched
+        self._idle = {}  # socket -> (handler, idle since)
+        self._framed = set()
+        self._active = 0
+        # Serve framed connections when given; without them a frame hello
+        # gets the 400 any malformed HTTP request does
+        self.process_record = process_record
+        self.process_records = process_records
+
+    @property
+    def active_requests(self):
+        with self._lock:
+            return self._active
+
+    def server_bind(self):
+        if self.address_family != socket.AF_UNIX:
+            super().server_bind()
+            return
+        # A socket left behind by a previous run would fail the bind
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    @property
+    def idle_connections(self):
+        return len(self._idle)
+
+    @property
+    def framed_connections(self):
+        return len(self._framed)
+
+    def drain(self):
+        # Safe to call from a signal handler
+        self.draining = True
+        self._wakeup()
+
+    def serve_until_drained(self, drain_timeout=DRAIN_TIMEOUT):
+        self._selector.register(self.socket, selectors.EVENT_READ, 'accept')
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, 'wakeup')
+        drain_deadline = None
+        try:
+            while True:
+                for key, _ in self._selector.select(timeout=1):
+                    if key.data == 'accept':
+                        self._accept()
+                    elif key.data == 'wakeup':
+                        self._drain_wakeups()
+                    elif isinstance(key.data, FramedConnection):
+                        self._read_frames(key.data)
+                    else:
+                        self._selector.unregister(key.fileobj)
+                        self._idle.pop(key.fileobj, None)
+                        handler = key.data
+                        first, handler.fresh = handler.fresh, False
+                        self._dispatch(handler, first)
+
+                self._close_idle(KEEPALIVE_TIMEOUT)
+
+                if self.draining:
+                    if drain_deadline is None:
+                        logger.info("Draining validator server")
+                        drain_deadline = time.monotonic() + drain_timeout
+                        self._selector.unregister(self.socket)
+                    self._close_idle(0)
+                    for connection in list(self._framed):
+                        self._settle(connection)
+                    if self.active_requests == 0:
+                        break
+                    if time.monotonic() > drain_deadline:
+                        logger.warning(f"Drain timed out with {self.active_requests} requests in flight")
+                        break
+        finally:
+            for connection in list(self._framed):
+                self._close_framed(connection)
+            self._executor.shutdown(wait=False)
+            self._selector.close()
+            self.server_close()
+        logger.info("Validator server stopped")
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _accept(self):
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            return
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = request
+        handler.client_address = client_address
+        handler.server = self
+        handler.setup()
+        # Dispatched once the first request starts to arrive, and closed
+        # like an idle connection if it never does
+        handler.fresh = True
+        self._idle[request] = (handler, time.monotonic())
+        self._selector.register(request, selectors.EVENT_READ, handler)
+
+    def _dispatch(self, handler, first=False):
+        handler.received_at = time.monotonic()
+        with self._lock:
+            self._active += 1
+        self._executor.submit(self._serve, handler, first)
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup_r.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            parked, self._parked = self._parked, deque()
+        now = time.monotonic()
+        for handler in parked:
+            if isinstance(handler, FramedConnection):
+                self._settle(handler)
+            elif self.draining:
+                self._close(handler)
+            else:
+                self._idle[handler.request] = (handler, now)
+                self._selector.register(handler.request, selectors.EVENT_READ, handler)
+
+    def _close_idle(self, timeout):
+        now = time.monotonic()
+        for sock, (handler, idle_since) in list(self._idle.items()):
+            if now - idle_since >= timeout:
+                self._selector.unregister(sock)
+                del self._idle[sock]
+                self._close(handler)
+
+    def _close(self, handler):
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+
+    def _serve(self, handler, first=False):
+        keep_open = False
+        upgraded = False
+        try:
+            if first and self.process_record and self._wants_frames(handler):
+                upgraded = self._upgrade(handler)
+            else:
+                handler.handle_one_request()
+                # Serve pipelined requests that are already buffered
+                while not handler.close_connection and self._has_buffered_input(handler):
+                    handler.received_at = time.monotonic()
+                    handler.handle_one_request()
+                keep_open = not handler.close_connection and not self.draining
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            if upgraded:
+                pass
+            elif keep_open:
+                with self._lock:
+                    self._parked.append(handler)
+            else:
+                self._close(handler)
+            with self._lock:
+                self._active -= 1
+            self._wakeup()
+
+    # Framed connections
+
+    @staticmethod
+    def _wants_frames(handler):
+        try:
+            return handler.rfile.peek(1)[:1] == framing.MAGIC[:1]
+        except OSError:
+            return False
+
+    def _upgrade(self, handler):
+        encoding = framing.parse_hello(handler.rfile.read(framing.HELLO_SIZE))
+        if encoding is None:
+            logger.warning(f"Malformed frame hello from {handler.address_string()}")
+            return False
+        encoding = framing.accept_encoding(encoding)
+        handler.wfile.write(framing.hello(encoding))
+        # Frames that came in with the hello are already in the read buffer
+        handler.request.settimeout(0)
+        try:
+            buffered = handler.rfile.read1(65536) or b''
+        except OSError:
+            buffered = b''
+        finally:
+            handler.request.settimeout(handler.timeout)
+        connection = FramedConnection(handler, encoding, buffered)
+        logger.debug("Switched connection from %s to frames", handler.address_string())
+        with self._lock:
+            self._parked.append(connection)
+        return True
+
+    def _settle(self, connection):
+        # Starts watching a new framed connection, and stops and closes one
+        # that is done, once its last response has gone out
+        if connection.closed:
+            return
+        if connection.stopped or self.draining:
+            connection.stopped = True
+            if connection.registered:
+                self._selector.unregister(connection.sock)
+                connection.registered = False
+            with self._lock:
+                idle = connection.inflight == 0
+            if idle:
+                self._close_framed(connection)
+            return
+        if not connection.registered:
+            self._framed.add(connection)
+            self._selector.register(connection.sock, selectors.EVENT_READ, connection)
+            connection.registered = True
+            self._dispatch_frames(connection)
+            if connection.stopped:
+                self._settle(connection)
+
+    def _close_framed(self, connection):
+        if connection.registered:
+            self._selector.unregister(connection.sock)
+            connection.registered = False
+        self._framed.discard(connection)
+        if not connection.closed:
+            connection.closed = True
+            self._close(connection.handler)
+
+    def _read_frames(self, connection):
+        try:
+            data = connection.sock.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            connection.stopped = True
+        else:
+            connection.buffer += data
+            self._dispatch_frames(connection)
+        self._settle(connection)
+
+    def _dispatch_frames(self, connection):
+        try:
+            frames = framing.split_frames(connection.buffer)
+        except ValueError as e:
+            logger.error(f"Closing framed connection from {connection.handler.address_string()}: {e}")
+            connection.stopped = True
+            return
+        received_at = time.monotonic()
+        for body in frames:
+            with self._lock:
+                self._active += 1
+                connection.inflight += 1
+            self._executor.submit(self._serve_frame, connection, body, received_at)
+
+    def _serve_frame(self, connection, body, received_at):
+        start = time.perf_counter()
+        status = 200
+        try:
+            message = framing.decode(body, connection.encoding)
+            if expired(received_at, message.get('timeout_ms')):
+                response = {"id": message['id'], "error": "Deadline passed before the request was served",
+                            "expired": True}
+                status = 504
+            else:
+                response = self._frame_response(message)
+            if status == 200 and 'error' in response:
+                status = 500
+            connection.send(response)
+        except Exception as e:
+            # Without a response the node would wait on this request until it
+            # times out, so the connection goes instead
+            logger.error(f"Failed to serve frame from {connection.handler.address_string()}: {e}")
+            status = 500
+            connection.stopped = True
+        finally:
+            REQUEST_TIME.labels('/frames').observe(time.perf_counter() - start)
+            REQUESTS.labels('/frames', status).inc()
+            with self._lock:
+                self._active -= 1
+                connection.inflight -= 1
+                if connection.stopped or self.draining:
+                    self._parked.append(connection)
+            self._wakeup()
+
+    def _frame_response(self, message):
+        if 'batch' in message:
+            records = message['batch']
+            results = []
+            for start in range(0, len(records), BATCH_CHUNK_SIZE):
+                for result in process_chunk(records[start:start + BATCH_CHUNK_SIZE], self.process_record,
+                                            self.process_records):
+                    if isinstance(result, Exception):
+                        logger.error(f"Failed to process batch record {len(results)}: {result}")
+                        result = {"error": str(result)}
+                    results.append(result)
+            return {"id": message['id'], "results": results}
+        try:
+            return {"id": message['id'], "result": self.process_record(message['data'])}
+        except Exception as e:
+            logger.error(f"Failed to process record: {e}")
+            return {"id": message['id'], "error": str(e)}
+
+    @staticmethod
+    def _has_buffered_input(handler):
+        sock = handler.request
+        sock.settimeout(0)
+        try:
+            return bool(handler.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(handler.timeout)
+
+
+def default_workers():
+    # Whatever is left of the thread budget once the validator's own
+    # background threads are running
+    return VALIDATOR_WORKERS or max(1, SGX_MAX_THREADS - threading.active_count())
+
+
+def run_server(handler_class, host=VALIDATOR_HOST, port=VALIDATOR_PORT, workers=None, socket_path=VALIDATOR_SOCKET,
+               process_record=None, process_records=None):
+    # With process_record, and process_records for whole chunks of a batch,
+    # the node may also send records over framed connections
+    httpd = ValidatorServer(socket_path or (host, port), handler_class, workers=workers,
+                            process_record=process_record, process_records=process_records)
+    ACTIVE_REQUESTS.set_function(lambda: httpd.active_requests)
+    IDLE_CONNECTIONS.set_function(lambda: httpd.idle_connections)
+
+    def handle_signal(signum, frame):
+        logger.info(f"Received signal {signum}, draining connections")
+        httpd.drain()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    # Only outside an enclave; inside one PUT /loglevel does the same
+    logs.install_signal_handlers()
+
+    address = socket_path or f'{host}:{port}'
+    logger.info(f'Starting validator server on {address} with {httpd.workers} workers...')
+    httpd.serve_until_drained()
@@ -0,0 +1,113 @@
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import deque
+
+import requests
+
+import logs
+
+logger = logging.getLogger(__name__)
+
+RANDOMNESS_BACKEND = os.environ.get('RANDOMNESS_BACKEND', 'remote')
+RANDOMNESS_FALLBACK = os.environ.get('RANDOMNESS_FALLBACK', 'local')
+RANDOM_API_URL = os.environ.get('RANDOM_API_URL', "https://www.randomnumberapi.com/api/v1.0/random")
+RANDOM_API_TIMEOUT = float(os.environ.get('RANDOM_API_TIMEOUT', 5))
+RANDOMNESS_BUFFER_SIZE = int(os.environ.get('RANDOMNESS_BUFFER_SIZE', 256))
+RANDOMNESS_LOW_WATER = int(os.environ.get('RANDOMNESS_LOW_WATER', 64))
+
+# Same range as the random number API's default
+RANDOM_MIN = 0
+RANDOM_MAX = 100
+
+
+class LocalRandomSource:
+    # Backed by the OS CSPRNG; inside Gramine this is the enclave's own entropy
+    def fetch(self, count):
+        return [RANDOM_MIN + secrets.randbelow(RANDOM_MAX - RANDOM_MIN + 1) for _ in range(count)]
+
+    def next(self):
+        return self.fetch(1)[0]
+
+
+class RemoteRandomSource:
+    def __init__(self, url=RANDOM_API_URL, timeout=RANDOM_API_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def fetch(self, count):
+        response = self._session.get(self.url, params={'min': RANDOM_MIN, 'max': RANDOM_MAX, 'count': count},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return [int(n) for n in response.json()]
+
+    def next(self):
+        return self.fetch(1)[0]
+
+
+class PrefetchingRandomSource:
+    """Serves numbers from a buffer that a background thread refills in bulk.
+
+    Refills start once the buffer drops to low_water. If it ever runs dry
+    the number comes from the fallback source instead, so callers never
+    wait on the network.
+    """
+
+    def __init__(self, source, fallback, buffer_size=RANDOMNESS_BUFFER_SIZE, low_water=RANDOMNESS_LOW_WATER):
+        self.source = source
+        self.fallback = fallback
+        self.buffer_size = buffer_size
+        self.low_water = min(low_water, buffer_size - 1)
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._refill.set()
+
+    def next(self):
+        with self._lock:
+            number = self._buffer.popleft() if self._buffer else None
+            if len(self._buffer) <= self.low_water:
+                self._refill.set()
+        if number is None:
+            logger.warning("Random number buffer is empty, using fallback source", extra=logs.SAMPLED)
+            return self.fallback.next()
+        return number
+
+    def start(self):
+        threading.Thread(target=self._refill_loop, name='randomness-prefetch', daemon=True).start()
+
+    def _refill_loop(self):
+        retry = 1
+        while True:
+            self._refill.wait()
+            with self._lock:
+                missing = self.buffer_size - len(self._buffer)
+            try:
+                numbers = self.source.fetch(missing) if missing > 0 else []
+            except Exception as e:
+                # Includes a body that is not a list of numbers; the thread must outlive it
+                logger.error(f"Failed to prefetch random numbers: {e}")
+                time.sleep(retry)
+                retry = min(retry * 2, 60)
+                continue
+            retry = 1
+            with self._lock:
+                self._buffer.extend(numbers)
+                if len(self._buffer) > self.low_water:
+                    self._refill.clear()
+
+
+SOURCES = {
+    'local': LocalRandomSource,
+    'remote': RemoteRandomSource,
+}
+
+
+def make_random_source(backend=RANDOMNESS_BACKEND, fallback=RANDOMNESS_FALLBACK):
+    source = SOURCES[backend]()
+    if backend == 'local':
+        return source
+    return PrefetchingRandomSource(source, SOURCES[fallback]())
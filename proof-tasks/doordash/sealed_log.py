@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+SEALED_DIR = os.environ.get('SEALED_DIR', '/sealed')
+SEGMENT_MAX_BYTES = int(os.environ.get('SEALED_SEGMENT_MAX_BYTES', 4 * 1024 * 1024))
+COMPACT_AFTER_SEGMENTS = int(os.environ.get('SEALED_COMPACT_AFTER_SEGMENTS', 4))
+GROUP_COMMIT_MAX_RECORDS = int(os.environ.get('SEALED_GROUP_COMMIT_MAX_RECORDS', 256))
+# Seconds append() waits for its record to be durable
+APPEND_TIMEOUT = float(os.environ.get('SEALED_APPEND_TIMEOUT', 30))
+
+SEGMENT_NAME = re.compile(r'^(\d{8})\.log$')
+
+
+class SealedLog:
+    """Append-only record log kept in segment files under the sealed mount.
+
+    Records are NDJSON lines. Appends from concurrent requests are written
+    and fsynced together by a single writer thread (group commit), so each
+    request only pays for encrypting its own record. An in-memory index maps
+    record ids to their location, and once enough segments have filled up
+    the live records in them are compacted into one.
+    """
+
+    def __init__(self, directory=SEALED_DIR, segment_max_bytes=SEGMENT_MAX_BYTES,
+                 compact_after=COMPACT_AFTER_SEGMENTS):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.compact_after = compact_after
+        self._lock = threading.Lock()  # guards the index and segment list
+        self._cond = threading.Condition()  # guards the append queue
+        self._queue = deque()
+        self._index = {}  # record id -> (segment, offset, length)
+        self._latest = None  # location of the most recent record
+        self._segments = []
+        self._active = None
+        self._opened = False
+
+    def open(self):
+        with self._lock:
+            if self._opened:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._segments = sorted(
+                int(match.group(1)) for match in map(SEGMENT_NAME.match, os.listdir(self.directory)) if match
+            )
+            for segment in self._segments:
+                self._recover_segment(segment)
+            if not self._segments:
+                self._segments.append(1)
+            self._active = open(self._path(self._segments[-1]), 'ab')
+            self._opened = True
+        threading.Thread(target=self._write_loop, name='sealed-log-writer', daemon=True).start()
+        logger.info(f"Opened sealed log in {self.directory} with {len(self._index)} records "
+                    f"in {len(self._segments)} segments")
+
+    def append(self, record, timeout=APPEND_TIMEOUT):
+        # Blocks until the record is durable, raising TimeoutError if the
+        # writer cannot get it there in time
+        return self.append_async(record).result(timeout)
+
+    def append_async(self, record):
+        self.open()
+        future = Future()
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        with self._cond:
+            self._queue.append((record.get('id') if isinstance(record, dict) else None, line, future))
+            self._cond.notify()
+        return future
+
+    def get(self, record_id):
+        with self._lock:
+            return self._read(self._index.get(str(record_id)))
+
+    def latest(self):
+        with self._lock:
+            return self._read(self._latest)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._index)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f'{segment:08d}.log')
+
+    def _read(self, location):
+        # Called with the lock held, which keeps compaction from replacing the
+        # segment between the index lookup and the read
+        if location is None:
+            return None
+        segment, offset, length = location
+        with open(self._path(segment), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    def _recover_segment(self, segment):
+        offset = 0
+        with open(self._path(segment), 'rb+') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Torn write from a crash; drop the partial record
+                    f.truncate(offset)
+                    logger.warning(f"Truncated partial record at {segment:08d}.log:{offset}")
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    offset += len(line)
+                    continue
+                self._track(record.get('id') if isinstance(record, dict) else None, (segment, offset, len(line)))
+                offset += len(line)
+
+    def _track(self, record_id, location):
+        if record_id is not None:
+            self._index[str(record_id)] = location
+        self._latest = location
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), GROUP_COMMIT_MAX_RECORDS))]
+
+            offset = None
+            try:
+                offset = self._active.tell()
+                self._active.write(b''.join(line for _, line, _ in batch))
+                self._active.flush()
+                os.fsync(self._active.fileno())
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} sealed records: {e}")
+                self._reset_active(offset)
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._lock:
+                segment = self._segments[-1]
+                for record_id, line, _ in batch:
+                    self._track(record_id, (segment, offset, len(line)))
+                    offset += len(line)
+            for _, _, future in batch:
+                future.set_result(None)
+
+            if offset >= self.segment_max_bytes:
+                # A failure here leaves the active segment as it was; the
+                # next batch tries again
+                try:
+                    self._rotate()
+                except Exception as e:
+                    logger.error(f"Failed to rotate the sealed log: {e}")
+
+    def _reset_active(self, offset):
+        # Cuts whatever part of a failed write reached the active segment, so
+        # the next record starts where the index will say it does
+        path = self._path(self._segments[-1])
+        try:
+            self._active.close()
+        except Exception:
+            # Closing flushes the rest of the failed write, and fails the same way
+            pass
+        try:
+            if offset is not None:
+                os.truncate(path, offset)
+            self._active = open(path, 'ab')
+        except OSError as e:
+            logger.error(f"Failed to reopen {path} after a failed write: {e}")
+
+    def _rotate(self):
+        segment = self._segments[-1] + 1
+        active = open(self._path(segment), 'ab')
+        with self._lock:
+            self._segments.append(segment)
+            previous, self._active = self._active, active
+            closed = self._segments[:-1]
+        previous.close()
+        if len(closed) >= self.compact_after:
+            try:
+                self._compact(closed)
+            except Exception as e:
+                logger.error(f"Failed to compact sealed segments {closed}: {e}")
+                try:
+                    os.remove(self._path(closed[-1]) + '.compact')
+                except OSError:
+                    pass
+
+    def _compact(self, closed):
+        # Copy the live records of all closed segments into one segment that
+        # takes the place of the newest of them, then drop the rest
+        target = closed[-1]
+        tmp_path = self._path(target) + '.compact'
+        with self._lock:
+            live = [(key, location) for key, location in self._index.items() if location[0] in closed]
+            latest = self._latest if self._latest and self._latest[0] in closed else None
+
+        moved = {}
+        offset = 0
+        with open(tmp_path, 'wb') as out:
+            for location in sorted({location for _, location in live} | ({latest} if latest else set())):
+                segment, start, length = location
+                with open(self._path(segment), 'rb') as f:
+                    f.seek(start)
+                    out.write(f.read(length))
+                moved[location] = (target, offset, length)
+                offset += length
+            out.flush()
+            os.fsync(out.fileno())
+
+        with self._lock:
+            os.replace(tmp_path, self._path(target))
+            for key, location in live:
+                if self._index.get(key) == location:
+                    self._index[key] = moved[location]
+            if self._latest in moved:
+                self._latest = moved[self._latest]
+            self._segments = [target] + [segment for segment in self._segments if segment not in closed]
+        for segment in closed[:-1]:
+            os.remove(self._path(segment))
+        logger.info(f"Compacted {len(closed)} sealed segments into {target:08d}.log ({len(moved)} live records)")
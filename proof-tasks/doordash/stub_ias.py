@@ -0,0 +1,106 @@
+# A local stand-in for the Intel Attestation Service, for testing the
+# validator's attestation cache and report verification outside of SGX.
+#
+#   python stub_ias.py --port 8443 --root-ca /tmp/stub_ias_root.pem
+#   IAS_URL=http://127.0.0.1:8443/sgx/dev/attestation/v4/report \
+#   IAS_ROOT_CA_CERT_PATH=/tmp/stub_ias_root.pem IAS_API_KEY=stub \
+#   ATTESTATION_REPORT_PATH=/tmp/report python validate.py
+import argparse
+import base64
+import datetime
+import json
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import quote
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def make_cert(subject, issuer_name, public_key, signing_key, is_ca):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject)]))
+        .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer_name)]))
+        .public_key(public_key)
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=365))
+        .add_extension(x509.BasicConstraints(ca=is_ca, path_length=None), critical=True)
+        .sign(signing_key, hashes.SHA256())
+    )
+
+
+class StubIAS:
+    def __init__(self, mrenclave):
+        self.mrenclave = mrenclave
+        root_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.signing_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.root_cert = make_cert('Stub IAS Root CA', 'Stub IAS Root CA', root_key.public_key(), root_key, True)
+        signing_cert = make_cert('Stub IAS Report Signing', 'Stub IAS Root CA',
+                                 self.signing_key.public_key(), root_key, False)
+        # Same layout as IAS: signing certificate first, URL-encoded
+        self.certs_header = quote(b''.join(
+            cert.public_bytes(serialization.Encoding.PEM) for cert in (signing_cert, self.root_cert)
+        ))
+
+    def report(self, quote_b64):
+        report = {
+            'id': base64.b16encode(quote_b64[:8].encode()).decode(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'version': 4,
+            'isvEnclaveQuoteStatus': 'OK',
+            'isvEnclaveQuoteBody': {'mrenclave': self.mrenclave},
+        }
+        # The validator verifies the signature over json.dumps of the parsed report
+        signature = self.signing_key.sign(json.dumps(report).encode(), padding.PKCS1v15(), hashes.SHA256())
+        return report, base64.b64encode(signature).decode()
+
+
+def make_handler(ias):
+    class StubIASHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            content_length = int(self.headers['Content-Length'])
+            quote_b64 = json.loads(self.rfile.read(content_length)).get('isvEnclaveQuote', '')
+            if not self.headers.get('Ocp-Apim-Subscription-Key'):
+                self.send_error(401, 'Missing subscription key')
+                return
+
+            report, signature = ias.report(quote_b64)
+            body = json.dumps(report).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-IASReport-Signature', signature)
+            self.send_header('X-IASReport-Signing-Certificate', ias.certs_header)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return StubIASHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub Intel Attestation Service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--root-ca', required=True, help='where to write the stub root certificate')
+    parser.add_argument('--mrenclave', default='00' * 32)
+    args = parser.parse_args()
+
+    ias = StubIAS(args.mrenclave)
+    with open(args.root_ca, 'wb') as f:
+        f.write(ias.root_cert.public_bytes(serialization.Encoding.PEM))
+
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(ias))
+    logger.info(f'Stub IAS listening on {args.host}:{args.port}, root CA written to {args.root_ca}')
+    httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
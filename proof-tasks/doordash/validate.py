@@ -1,41 +1,81 @@
 import json
 import requests
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import logging
 import os
 import base64
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import hashlib
+import threading
+import time
+from urllib.parse import unquote
+
+from randomness import PrefetchingRandomSource, make_random_source
+from sealed_log import SEALED_DIR, SealedLog
+import logs
+import metrics
+from validator_server import PHASE_TIME, ValidatorRequestHandler, run_server
+
+logs.setup()
 logger = logging.getLogger(__name__)
 
-# Add this near the top of the file, after the logger setup
+# Redacted from the log, like every variable named like a key or secret
 IAS_API_KEY = os.environ.get('IAS_API_KEY')
-logger.info(f"IAS_API_KEY at startup: {IAS_API_KEY}")
+logger.info(f"IAS_API_KEY is {'set' if IAS_API_KEY else 'not set'}")
+
+# Profiles are appended to a segmented log under the sealed mount, see sealed_log.py
+sealed_log = SealedLog(SEALED_DIR)
+# Where the most recent profile used to be sealed, migrated on startup
+LEGACY_SEALED_FILE_PATH = os.path.join(SEALED_DIR, "sealed_data.txt")
 
-SEALED_FILE_PATH = "/sealed/sealed_data.txt"
+# Prefetched in bulk in the background, see randomness.py
+random_source = make_random_source()
 
 def get_random_number():
-    return requests.get("https://www.randomnumberapi.com/api/v1.0/random").json()[0]
+    with PHASE_TIME.labels('random').time():
+        return random_source.next()
 
 def validate_doordash_profile(profile):
     required_fields = ['id', 'name', 'email', 'phone']
     return all(field in profile for field in required_fields) and get_random_number() > 50
 
+def process_profile(profile):
+    with PHASE_TIME.labels('validate').time():
+        is_valid = validate_doordash_profile(profile)
+
+    # Seal the data as a side effect
+    seal_data(profile)
+    return {"is_valid": is_valid}
+
+# Entry point for the node's in-process backend, after setup()
+process_record = process_profile
+
 def seal_data(data):
-    with open(SEALED_FILE_PATH, 'w') as f:
-        json.dump(data, f)
-    logger.info(f"Data sealed to {SEALED_FILE_PATH}")
+    with PHASE_TIME.labels('seal').time():
+        sealed_log.append(data)
+    logger.debug("Data sealed to %s", SEALED_DIR)
 
-def unseal_data():
+def unseal_data(record_id=None):
+    if record_id is not None:
+        return sealed_log.get(record_id)
+    return sealed_log.latest()
+
+def migrate_legacy_sealed_data():
     try:
-        with open(SEALED_FILE_PATH, 'r') as f:
-            return json.load(f)
+        with open(LEGACY_SEALED_FILE_PATH, 'r') as f:
+            data = json.load(f)
     except FileNotFoundError:
-        return None
+        return
+    except ValueError as e:
+        logger.error(f"Could not migrate {LEGACY_SEALED_FILE_PATH}: {e}")
+        return
+    sealed_log.append(data)
+    os.remove(LEGACY_SEALED_FILE_PATH)
+    logger.info(f"Migrated {LEGACY_SEALED_FILE_PATH} into the sealed log")
+
+ATTESTATION_REPORT_PATH = os.environ.get('ATTESTATION_REPORT_PATH', '/dev/attestation/report')
 
 def get_attestation_report():
     try:
-        with open('/dev/attestation/report', 'rb') as f:
+        with open(ATTESTATION_REPORT_PATH, 'rb') as f:
             report = f.read()
         logger.info('Fetched attestation report successfully')
         return report.hex()  # Return report in hexadecimal format
@@ -43,10 +83,14 @@ def get_attestation_report():
         logger.error(f'Failed to fetch attestation report: {e}')
         return None
 
-IAS_URL = "https://api.trustedservices.intel.com/sgx/dev/attestation/v4/report"
+# IAS_URL can point at a local stub IAS (see stub_ias.py) for testing
+IAS_URL = os.environ.get('IAS_URL', "https://api.trustedservices.intel.com/sgx/dev/attestation/v4/report")
+IAS_TIMEOUT = float(os.environ.get('IAS_TIMEOUT', 30))
+
+ATTESTATION_FETCHES = metrics.Counter('validator_attestation_fetches_total',
+                                      'Attestation reports fetched from IAS, by outcome', ['outcome'])
 
 def verify_with_ias(quote):
-    logger.info(f"IAS_API_KEY at verify_with_ias: {IAS_API_KEY}")
     if not IAS_API_KEY:
         logger.error("IAS_API_KEY environment variable not set")
         return None
@@ -58,16 +102,17 @@ def verify_with_ias(quote):
     try:
         quote_bytes = bytes.fromhex(quote)
         data = {"isvEnclaveQuote": base64.b64encode(quote_bytes).decode()}
-        logger.info(f"Sending request to IAS with data: {data}")
+        logger.debug("Sending request to IAS with data: %s", data)
     except ValueError as e:
         logger.error(f"Failed to convert quote to bytes: {e}")
         return None
 
     try:
-        response = requests.post(IAS_URL, headers=headers, json=data)
+        with PHASE_TIME.labels('ias').time():
+            response = requests.post(IAS_URL, headers=headers, json=data, timeout=IAS_TIMEOUT)
         logger.info(f"IAS response status code: {response.status_code}")
-        logger.info(f"IAS response headers: {response.headers}")
-        logger.info(f"IAS response content: {response.text}")
+        logger.debug("IAS response headers: %s", response.headers)
+        logger.debug("IAS response content: %s", response.text)
 
         if response.status_code == 200:
             return response
@@ -81,7 +126,7 @@ def verify_with_ias(quote):
 # The following imports and constants are typically part of the client code
 # They are included here for testing purposes
 from cryptography import x509
-from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from cryptography.hazmat.backends import default_backend
@@ -121,10 +166,32 @@ DaVzWh5aiEx+idkSGMnX
 -----END CERTIFICATE-----
 """
 
+# Tests against a stub IAS can trust its root certificate instead
+IAS_ROOT_CA_CERT_PATH = os.environ.get('IAS_ROOT_CA_CERT_PATH')
+if IAS_ROOT_CA_CERT_PATH:
+    with open(IAS_ROOT_CA_CERT_PATH) as f:
+        INTEL_SGX_ROOT_CA_CERT_PEM = f.read()
+
+# Parsed once; every chain is checked against these bytes
+ROOT_CERT = x509.load_pem_x509_certificate(INTEL_SGX_ROOT_CA_CERT_PEM.strip().encode(), default_backend())
+ROOT_CERT_PEM = ROOT_CERT.public_bytes(serialization.Encoding.PEM)
+
+# Chain verification results keyed by the SHA-256 of the certificate bundle.
+# IAS signs with the same few certificates, so this stays tiny.
+MAX_VERIFIED_BUNDLES = 32
+verified_bundles = {}
+verified_bundles_lock = threading.Lock()
+
 # The following functions would typically be part of the client code
 # They are included here for testing purposes
+def root_first(cert_chain):
+    # IAS sends the signing certificate first, the chain is walked from the root
+    if cert_chain and cert_chain[-1].public_bytes(serialization.Encoding.PEM) == ROOT_CERT_PEM:
+        return cert_chain[::-1]
+    return cert_chain
+
 def verify_certificate_chain(cert_chain):
-    root_cert = x509.load_pem_x509_certificate(INTEL_SGX_ROOT_CA_CERT_PEM.encode(), default_backend())
+    cert_chain = root_first(cert_chain)
 
     for i in range(len(cert_chain) - 1, 0, -1):
         issuer = cert_chain[i-1]
@@ -140,19 +207,34 @@ def verify_certificate_chain(cert_chain):
         except:
             return False
 
-    if cert_chain[0].public_bytes(serialization.Encoding.PEM) != root_cert.public_bytes(serialization.Encoding.PEM):
+    if cert_chain[0].public_bytes(serialization.Encoding.PEM) != ROOT_CERT_PEM:
         return False
 
     return True
 
-def verify_ias_report(ias_report, ias_signature, ias_certs):
-    cert_chain = x509.load_pem_x509_certificates(ias_certs.encode(), default_backend())
+def verify_cert_bundle(ias_certs):
+    # Returns the leaf public key of a verified bundle, or None
+    bundle_hash = hashlib.sha256(ias_certs.encode()).digest()
+    with verified_bundles_lock:
+        if bundle_hash in verified_bundles:
+            return verified_bundles[bundle_hash]
 
-    if not verify_certificate_chain(cert_chain):
-        return False
+    try:
+        cert_chain = root_first(x509.load_pem_x509_certificates(ias_certs.encode()))
+    except ValueError:
+        return None
+    public_key = cert_chain[-1].public_key() if verify_certificate_chain(cert_chain) else None
+
+    with verified_bundles_lock:
+        if len(verified_bundles) >= MAX_VERIFIED_BUNDLES:
+            verified_bundles.clear()
+        verified_bundles[bundle_hash] = public_key
+    return public_key
 
-    leaf_cert = cert_chain[-1]
-    public_key = leaf_cert.public_key()
+def verify_ias_report(ias_report, ias_signature, ias_certs):
+    public_key = verify_cert_bundle(ias_certs)
+    if not public_key:
+        return False
 
     try:
         public_key.verify(
@@ -165,22 +247,91 @@ def verify_ias_report(ias_report, ias_signature, ias_certs):
     except:
         return False
 
-class ValidatorHandler(BaseHTTPRequestHandler):
-    def get_attestation_data(self):
-        quote = get_attestation_report()
-        if not quote:
-            return None, "Failed to get attestation report"
-
-        ias_response = verify_with_ias(quote)
-        if not ias_response:
-            return None, "IAS verification failed"
+def fetch_attestation_data():
+    quote = get_attestation_report()
+    if not quote:
+        ATTESTATION_FETCHES.labels('no_report').inc()
+        return None, "Failed to get attestation report"
+
+    ias_response = verify_with_ias(quote)
+    if not ias_response:
+        ATTESTATION_FETCHES.labels('ias_failed').inc()
+        return None, "IAS verification failed"
+    ATTESTATION_FETCHES.labels('ok').inc()
+
+    attestation_data = {
+        'ias_report': ias_response.json(),
+        'ias_signature': ias_response.headers.get('X-IASReport-Signature'),
+        # IAS URL-encodes the PEM bundle to fit it in a header
+        'ias_certs': unquote(ias_response.headers.get('X-IASReport-Signing-Certificate', ''))
+    }
+    return attestation_data, None
+
+ATTESTATION_TTL = float(os.environ.get('ATTESTATION_TTL', 3600))
+ATTESTATION_REFRESH_MARGIN = float(os.environ.get('ATTESTATION_REFRESH_MARGIN', 300))
+
+class AttestationCache:
+    """Keeps the latest IAS-verified attestation for ATTESTATION_TTL seconds.
+
+    A background thread fetches it at startup and again shortly before it
+    expires, so requests only wait on IAS if the cache is cold or a refresh
+    has failed for longer than the TTL.
+    """
+
+    def __init__(self, ttl=ATTESTATION_TTL, refresh_margin=ATTESTATION_REFRESH_MARGIN):
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl / 2)
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._data = None
+        self._expires_at = 0
+
+    def get(self):
+        with self._lock:
+            if self._data and time.monotonic() < self._expires_at:
+                return self._data, None
+        return self.refresh(force=False)
+
+    def refresh(self, force=True):
+        with self._fetch_lock:
+            with self._lock:
+                if not force and self._data and time.monotonic() < self._expires_at:
+                    return self._data, None
+            attestation_data, error = fetch_attestation_data()
+            if error:
+                return None, error
+            with self._lock:
+                self._data = attestation_data
+                self._expires_at = time.monotonic() + self.ttl
+            logger.info("Refreshed cached attestation data")
+            return attestation_data, None
+
+    def start(self):
+        threading.Thread(target=self._refresh_loop, name='attestation-refresh', daemon=True).start()
+
+    def _refresh_loop(self):
+        retry = 5
+        while True:
+            _, error = self.refresh()
+            if error:
+                logger.error(f"Background attestation refresh failed: {error}")
+                time.sleep(retry)
+                # Backs off to at most a minute, or the refresh margin if longer,
+                # and never to nothing when the margin is zero
+                retry = min(max(retry * 2, 1), max(self.refresh_margin, 60))
+                continue
+            retry = 5
+            time.sleep(self.ttl - self.refresh_margin)
+
+attestation_cache = AttestationCache()
+
+class ValidatorHandler(ValidatorRequestHandler):
+    # Draws random numbers and seals every profile, so results must never
+    # be served from a cache
+    deterministic = False
 
-        attestation_data = {
-            'ias_report': ias_response.json(),
-            'ias_signature': ias_response.headers.get('X-IASReport-Signature'),
-            'ias_certs': ias_response.headers.get('X-IASReport-Signing-Certificate')
-        }
-        return attestation_data, None
+    def get_attestation_data(self):
+        return attestation_cache.get()
 
     def verify_attestation(self, attestation_data, expected_mrenclave=None):
         if not verify_ias_report(attestation_data['ias_report'], attestation_data['ias_signature'], attestation_data['ias_certs']):
@@ -197,32 +348,41 @@ class ValidatorHandler(BaseHTTPRequestHandler):
 
         return None
 
+    def health(self):
+        return {'sealed_records': len(sealed_log)}
+
     def do_GET(self):
-        if self.path == '/attestation':
+        if self.path == '/healthz':
+            self.send_health()
+        elif self.path == '/metrics':
+            self.send_metrics()
+        elif self.path == '/attestation':
             attestation_data, error = self.get_attestation_data()
             if error:
                 self.send_error(500, error)
                 return
 
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(attestation_data).encode('utf-8'))
+            self.send_json(attestation_data)
             logger.info("Sent attestation data")
+        elif self.path.startswith('/sealed/'):
+            logger.info(f"Received GET request from {self.client_address}")
+            sealed_data = unseal_data(self.path[len('/sealed/'):])
+            if sealed_data is None:
+                self.send_error(404, "No sealed record with that id")
+                return
+
+            self.send_json(sealed_data)
+            logger.info("Returned sealed data")
         else:
             logger.info(f"Received GET request from {self.client_address}")
             sealed_data = unseal_data()
 
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(sealed_data).encode('utf-8'))
+            self.send_json(sealed_data)
             logger.info("Returned sealed data")
 
     def do_POST(self):
         if self.path == '/test_attestation':
-            content_length = int(self.headers['Content-Length'])
-            post_data = json.loads(self.rfile.read(content_length))
+            post_data = self.read_json()
             expected_mrenclave = post_data.get('expected_mrenclave')
 
             attestation_data, error = self.get_attestation_data()
@@ -236,40 +396,39 @@ class ValidatorHandler(BaseHTTPRequestHandler):
                 return
 
             # If we've made it this far, attestation is successful
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"message": "Attestation verified successfully"}).encode('utf-8'))
+            self.send_json({"message": "Attestation verified successfully"})
             logger.info("Attestation verified successfully")
+        elif self.path == '/batch':
+            logger.debug("Received batch request from %s", self.client_address)
+            self.send_batch_results(process_profile)
+            logger.debug("Processed batch validation request")
         else:
-            logger.info(f"Received POST request from {self.client_address}")
-            content_length = int(self.headers['Content-Length'])
-            profile_data = json.loads(self.rfile.read(content_length))
+            logger.debug("Received POST request from %s", self.client_address)
+            profile_data = self.read_json()
+
+            result = process_profile(profile_data)
 
-            is_valid = validate_doordash_profile(profile_data)
-            result = {"is_valid": is_valid}
+            self.send_json(result)
+            logger.debug("Processed validation request. Result: %s", result)
 
-            # Seal the data as a side effect
-            seal_data(profile_data)
+# Startup shared by the server and the node's in-process backend
+def setup():
+    os.makedirs(SEALED_DIR, exist_ok=True)
+    sealed_log.open()
+    migrate_legacy_sealed_data()
 
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(result).encode('utf-8'))
-            logger.info(f"Processed validation request. Result: {result}")
+    if isinstance(random_source, PrefetchingRandomSource):
+        random_source.start()
 
-def run_server():
-    server_address = ('0.0.0.0', 8000)
-    httpd = HTTPServer(server_address, ValidatorHandler)
-    logger.info('Starting validator server on 0.0.0.0:8000...')
-    httpd.serve_forever()
+    # Only an enclave can produce a report to attest
+    if os.path.exists(ATTESTATION_REPORT_PATH):
+        attestation_cache.start()
 
 if __name__ == "__main__":
     logger.info("Starting validator server...")
-    logger.info(f"IAS_API_KEY before server start: {IAS_API_KEY}")
-    os.makedirs("/sealed", exist_ok=True)
+    setup()
 
     try:
-        run_server()
+        run_server(ValidatorHandler, process_record=process_profile)
     except Exception as e:
         logger.error(f"Error starting server: {e}")
\ No newline at end of file
@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# Validators import their modules and the shared runtime as top-level
+# modules, as they are laid out in their containers
+TASKS_DIR = Path(__file__).resolve().parents[1]
+for directory in ('common', 'analytics', 'doordash'):
+    sys.path.insert(0, str(TASKS_DIR / directory))
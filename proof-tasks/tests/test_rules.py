@@ -0,0 +1,123 @@
+import random
+
+import pytest
+
+import rules
+from rules import DEFAULT_RULES, compile_rules
+
+SESSIONS = 20000
+
+
+def validate_browsing_session(session):
+    # The analytics validator before its rules were configurable
+    MIN_DURATION = 60  # 1 minute in seconds
+    MIN_PAGES = 3
+    VALUABLE_KEYWORDS = {'buy', 'cart', 'checkout'}
+
+    duration = session.get('duration', 0)
+    pages = session.get('pages', [])
+
+    return (
+        duration >= MIN_DURATION and
+        len(pages) >= MIN_PAGES and
+        any(kw in ' '.join(pages).lower() for kw in VALUABLE_KEYWORDS)
+    )
+
+
+def random_page(rng):
+    words = ['home', 'search', 'product', 'buy', 'BUY-now', 'Cart', 'cart', 'checkOUT', 'check', 'out', 'ca', 'rt',
+             'bu', 'y', '', ' ', 'büy', 'caRT?id=1', '/shop/item/42']
+    return ''.join(rng.choice(words) for _ in range(rng.randint(0, 3)))
+
+
+def random_duration(rng):
+    if rng.random() < 0.8:
+        return rng.choice([rng.randint(0, 120), 60, 59.999, rng.uniform(-10, 200)])
+    return rng.choice([
+        lambda: rng.choice([True, False]),
+        lambda: rng.choice([2 ** 53 + 1, -2 ** 63, 10 ** 30]),
+        lambda: rng.choice([float('nan'), float('inf'), float('-inf')]),
+        lambda: None,
+        lambda: '90',
+        lambda: [90],
+        lambda: {'seconds': 90},
+    ])()
+
+
+def random_pages(rng):
+    if rng.random() < 0.8:
+        return [random_page(rng) for _ in range(rng.choice([rng.randint(0, 6), 3]))]
+    return rng.choice([
+        lambda: [random_page(rng) for _ in range(rng.randint(2, 5))] + [rng.choice([None, 1, 2.5, ['cart'], {}])],
+        lambda: random_page(rng),
+        lambda: {random_page(rng): 1 for _ in range(rng.randint(0, 5))},
+        lambda: None,
+        lambda: rng.randint(0, 5),
+        lambda: [],
+    ])()
+
+
+def random_session(rng):
+    if rng.random() < 0.02:
+        return rng.choice([None, [], 'session', 42])
+    session = {}
+    if rng.random() < 0.9:
+        session['duration'] = random_duration(rng)
+    if rng.random() < 0.9:
+        session['pages'] = random_pages(rng)
+    if rng.random() < 0.1:
+        session['user'] = 'u1'
+    return session
+
+
+def outcome(check, session):
+    try:
+        return check(session)
+    except Exception as e:
+        return e
+
+
+def same(result, expected):
+    if isinstance(expected, Exception):
+        return type(result) is type(expected) and str(result) == str(expected)
+    return type(result) is type(expected) and result == expected
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def ruleset(request, monkeypatch):
+    if request.param == 'python':
+        monkeypatch.setattr(rules, 'np', None)
+    elif rules.np is None:
+        pytest.skip("NumPy is not installed")
+    return compile_rules(DEFAULT_RULES)
+
+
+@pytest.fixture(scope='module')
+def sessions():
+    rng = random.Random(20240611)
+    return [random_session(rng) for _ in range(SESSIONS)]
+
+
+def test_default_rules_match_the_old_validator(ruleset, sessions):
+    for session in sessions:
+        expected = outcome(validate_browsing_session, session)
+        result = outcome(ruleset.evaluate, session)
+        assert same(result, expected), session
+
+
+def test_batches_match_the_old_validator(ruleset, sessions):
+    rng = random.Random(7)
+    start = 0
+    while start < len(sessions):
+        size = rng.choice([1, 2, 17, 256, 1000])
+        batch = sessions[start:start + size]
+        for session, result in zip(batch, ruleset.evaluate_batch(batch)):
+            expected = outcome(validate_browsing_session, session)
+            assert same(result, expected), session
+        start += size
+
+
+def test_digest_follows_the_rules():
+    assert compile_rules(DEFAULT_RULES).digest == compile_rules([dict(spec) for spec in DEFAULT_RULES]).digest
+    changed = DEFAULT_RULES[:2] + [{**DEFAULT_RULES[2], 'keywords': ['buy', 'cart']}]
+    assert compile_rules(changed).digest != compile_rules(DEFAULT_RULES).digest
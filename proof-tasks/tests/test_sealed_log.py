@@ -0,0 +1,120 @@
+import errno
+import os
+import threading
+
+import pytest
+
+from sealed_log import SealedLog
+
+
+class TornFile:
+    # Writes the first bytes of whatever it is given, then fails like a full disk
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        self.f.write(data[:5])
+        self.f.flush()
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.log'))
+
+
+def test_records_survive_a_restart(tmp_path):
+    log = SealedLog(str(tmp_path))
+    for i in range(10):
+        log.append({'id': i, 'value': i * 2})
+    log.append({'id': 3, 'value': 'updated'})
+
+    reopened = SealedLog(str(tmp_path))
+    reopened.open()
+    assert len(reopened) == 10
+    assert reopened.get(3) == {'id': 3, 'value': 'updated'}
+    assert reopened.latest() == {'id': 3, 'value': 'updated'}
+
+
+def test_partial_record_at_the_end_is_dropped(tmp_path):
+    log = SealedLog(str(tmp_path))
+    log.append({'id': 1})
+    with open(tmp_path / '00000001.log', 'ab') as f:
+        f.write(b'{"id": 2, "na')
+
+    reopened = SealedLog(str(tmp_path))
+    reopened.open()
+    assert reopened.get(1) == {'id': 1}
+    assert reopened.get(2) is None
+    reopened.append({'id': 3})
+    again = SealedLog(str(tmp_path))
+    again.open()
+    assert again.get(3) == {'id': 3}
+
+
+def test_compaction_keeps_live_records(tmp_path):
+    log = SealedLog(str(tmp_path), segment_max_bytes=200, compact_after=2)
+    for i in range(200):
+        log.append({'id': i % 7, 'value': i})
+    assert len(segments(tmp_path)) <= 3
+
+    reopened = SealedLog(str(tmp_path))
+    reopened.open()
+    for key in range(7):
+        assert reopened.get(key)['value'] == max(i for i in range(200) if i % 7 == key)
+    assert reopened.latest() == {'id': 199 % 7, 'value': 199}
+
+
+def test_failed_write_leaves_no_torn_bytes(tmp_path):
+    log = SealedLog(str(tmp_path))
+    log.append({'id': 1})
+    log._active = TornFile(log._active)
+    with pytest.raises(OSError):
+        log.append({'id': 2})
+    log.append({'id': 3})
+
+    reopened = SealedLog(str(tmp_path))
+    reopened.open()
+    assert reopened.get(1) == {'id': 1}
+    assert reopened.get(2) is None
+    assert reopened.get(3) == {'id': 3}
+    assert log.get(3) == {'id': 3}
+
+
+def test_failed_rotation_keeps_the_writer_alive(tmp_path, monkeypatch):
+    log = SealedLog(str(tmp_path), segment_max_bytes=1)
+    log.open()
+
+    def rotate():
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(log, '_rotate', rotate)
+    for i in range(3):
+        log.append({'id': i}, timeout=5)
+    assert [log.get(i) for i in range(3)] == [{'id': 0}, {'id': 1}, {'id': 2}]
+
+
+def test_failed_compaction_keeps_the_writer_alive(tmp_path, monkeypatch):
+    log = SealedLog(str(tmp_path), segment_max_bytes=1, compact_after=2)
+    log.open()
+
+    def compact(closed):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(log, '_compact', compact)
+    for i in range(5):
+        log.append({'id': i}, timeout=5)
+    assert log.get(4) == {'id': 4}
+
+
+def test_append_times_out_when_the_writer_is_stuck(tmp_path, monkeypatch):
+    log = SealedLog(str(tmp_path))
+    log.open()
+    release = threading.Event()
+    fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: (release.wait(), fsync(fd)))
+    with pytest.raises(TimeoutError):
+        log.append({'id': 1}, timeout=0.1)
+    release.set()
@@ -0,0 +1,58 @@
+import http.client
+import json
+import socket
+import threading
+
+import pytest
+
+from validator_server import ValidatorRequestHandler, ValidatorServer
+
+
+@pytest.fixture
+def server():
+    httpd = ValidatorServer(('127.0.0.1', 0), ValidatorRequestHandler, workers=2)
+    thread = threading.Thread(target=httpd.serve_until_drained, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.drain()
+    thread.join(10)
+
+
+def get(server, path, timeout=5):
+    connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=timeout)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def test_silent_connections_hold_no_worker(server):
+    silent = [socket.create_connection(('127.0.0.1', server.server_address[1])) for _ in range(server.workers * 3)]
+    try:
+        status, _ = get(server, '/healthz')
+        assert status == 200
+    finally:
+        for sock in silent:
+            sock.close()
+
+
+def test_keep_alive_connection_serves_several_requests(server):
+    connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+    try:
+        for _ in range(3):
+            connection.request('GET', '/healthz')
+            response = connection.getresponse()
+            assert response.status == 200
+            response.read()
+    finally:
+        connection.close()
+
+
+def test_health_reports_how_results_may_be_cached(server):
+    status, body = get(server, '/healthz')
+    health = json.loads(body)
+    assert status == 200
+    assert health['deterministic'] is False
+    assert health['version'] is None